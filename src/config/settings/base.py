@@ -35,7 +35,7 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
-    'django.contrib.admin',
+    'server_panel.apps.ServerAdminConfig',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
@@ -45,6 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'server_panel.middleware.MetricsMiddleware',
+    'server_panel.middleware.PrimaryStickinessMiddleware',
+    'server_panel.middleware.AuditMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,6 +81,50 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 DATABASE_ROUTERS = ['server_panel.dbrouters.ServerRouter']
 
+# Options of the SQLite database of the admin (users, admin log). In WAL mode reads go on during
+# a write; transactions take the write lock when they start and wait up to `timeout` seconds for
+# it, instead of failing with "database is locked" when several workers write at once.
+SQLITE_OPTIONS = {
+    'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+    'timeout': 20,
+    'transaction_mode': 'IMMEDIATE',
+}
+
+# Sessions are read from the Redis cache and written through to SQLite only when they change (login,
+# CSV filter), so requests do not write to SQLite and an evicted or flushed Redis key does not log out
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Seconds a connection to the server database is reused by the requests of a worker thread,
+# connections are checked before reuse (CONN_HEALTH_CHECKS). 0 opens a connection per request.
+DATABASE_CONN_MAX_AGE = int(os.getenv('DATABASE_CONN_MAX_AGE') or 60)
+
+# Read replicas of the vodomat_server database (alias: weight), reads are spread over them by
+# weighted round-robin. See replica_databases() for the aliases configured from the environment.
+DATABASE_REPLICAS = {}
+
+# Seconds a browser reads from the primary after it changed something, covers the replication lag
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS') or 10)
+
+
+def replica_databases(primary: dict, hosts: str, weights: str) -> tuple[dict, dict]:
+    """Return the database settings of the replicas of a primary and their weights, from
+    comma-separated ``host[:port]`` and weight lists, e.g. ``replica1,replica2:3307`` and ``2,1``.
+    """
+    weights = [int(weight) for weight in (weights or '').split(',') if weight.strip()]
+    databases, replicas = {}, {}
+    for i, replica in enumerate(host.strip() for host in (hosts or '').split(',') if host.strip()):
+        host, _, port = replica.partition(':')
+        alias = f'vodomat_server_replica_{i + 1}'
+        databases[alias] = {
+            **primary,
+            'HOST': host,
+            'PORT': port or primary.get('PORT'),
+            # Tests read the replicas from the test database of the primary
+            'TEST': {'MIRROR': 'vodomat_server'},
+        }
+        replicas[alias] = weights[i] if i < len(weights) else 1
+    return databases, replicas
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -119,3 +166,75 @@ STATIC_ROOT = BASE_DIR / 'static'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Vodomat server API
+
+# Maximum number of parallel requests when an action pushes a parameter to many avtomats
+SERVER_API_MAX_WORKERS = int(os.getenv('SERVER_API_MAX_WORKERS') or 16)
+
+# Seconds to wait for a connection and for a response
+SERVER_API_CONNECT_TIMEOUT = float(os.getenv('SERVER_API_CONNECT_TIMEOUT') or 3.05)
+SERVER_API_READ_TIMEOUT = float(os.getenv('SERVER_API_READ_TIMEOUT') or 10)
+
+# Retries for connection errors and 502/503/504 responses, with exponential backoff
+SERVER_API_RETRIES = int(os.getenv('SERVER_API_RETRIES') or 2)
+SERVER_API_BACKOFF_FACTOR = float(os.getenv('SERVER_API_BACKOFF_FACTOR') or 0.3)
+
+# Fail fast after this many consecutive failures, try again after the reset timeout (seconds)
+SERVER_API_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('SERVER_API_CIRCUIT_FAILURE_THRESHOLD') or 5)
+SERVER_API_CIRCUIT_RESET_TIMEOUT = float(os.getenv('SERVER_API_CIRCUIT_RESET_TIMEOUT') or 30)
+
+# Background jobs (python manage.py run_jobs)
+
+# Avtomats processed between two progress updates
+JOBS_BATCH_SIZE = int(os.getenv('JOBS_BATCH_SIZE') or 50)
+
+# Seconds without a heartbeat after which a running job is handed to another worker
+JOBS_HEARTBEAT_TIMEOUT = int(os.getenv('JOBS_HEARTBEAT_TIMEOUT') or 60)
+
+# Seconds a finished job stays available for its progress page
+JOBS_RESULT_TTL = int(os.getenv('JOBS_RESULT_TTL') or 7 * 24 * 3600)
+
+# Busy avtomats are retried by the job workers with exponential backoff (seconds) and jitter
+RETRY_BASE_DELAY = int(os.getenv('RETRY_BASE_DELAY') or 60)
+RETRY_MAX_DELAY = int(os.getenv('RETRY_MAX_DELAY') or 3600)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS') or 10)
+
+# Activity rollup of the statistic table, refreshed by the job workers
+
+# Days without new statistic rows after which an avtomat counts as inactive
+ACTIVITY_WINDOW_DAYS = int(os.getenv('ACTIVITY_WINDOW_DAYS') or 7)
+
+# Seconds between two refreshes
+ACTIVITY_REFRESH_INTERVAL = int(os.getenv('ACTIVITY_REFRESH_INTERVAL') or 300)
+
+# Seconds between two rebuilds of the fleet status counts, which admin changes keep current in between
+FLEET_STATUS_REFRESH_INTERVAL = int(os.getenv('FLEET_STATUS_REFRESH_INTERVAL') or 300)
+
+# Seconds between two rebuilds of the changelist search index, which admin changes keep current in between
+SEARCH_INDEX_REFRESH_INTERVAL = int(os.getenv('SEARCH_INDEX_REFRESH_INTERVAL') or 300)
+
+# Processes rendering QR codes for the sticker sheet action
+QR_PROCESSES = int(os.getenv('QR_PROCESSES') or min(4, os.cpu_count() or 1))
+
+# Request metrics (/metrics)
+
+# Bearer token for Prometheus, without a token /metrics requires a staff login
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or ''
+
+# Requests slower than this (seconds) are logged with their slowest queries
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD') or 1.0)
+
+# Admin log (server_panel.audit)
+
+# Admin log entries of requests are inserted by a writer thread of each process, after the view returned
+AUDIT_ASYNC = True
+
+# Log entries inserted by one INSERT statement
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE') or 500)
+
+# Seconds a finished request waits for its log entries to be written
+AUDIT_WRITE_TIMEOUT = float(os.getenv('AUDIT_WRITE_TIMEOUT') or 30)
+
+# Log entries per page of the avtomat changes view
+AUDIT_PAGE_SIZE = 100
@@ -2,10 +2,12 @@ from .base import *
 
 DEBUG = True
 
+REDIS_URL = f'redis://{os.getenv("REDIS_HOST_TEST")}:{os.getenv("REDIS_PORT_TEST")}'
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-        'LOCATION': f'redis://{os.getenv("REDIS_HOST_TEST")}:{os.getenv("REDIS_PORT_TEST")}',
+        'BACKEND': 'server_panel.cache_backends.InstrumentedRedisCache',
+        'LOCATION': REDIS_URL,
     }
 }
 
@@ -13,6 +15,7 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / '..' / 'database' / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
     },
     'vodomat_server': {
         'ENGINE': 'django.db.backends.mysql',
@@ -21,9 +24,16 @@ DATABASES = {
         'PASSWORD': os.getenv('DATABASE_PASSWORD_TEST'),
         'HOST': os.getenv('DATABASE_HOST_TEST'),
         'PORT': os.getenv('DATABASE_PORT_TEST'),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+replicas, DATABASE_REPLICAS = replica_databases(DATABASES['vodomat_server'],
+                                               os.getenv('DATABASE_REPLICA_HOSTS_TEST'),
+                                               os.getenv('DATABASE_REPLICA_WEIGHTS_TEST'))
+DATABASES.update(replicas)
+
 REDIS_HOST = os.getenv('REDIS_HOST_TEST')
 
 AUTH_PASSWORD_VALIDATORS = []
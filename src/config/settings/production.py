@@ -4,10 +4,12 @@ DEBUG = False
 
 CSRF_TRUSTED_ORIGINS = ['https://admin.roganska.com']
 
+REDIS_URL = f'redis://{os.getenv("REDIS_HOST")}:{os.getenv("REDIS_PORT")}'
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-        'LOCATION': f'redis://{os.getenv("REDIS_HOST")}:{os.getenv("REDIS_PORT")}',
+        'BACKEND': 'server_panel.cache_backends.InstrumentedRedisCache',
+        'LOCATION': REDIS_URL,
     }
 }
 
@@ -15,6 +17,7 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'database' / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
     },
     'vodomat_server': {
         'ENGINE': 'django.db.backends.mysql',
@@ -23,9 +26,16 @@ DATABASES = {
         'PASSWORD': os.getenv('DATABASE_PASSWORD'),
         'HOST': os.getenv('DATABASE_HOST'),
         'PORT': os.getenv('DATABASE_PORT'),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+replicas, DATABASE_REPLICAS = replica_databases(DATABASES['vodomat_server'],
+                                               os.getenv('DATABASE_REPLICA_HOSTS'),
+                                               os.getenv('DATABASE_REPLICA_WEIGHTS'))
+DATABASES.update(replicas)
+
 REDIS_HOST = os.getenv('REDIS_HOST')
 
 AUTH_PASSWORD_VALIDATORS = []
@@ -0,0 +1,43 @@
+from .base import *
+
+# Local settings of the tests and the benchmark (python manage.py benchmark --settings=config.settings.test):
+# the server tables are created in SQLite from the models, Redis uses a database of its own.
+
+DEBUG = False
+
+SECRET_KEY = SECRET_KEY or 'test'
+
+REDIS_URL = (f'redis://{os.getenv("REDIS_HOST_TEST") or "localhost"}:{os.getenv("REDIS_PORT_TEST") or 6379}'
+             f'/{os.getenv("REDIS_DB_TEST") or 15}')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'server_panel.cache_backends.InstrumentedRedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / '..' / 'database' / 'test_db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+    },
+    'vodomat_server': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / '..' / 'database' / 'test_server.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+    }
+}
+
+REDIS_HOST = os.getenv('REDIS_HOST_TEST')
+
+AUTH_PASSWORD_VALIDATORS = []
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# Fail fast against the stub server API
+SERVER_API_RETRIES = 0
+
+# The audit writer thread has its own database connection, outside the transaction of a test
+AUDIT_ASYNC = False
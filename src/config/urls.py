@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from server_panel.views import metrics_view
+
 
 urlpatterns = [
+    path('metrics', metrics_view, name='metrics'),
     path(r'', admin.site.urls),
 ]
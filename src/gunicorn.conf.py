@@ -0,0 +1,29 @@
+"""Gunicorn settings of the admin, read on start (gunicorn --config gunicorn.conf.py).
+
+Threaded workers (gthread) serve requests while other threads of the worker wait on the
+database, Redis or the server API, so slow actions and exports do not hold a whole process.
+Every thread keeps its own persistent database connections (DATABASE_CONN_MAX_AGE): the server
+database sees up to workers x threads connections per web container.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND') or '0.0.0.0:8000'
+
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('GUNICORN_THREADS') or 4)
+
+# Seconds a worker may be silent before it is restarted, long exports stream from a thread
+timeout = int(os.getenv('GUNICORN_TIMEOUT') or 60)
+graceful_timeout = 30
+
+# Behind nginx, which keeps its own client connections
+keepalive = 5
+
+# Restart workers now and then, against slow memory growth
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
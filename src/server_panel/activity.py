@@ -0,0 +1,143 @@
+"""Activity rollup of the ``statistic`` table.
+
+Counting statistic rows per avtomat on the changelist would scan the whole table, so a worker
+rolls up new rows periodically: every refresh counts only the rows above the high-water mark
+(the largest ``statistic.id`` seen so far) with one ``GROUP BY`` over a primary key range.
+The table has no timestamp, so a row is dated by the refresh that first saw it, and the rows
+present at the first refresh cannot be dated at all: they are skipped, and the changelist filter
+of inactive avtomats appears once the refreshes have watched the table for a whole window.
+Counts are kept in one Redis hash per day, the time an avtomat was last seen in a sorted set,
+and for the changelist filter the numbers of the inactive avtomats, or of the active ones when
+there are fewer of them, so the filter is one ``IN`` list of at most half the fleet.
+"""
+import json
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from django.conf import settings
+from django.db.models import Count, Max, Q
+
+from . import dbrouters
+from .models import Avtomat, Statistic
+from .redis_client import get_redis
+
+HIGH_WATER_MARK_KEY = 'server_panel:activity:high_water_mark'
+LAST_SEEN_KEY = 'server_panel:activity:last_seen'
+INACTIVE_KEY = 'server_panel:activity:inactive'
+REFRESHED_KEY = 'server_panel:activity:refreshed'
+STARTED_KEY = 'server_panel:activity:started'
+LOCK_KEY = 'server_panel:activity:lock'
+
+# Seconds one refresh may take before another process may start refreshing
+LOCK_TIMEOUT = 600
+
+DAY = 24 * 3600
+
+
+def _day_key(timestamp: float) -> str:
+    return f'server_panel:activity:day:{time.strftime("%Y-%m-%d", time.gmtime(timestamp))}'
+
+
+def _window_day_keys(now: float) -> list[str]:
+    # The current day is partial, so the window spans one more daily bucket
+    return [_day_key(now - day * DAY) for day in range(settings.ACTIVITY_WINDOW_DAYS + 1)]
+
+
+def refresh() -> Optional[int]:
+    """Roll up the statistic rows added since the last refresh, return their number.
+
+    Returns None when another process is refreshing.
+    """
+    r = get_redis()
+    if not r.set(LOCK_KEY, 1, nx=True, ex=LOCK_TIMEOUT):
+        return None
+    # The high-water mark and the rows below it are read from the same replica
+    try:
+        with dbrouters.bind(dbrouters.current()):
+            now = time.time()
+            top = Statistic.objects.aggregate(top=Max('id'))['top']
+            started = r.get(STARTED_KEY)
+            if started is None:
+                # The rows so far are undated, only rows added from now on tell when an avtomat was seen
+                with r.pipeline() as pipe:
+                    pipe.set(HIGH_WATER_MARK_KEY, top or 0)
+                    pipe.set(STARTED_KEY, now)
+                    pipe.set(REFRESHED_KEY, now)
+                    pipe.execute()
+                return 0
+
+            high_water_mark = int(r.get(HIGH_WATER_MARK_KEY) or 0)
+            top = top or high_water_mark
+            rows = Statistic.objects.filter(id__gt=high_water_mark, id__lte=top) \
+                                    .values_list('avtomat_id').annotate(rows=Count('id')).order_by()
+            added = 0
+            day_key = _day_key(now)
+            with r.pipeline() as pipe:
+                for avtomat_number, count in rows:
+                    pipe.hincrby(day_key, avtomat_number, count)
+                    pipe.zadd(LAST_SEEN_KEY, {avtomat_number: now})
+                    added += count
+                pipe.expire(day_key, (settings.ACTIVITY_WINDOW_DAYS + 2) * DAY)
+                pipe.set(HIGH_WATER_MARK_KEY, top)
+                pipe.set(REFRESHED_KEY, now)
+                pipe.execute()
+
+            window_start = now - settings.ACTIVITY_WINDOW_DAYS * DAY
+            if float(started) <= window_start:
+                r.set(INACTIVE_KEY, json.dumps(_inactive(r, window_start)))
+            return added
+    finally:
+        r.delete(LOCK_KEY)
+
+
+def _inactive(r, window_start: float) -> dict:
+    active = {int(number) for number in r.zrangebyscore(LAST_SEEN_KEY, window_start, '+inf')}
+    inactive = [number for number in Avtomat.objects.values_list('avtomat_number', flat=True).iterator()
+                if number not in active]
+    if len(inactive) <= len(active):
+        return {'inactive': inactive}
+    # Avtomats added after the refresh count as inactive until they are seen
+    return {'active': sorted(active)}
+
+
+def refresh_if_due() -> Optional[int]:
+    """Refresh when the last refresh is older than the refresh interval."""
+    refreshed = get_redis().get(REFRESHED_KEY)
+    if refreshed is not None and time.time() - float(refreshed) < settings.ACTIVITY_REFRESH_INTERVAL:
+        return None
+    return refresh()
+
+
+def is_refreshed() -> bool:
+    return bool(get_redis().exists(INACTIVE_KEY))
+
+
+def inactive_q() -> Optional[Q]:
+    """Return the filter for avtomats without activity in the window, or None before a whole window was watched."""
+    numbers = get_redis().get(INACTIVE_KEY)
+    if numbers is None:
+        return None
+    numbers = json.loads(numbers)
+    if 'active' in numbers:
+        return ~Q(avtomat_number__in=numbers['active'])
+    return Q(avtomat_number__in=numbers['inactive'])
+
+
+def get_activity(avtomat_numbers: list[int]) -> dict[int, tuple[int, Optional[datetime]]]:
+    """Return the statistic rows in the window and the last seen time of the given avtomats."""
+    if not avtomat_numbers:
+        return {}
+    day_keys = _window_day_keys(time.time())
+    with get_redis().pipeline() as pipe:
+        pipe.zmscore(LAST_SEEN_KEY, avtomat_numbers)
+        for day_key in day_keys:
+            pipe.hmget(day_key, avtomat_numbers)
+        last_seen, *days = pipe.execute()
+
+    activity = {}
+    for i, number in enumerate(avtomat_numbers):
+        count = sum(int(day[i] or 0) for day in days)
+        seen = None if last_seen[i] is None else datetime.fromtimestamp(last_seen[i], tz=timezone.utc)
+        activity[number] = (count, seen)
+    return activity
@@ -1,18 +1,74 @@
 import csv
-import io
-
-from django.contrib import admin
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.models import ADDITION, CHANGE, DELETION
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.db import router, transaction
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
+from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response
+from django.urls import path, reverse
 from django.utils.html import format_html
-from django.db.models import Q
 from .models import User, Route, City, Street, Avtomat, Setting
-from .forms import AvtomatAdminForm, UserAdminForm
-from .avtomat_actions import set_max_sum, set_price, set_price_for_app, disable_online_pay
+from .forms import AvtomatAdminForm, AvtomatChangesForm, AvtomatImportForm, UserAdminForm
+from .avtomat_actions import set_max_sum, set_price, set_price_for_app, disable_online_pay, export_csv, \
+    download_qr_stickers
+
+from .admin_filters import CitiesListFilter, InactiveAvtomatsListFilter, PriceForAppListFilter, RoutesListFilter
+from . import activity, audit, export, facets, fleet_status, geo, importer, jobs, machine_filter, paginators, qr, \
+    retries, search_index, settings_cache, street_labels
+
+
+class AuditLogMixin:
+    """Log additions, changes and deletions through the audit writer instead of an INSERT each."""
+
+    def log_addition(self, request, obj, message):
+        audit.record(audit.entries(request.user.pk, [obj], ADDITION, message))
+
+    def log_change(self, request, obj, message):
+        audit.record(audit.entries(request.user.pk, [obj], CHANGE, message))
+
+    def log_deletions(self, request, queryset):
+        audit.record(audit.entries(request.user.pk, queryset, DELETION))
+
+
+class InvalidateCacheMixin:
+    """Invalidate cached data after the transaction of an admin change is committed."""
+
+    def invalidate_cache(self, pks: list):
+        """Called with the primary keys of the saved or deleted objects; nothing to invalidate by default."""
 
-from .admin_filters import RoutesListFilter
+    def _invalidate_on_commit(self, pks: list):
+        transaction.on_commit(lambda: self.invalidate_cache(pks), using=router.db_for_write(self.model))
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self._invalidate_on_commit([obj.pk])
+
+    def delete_model(self, request, obj):
+        pk = obj.pk
+        super().delete_model(request, obj)
+        self._invalidate_on_commit([pk])
+
+    def delete_queryset(self, request, queryset):
+        pks = list(queryset.values_list('pk', flat=True))
+        super().delete_queryset(request, queryset)
+        self._invalidate_on_commit(pks)
+
+
+def _invalidate_fleet_status_if_deleted(model, pks: list):
+    # The fleet status counts avtomats by route and city ids; a deleted route or city leaves its
+    # avtomats to the database, so the counts are rebuilt rather than adjusted
+    if not model.objects.filter(pk__in=pks).exists():
+        fleet_status.invalidate()
 
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(AuditLogMixin, admin.ModelAdmin):
     list_display = ('username', 'full_name', 'email',
                     'permission', 'last_visit')
 
@@ -32,33 +88,76 @@ class UserAdmin(admin.ModelAdmin):
 
 
 @admin.register(Route)
-class RouteAdmin(admin.ModelAdmin):
+class RouteAdmin(AuditLogMixin, InvalidateCacheMixin, admin.ModelAdmin):
     list_display = ('name', 'car_number', 'driver_1', 'driver_2')
 
+    def invalidate_cache(self, pks):
+        facets.invalidate()
+        _invalidate_fleet_status_if_deleted(Route, pks)
+
 
 @admin.register(City)
-class CityAdmin(admin.ModelAdmin):
-    pass
+class CityAdmin(AuditLogMixin, InvalidateCacheMixin, admin.ModelAdmin):
+
+    def invalidate_cache(self, pks):
+        facets.invalidate()
+        street_labels.invalidate()
+        # The map shows the addresses of the avtomats
+        geo.invalidate()
+        _invalidate_fleet_status_if_deleted(City, pks)
 
 
 @admin.register(Street)
-class StreetAdmin(admin.ModelAdmin):
+class StreetAdmin(AuditLogMixin, InvalidateCacheMixin, admin.ModelAdmin):
     list_display = ('street', 'city')
     search_fields = ('street', )
 
     list_select_related = ['city', ]
 
+    def get_queryset(self, request):
+        # Street labels include the city, also for autocomplete results
+        return super().get_queryset(request).select_related('city')
+
+    def invalidate_cache(self, pks):
+        facets.invalidate()
+        street_labels.invalidate()
+        geo.invalidate()
+        search_index.update_streets(pks)
+        fleet_status.update_streets(pks)
+
+
+class AvtomatChangeList(ChangeList):
+
+    def get_results(self, request):
+        super().get_results(request)
+        # One Redis round trip for the activity of the whole page
+        page = list(self.result_list)
+        avtomat_activity = activity.get_activity([obj.avtomat_number for obj in page])
+        for obj in page:
+            obj.activity = avtomat_activity[obj.avtomat_number]
+
+
+class AvtomatExportChangeList(AvtomatChangeList):
+    """The filters, search and ordering of the changelist, without fetching or counting a page."""
+
+    def get_results(self, request):
+        pass
+
 
 @admin.register(Avtomat)
-class AvtomatAdmin(admin.ModelAdmin):
-    actions = [set_price, set_price_for_app, set_max_sum, disable_online_pay, admin.actions.delete_selected]
+class AvtomatAdmin(AuditLogMixin, InvalidateCacheMixin, admin.ModelAdmin):
+    actions = [set_price, set_price_for_app, set_max_sum, disable_online_pay, export_csv, download_qr_stickers,
+               admin.actions.delete_selected]
     form = AvtomatAdminForm
-    list_display = ('number', 'address', 'route', 'state', 'show_on_map', 'create_qr')
+    list_display = ('number', 'address', 'route', 'state', 'last_seen', 'activity_count', 'show_on_map', 'create_qr')
     search_fields = ('street__street', 'avtomat_number', 'rro_id')
     autocomplete_fields = ('street', )
-    list_filter = ('state', 'size', 'price_for_app', 'street__city__price_type', RoutesListFilter, 'street__city')
+    list_filter = ('state', 'size', PriceForAppListFilter, 'street__city__price_type', RoutesListFilter,
+                   CitiesListFilter, InactiveAvtomatsListFilter)
     save_as = True  # Create new Avtomat from existing
     list_per_page = 100
+    paginator = paginators.KeysetPaginator
+    show_full_result_count = False
 
     list_select_related = ['street', 'street__city', 'route']
 
@@ -74,6 +173,14 @@ class AvtomatAdmin(admin.ModelAdmin):
     def address(self, obj):
         return 'No Address' if obj.street is None else f'{obj.street} {obj.house}'
 
+    @admin.display(description='Last seen')
+    def last_seen(self, obj):
+        return obj.activity[1]
+
+    @admin.display(description='Statistic')
+    def activity_count(self, obj):
+        return obj.activity[0]
+
     @admin.display(description='')
     def show_on_map(self, obj):
         href = f'https://www.google.com/maps/search/?api=1&query={obj.latitude},{obj.longitude}'
@@ -82,11 +189,8 @@ class AvtomatAdmin(admin.ModelAdmin):
 
     @admin.display(description='')
     def create_qr(self, obj):
-        href = f'http://chart.apis.google.com/chart?' \
-               f'cht=qr&chs=300x300&' \
-               f'chl=https://app.roganska.com?vodomat_id={obj.avtomat_number}'
-        return format_html(f"<a target='_blank' rel='noopener noreferrer'"
-                           f"href={href}><i class='fas fa-qrcode'></i></a>")
+        href = reverse('admin:server_panel_avtomat_qr', args=[obj.avtomat_number])
+        return format_html("<a target='_blank' href='{}'><i class='fas fa-qrcode'></i></a>", href)
 
     fieldsets = (
         ('Set Avtomat Number', {
@@ -104,53 +208,286 @@ class AvtomatAdmin(admin.ModelAdmin):
         })
     )
 
+    def invalidate_cache(self, pks):
+        facets.invalidate()
+        paginators.invalidate()
+        geo.invalidate()
+        search_index.update(pks)
+        fleet_status.update(pks)
+
+    def get_changelist(self, request, **kwargs):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name == 'server_panel_avtomat_export':
+            return AvtomatExportChangeList
+        return AvtomatChangeList
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'street':
+            kwargs['queryset'] = Street.objects.select_related('city')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
     def get_fieldsets(self, request, obj=None):
         fieldsets = super().get_fieldsets(request, obj)
         if obj:
             return fieldsets[1:]
         return fieldsets
 
+    def get_urls(self):
+        urls = [
+            path('jobs/<str:job_id>/', self.admin_site.admin_view(self.job_view),
+                 name='server_panel_avtomat_job'),
+            path('jobs/<str:job_id>/status/', self.admin_site.admin_view(self.job_status_view),
+                 name='server_panel_avtomat_job_status'),
+            path('retries/', self.admin_site.admin_view(self.retries_view),
+                 name='server_panel_avtomat_retries'),
+            path('status/', self.admin_site.admin_view(self.status_view),
+                 name='server_panel_avtomat_status'),
+            path('changes/', self.admin_site.admin_view(self.changes_view),
+                 name='server_panel_avtomat_changes'),
+            path('export/', self.admin_site.admin_view(self.export_view),
+                 name='server_panel_avtomat_export'),
+            path('<int:avtomat_number>/qr/', self.admin_site.admin_view(self.qr_view, cacheable=True),
+                 name='server_panel_avtomat_qr'),
+            path('map/', self.admin_site.admin_view(self.map_view),
+                 name='server_panel_avtomat_map'),
+            path('map/data/', self.admin_site.admin_view(self.map_data_view),
+                 name='server_panel_avtomat_map_data'),
+            path('import/', self.admin_site.admin_view(self.import_view),
+                 name='server_panel_avtomat_import'),
+            path('import/<str:plan_id>/apply/', self.admin_site.admin_view(self.import_apply_view),
+                 name='server_panel_avtomat_import_apply'),
+            path('import/<str:plan_id>/errors/', self.admin_site.admin_view(self.import_errors_view),
+                 name='server_panel_avtomat_import_errors'),
+        ]
+        return urls + super().get_urls()
+
+    def job_view(self, request, job_id):
+        job = jobs.get_job(job_id)
+        if job is None or not self.has_view_permission(request):
+            raise Http404('Job not found')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': f'Job progress: {job["action"]}',
+            'job': job,
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/job.html', context)
+
+    def job_status_view(self, request, job_id):
+        status = jobs.get_status(job_id, avtomats='avtomats' in request.GET)
+        if status is None or not self.has_view_permission(request):
+            raise Http404('Job not found')
+        return JsonResponse(status)
+
+    def retries_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Busy avtomat retries',
+            'retries': retries.list_retries(),
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/retries.html', context)
+
+    def status_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        filters = {dimension: request.GET[dimension] for dimension in fleet_status.DIMENSIONS
+                   if request.GET.get(dimension)}
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Fleet status',
+            'status': fleet_status.summary(filters),
+            'filter_query': request.GET.urlencode(),
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/status.html', context)
+
+    def changes_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        form = AvtomatChangesForm(request.GET)
+        entries, before = audit.avtomat_changes(**form.cleaned_data, page_size=settings.AUDIT_PAGE_SIZE) \
+            if form.is_valid() else ([], None)
+        older = None
+        if before is not None:
+            query = request.GET.copy()
+            query['before'] = before
+            older = query.urlencode()
+        newest = request.GET.copy()
+        newest.pop('before', None)
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Avtomat changes',
+            'form': form,
+            'entries': entries,
+            'older_query': older,
+            'newest_query': newest.urlencode() if 'before' in request.GET else None,
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/changes.html', context)
+
+    def history_view(self, request, object_id, extra_context=None):
+        # The changes view reads the log of one avtomat through an index, page by page
+        return HttpResponseRedirect(
+            reverse('admin:server_panel_avtomat_changes') + '?' + urlencode({'avtomat_number': object_id})
+        )
+
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        # Same filters, search and ordering as the changelist with this query string
+        try:
+            cl = self.get_changelist_instance(request)
+        except IncorrectLookupParameters:
+            return HttpResponseRedirect(reverse('admin:server_panel_avtomat_changelist') + '?e=1')
+        return export.csv_response(cl.queryset)
+
+    def qr_view(self, request, avtomat_number):
+        if not self.has_view_permission(request):
+            raise Http404
+        response = HttpResponse(qr.get_png(avtomat_number), content_type='image/png')
+        # The image of a number never changes
+        response['Cache-Control'] = f'private, max-age={qr.TIMEOUT}'
+        return response
+
+    def map_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Avtomat map',
+            'states': Avtomat.STATE,
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/map.html', context)
+
+    def map_data_view(self, request):
+        if not self.has_view_permission(request):
+            raise Http404
+        snapshot = geo.get_snapshot()
+        bbox = geo.parse_bbox(request.GET.get('bbox'))
+        etag = geo.etag(snapshot, bbox)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            payload = snapshot['payload'] if bbox is None else geo.to_geojson(geo.features_in(snapshot, bbox))
+            response = HttpResponse(payload, content_type='application/geo+json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _check_import_permission(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+
+    def import_view(self, request):
+        self._check_import_permission(request)
+        plan = None
+        if request.method == 'POST':
+            form = AvtomatImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                plan = importer.prepare(form.cleaned_data['csv_file'], request.user.id)
+        else:
+            form = AvtomatImportForm()
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Import avtomats' if plan is None else 'Import avtomats: dry run',
+            'form': form,
+            'plan': plan,
+        }
+        return TemplateResponse(request, 'admin/server_panel/avtomat/import.html', context)
+
+    def import_errors_view(self, request, plan_id):
+        self._check_import_permission(request)
+        errors = importer.get_errors(plan_id, request.user.id)
+        if errors is None:
+            raise Http404('Import not found')
+        response = HttpResponse(content_type='text/csv; charset=utf-8',
+                                headers={'Content-Disposition': 'attachment; filename="import_errors.csv"'})
+        writer = csv.writer(response)
+        writer.writerow(['Line', 'Number', 'Errors'])
+        for error in errors:
+            writer.writerow([error['line'], error['number'], '; '.join(error['errors'])])
+        return response
+
+    def import_apply_view(self, request, plan_id):
+        self._check_import_permission(request)
+        if request.method != 'POST':
+            return HttpResponseRedirect(reverse('admin:server_panel_avtomat_import'))
+        result = importer.apply(plan_id, request.user.id)
+        if result is None:
+            messages.error(request, 'The import expired or was applied already, upload the file again.')
+            return HttpResponseRedirect(reverse('admin:server_panel_avtomat_import'))
+        created, updated, deleted = result
+        messages.info(request, f'Imported avtomats: {created} created, {updated} updated.')
+        if deleted:
+            messages.warning(request, f'{len(deleted)} avtomat(s) deleted since the dry run were skipped: '
+                                      f'{", ".join(map(str, deleted[:20]))}{", ..." if len(deleted) > 20 else ""}')
+        return HttpResponseRedirect(reverse('admin:server_panel_avtomat_changelist'))
+
     def changelist_view(self, request, extra_context=None):
         if request.method == 'POST' and 'csv_file' in request.FILES:
-            csv_file = request.FILES['csv_file']
-
-            # Read CSV and extract machine identifiers
-            decoded_file = csv_file.read().decode('utf-8')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.reader(io_string)
-
-            # Skip header if present
-            # next(reader, None)
-
-            # Extract identifiers (adjust based on your CSV format)
-            machine_ids = [row[0] for row in reader if row]
-
-            # Store in session for filtering
-            request.session['machine_filter_ids'] = machine_ids
+            # Stream the CSV and keep the unique avtomat numbers in Redis, not in the session
+            try:
+                numbers, invalid = machine_filter.parse_csv(request.FILES['csv_file'])
+            except UnicodeDecodeError:
+                messages.error(request, 'The CSV file is not UTF-8 encoded, '
+                                        'save it as "CSV UTF-8" and upload it again.')
+            else:
+                self._store_machine_filter(request, numbers, invalid)
 
         # Clear filter if requested
         if request.GET.get('clear_csv_filter'):
-            request.session.pop('machine_filter_ids', None)
+            if request.session.pop('machine_filter_count', None) is not None:
+                machine_filter.clear(request.session.session_key)
+            return HttpResponseRedirect(request.path)
 
         return super().changelist_view(request, extra_context)
 
+    @staticmethod
+    def _store_machine_filter(request, numbers: set[int], invalid: int):
+        if not numbers:
+            messages.warning(request, 'No avtomat numbers found in the CSV file.')
+        elif len(numbers) > machine_filter.MAX_NUMBERS:
+            messages.error(request, f'The CSV file has {len(numbers)} avtomat numbers, '
+                                    f'at most {machine_filter.MAX_NUMBERS} can be filtered by.')
+        else:
+            if request.session.session_key is None:
+                request.session.save()
+            machine_filter.store(request.session.session_key, numbers)
+            request.session['machine_filter_count'] = len(numbers)
+        if invalid:
+            messages.warning(request, f'{invalid} row(s) without a valid avtomat number were skipped.')
+
     def get_queryset(self, request):
         qs = super().get_queryset(request)
 
         # Apply CSV filter if exists
-        machine_ids = request.session.get('machine_filter_ids')
-        if machine_ids:
-            # Filter by ID, name, or serial number - adjust as needed
-            qs = qs.filter(
-                Q(avtomat_number__in=machine_ids)
-            )
+        if request.session.get('machine_filter_count') is not None:
+            machine_filter_q = machine_filter.get_q(request.session.session_key)
+            if machine_filter_q is None:
+                request.session.pop('machine_filter_count')
+            else:
+                qs = qs.filter(machine_filter_q)
 
         return qs
 
+    def get_search_results(self, request, queryset, search_term):
+        # Prefix matches from the index instead of a LIKE scan of the changelist join; the admin
+        # search only when the index cannot answer or finds nothing, e.g. for a part of a word
+        numbers = search_index.search(search_term)
+        if not numbers:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(avtomat_number__in=numbers), False
+
 
 @admin.register(Setting)
-class SettingAdmin(admin.ModelAdmin):
-    pass
+class SettingAdmin(AuditLogMixin, InvalidateCacheMixin, admin.ModelAdmin):
+
+    def invalidate_cache(self, pks):
+        settings_cache.invalidate()
 
 
 admin.site.site_header = 'Vodomat Admin'
@@ -1,9 +1,10 @@
 from typing import Any
+from django.conf import settings
 from django.contrib import admin
 from django.db.models.query import QuerySet
 from django.utils.translation import gettext_lazy as _
 
-from .models import Route
+from . import activity, facets
 
 
 class InactiveAvtomatsListFilter(admin.SimpleListFilter):
@@ -11,22 +12,27 @@ class InactiveAvtomatsListFilter(admin.SimpleListFilter):
     parameter_name = 'activity_status'
 
     def lookups(self, request, model_admin):
+        # Hidden until the activity rollup has watched the statistic table for a whole window
+        if not activity.is_refreshed():
+            return []
         return [
-            ('inactive', _('Inactive'))
+            ('inactive', _('No activity in %(days)s days') % {'days': settings.ACTIVITY_WINDOW_DAYS})
         ]
 
     def queryset(self, request, queryset):
         if self.value() == 'inactive':
-            return queryset.filter(statistic_count=0)
+            inactive_q = activity.inactive_q()
+            if inactive_q is not None:
+                return queryset.filter(inactive_q)
         return queryset
-    
+
 
 class RoutesListFilter(admin.SimpleListFilter):
     title = _('route number')
     parameter_name = 'route_number'
 
     def lookups(self, request: Any, model_admin: Any) -> list[tuple[Any, str]]:
-        existing_lookups = [(obj.pk, obj.name) for obj in Route.objects.all()]
+        existing_lookups = facets.route_choices()
         extended_lookups = [('no_route', _('No route')), ] + existing_lookups
         return extended_lookups
     
@@ -36,3 +42,31 @@ class RoutesListFilter(admin.SimpleListFilter):
         elif self.value():
             return queryset.filter(route_id=self.value())
         return queryset
+
+
+class CitiesListFilter(admin.SimpleListFilter):
+    title = _('city')
+    parameter_name = 'city'
+
+    def lookups(self, request: Any, model_admin: Any) -> list[tuple[Any, str]]:
+        return facets.city_choices()
+
+    def queryset(self, request: Any, queryset: QuerySet[Any]) -> QuerySet[Any] | None:
+        if self.value():
+            return queryset.filter(street__city_id=self.value())
+        return queryset
+
+
+class PriceForAppListFilter(admin.SimpleListFilter):
+    title = _('price for app')
+    parameter_name = 'price_for_app'
+
+    def lookups(self, request: Any, model_admin: Any) -> list[tuple[Any, str]]:
+        return [(price, str(price)) for price in facets.price_for_app_choices()] + [('empty', _('Empty'))]
+
+    def queryset(self, request: Any, queryset: QuerySet[Any]) -> QuerySet[Any] | None:
+        if self.value() == 'empty':
+            return queryset.filter(price_for_app__isnull=True)
+        elif self.value():
+            return queryset.filter(price_for_app=self.value())
+        return queryset
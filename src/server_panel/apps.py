@@ -1,7 +1,14 @@
 from django.apps import AppConfig
+from django.contrib.admin import apps as admin_apps
 
 
 class AdminPanelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'server_panel'
     verbose_name = 'Server'
+
+
+class ServerAdminConfig(admin_apps.AdminConfig):
+    """Django admin using ServerAdminSite as the default site."""
+    default = False
+    default_site = 'server_panel.sites.ServerAdminSite'
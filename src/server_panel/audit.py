@@ -0,0 +1,205 @@
+"""Admin log entries written in batches by a writer thread.
+
+Admin changes are logged as ``LogEntry`` rows in the SQLite database. ``record`` adds them to the
+buffer of the current request instead of inserting them in the view; ``AuditMiddleware`` hands
+the buffer to the writer thread of the process when the view returned, and the writer inserts
+everything the threads of the process handed over since its last write with one bulk insert, so
+concurrent requests do not each wait for the SQLite write lock. The entries of a request are
+written at the latest when the request finishes: the ``request_finished`` handler waits for them
+after the response was sent. An entry is recorded when the transaction of its change commits on
+the database of the logged object, so the changes rolled back with a failed view are not logged,
+and the committed ones are, also when the view raised after the commit. Outside a request, e.g.
+in the job worker, entries are written immediately, as they are in the request thread with
+``AUDIT_ASYNC`` off.
+
+``avtomat_changes`` reads the log of the whole fleet newest first with keyset pagination on
+(action time, id), served by the indexes of migration 0002, so a page costs the same on a log of
+millions of rows as on a new one.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import request_finished
+from django.db import close_old_connections, router, transaction
+from django.utils import timezone
+
+from .models import Avtomat
+
+logger = logging.getLogger(__name__)
+
+_buffer: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar('audit_buffer', default=None)
+
+# The entries the current thread handed to the writer and has to wait for
+_pending = threading.local()
+
+_writer: Optional['Writer'] = None
+_writer_lock = threading.Lock()
+
+
+def entries(user_id: int, objs: Iterable, action_flag: int, message='') -> list[LogEntry]:
+    """Return the log entries of the same change of many objects, as ``LogEntry.objects.log_actions``."""
+    if isinstance(message, list):
+        message = json.dumps(message)
+    return [
+        LogEntry(
+            user_id=user_id,
+            content_type_id=ContentType.objects.get_for_model(obj, for_concrete_model=False).id,
+            object_id=str(obj.pk),
+            object_repr=str(obj)[:200],
+            action_flag=action_flag,
+            change_message=message,
+        )
+        for obj in objs
+    ]
+
+
+def record(log_entries: list[LogEntry]):
+    """Log entries with the current request, or immediately outside a request, once the
+    transaction of the change is committed (right away outside a transaction).
+    """
+    if not log_entries:
+        return
+    model = ContentType.objects.get_for_id(log_entries[0].content_type_id).model_class()
+    transaction.on_commit(lambda: _record(log_entries), using=router.db_for_write(model))
+
+
+def _record(log_entries: list[LogEntry]):
+    buffer = _buffer.get()
+    if buffer is None:
+        write(log_entries)
+    else:
+        buffer.extend(log_entries)
+
+
+def write(log_entries: list[LogEntry]):
+    LogEntry.objects.bulk_create(log_entries, batch_size=settings.AUDIT_BATCH_SIZE)
+
+
+def start_request() -> contextvars.Token:
+    return _buffer.set([])
+
+
+def end_request(token: contextvars.Token) -> list[LogEntry]:
+    """Return the entries recorded during the request."""
+    log_entries = _buffer.get()
+    _buffer.reset(token)
+    return log_entries
+
+
+def submit(log_entries: list[LogEntry]):
+    """Hand the entries of a request to the writer, ``wait`` returns when they are written."""
+    if not log_entries:
+        return
+    if not settings.AUDIT_ASYNC:
+        write(log_entries)
+        return
+    _pending.written = get_writer().put(log_entries)
+
+
+def wait(**kwargs):
+    """Wait until the entries the current thread submitted are written, on ``request_finished``."""
+    written = getattr(_pending, 'written', None)
+    if written is None:
+        return
+    _pending.written = None
+    if not written.wait(settings.AUDIT_WRITE_TIMEOUT):
+        logger.error('Admin log entries not written after %ss', settings.AUDIT_WRITE_TIMEOUT)
+
+
+request_finished.connect(wait, dispatch_uid='server_panel.audit.wait')
+
+
+def get_writer() -> 'Writer':
+    """Return the writer thread of this process, started on first use (also after a fork)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid() or not _writer.is_alive():
+            _writer = Writer()
+            _writer.start()
+        return _writer
+
+
+class Writer(threading.Thread):
+    """Insert the submitted entries, everything queued while the previous insert ran at once."""
+
+    def __init__(self):
+        super().__init__(name='audit-writer', daemon=True)
+        self.pid = os.getpid()
+        self.queue = queue.SimpleQueue()
+
+    def put(self, log_entries: list[LogEntry]) -> threading.Event:
+        written = threading.Event()
+        self.queue.put((log_entries, written))
+        return written
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    @staticmethod
+    def write(batch: list[tuple[list[LogEntry], threading.Event]]):
+        log_entries = [entry for submitted, _ in batch for entry in submitted]
+        try:
+            close_old_connections()
+            write(log_entries)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception('Could not write %d admin log entries', len(log_entries))
+            else:
+                # One by one, so the entries of one request cannot lose those of the others
+                logger.warning('Could not write %d admin log entries at once', len(log_entries), exc_info=True)
+                for submitted, _ in batch:
+                    try:
+                        write(submitted)
+                    except Exception:
+                        logger.exception('Could not write %d admin log entries', len(submitted))
+        finally:
+            for _, written in batch:
+                written.set()
+
+
+def avtomat_changes(avtomat_number: Optional[int] = None, action_flag: Optional[int] = None,
+                    date_from: Optional[date] = None, date_to: Optional[date] = None,
+                    before: Optional[int] = None, page_size: int = 100) -> tuple[list[LogEntry], Optional[int]]:
+    """Return a page of the avtomat log entries, newest first, and the id to pass as ``before``
+    for the next page (None on the last page). ``before`` is the id of the last entry of the
+    previous page, the dates are days of the current time zone, both included.
+    """
+    queryset = LogEntry.objects.filter(content_type=ContentType.objects.get_for_model(Avtomat))
+    if avtomat_number is not None:
+        queryset = queryset.filter(object_id=str(avtomat_number))
+    if action_flag is not None:
+        queryset = queryset.filter(action_flag=action_flag)
+    if date_from is not None:
+        queryset = queryset.filter(action_time__gte=_start_of_day(date_from))
+    if date_to is not None:
+        queryset = queryset.filter(action_time__lt=_start_of_day(date_to + timedelta(days=1)))
+    if before is not None:
+        before_time = LogEntry.objects.filter(pk=before).values_list('action_time', flat=True).first()
+        if before_time is not None:
+            # (action_time, id) < (before_time, before), as a range the indexes can seek to
+            queryset = queryset.filter(action_time__lte=before_time).exclude(action_time=before_time, pk__gte=before)
+
+    page = list(queryset.select_related('user').order_by('-action_time', '-pk')[:page_size + 1])
+    if len(page) > page_size:
+        return page[:page_size], page[page_size - 1].pk
+    return page, None
+
+
+def _start_of_day(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time.min))
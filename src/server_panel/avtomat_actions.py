@@ -1,95 +1,148 @@
-import os
-import requests
-from typing import Optional
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+from django.conf import settings
 from django.contrib import admin, messages
-from django.core.cache import cache
-from django.contrib.admin.models import LogEntry, CHANGE
-from django.contrib.contenttypes.models import ContentType
-from django.utils.encoding import force_str
-from .models import Setting
+from django.contrib.admin.models import CHANGE
+from django.db import router, transaction
+from django.http import HttpResponse, HttpResponseRedirect
+from django.urls import reverse
+from . import audit, export, facets, fleet_status, geo, jobs, paginators, qr, retries, settings_cache
+from .models import Avtomat
+from .server_api import ServerAPIError, get_client
+
+# Avtomats updated by one UPDATE statement in bulk actions
+UPDATE_CHUNK_SIZE = 1000
 
 # Utility Functions
 
-def get_api_key() -> Optional[str]:
-    """Retrieve the API key from cache or request a new one."""
-    api_key = cache.get('api_key')
+@dataclass
+class DispatchResult:
+    """Per-avtomat outcome of pushing a parameter to many avtomats."""
+    succeeded: list[int] = field(default_factory=list)
+    busy: list[int] = field(default_factory=list)
+    failed: list[int] = field(default_factory=list)
+
+
+def dispatch_param(avtomat_numbers: Iterable[int], param: str,
+                   max_workers: Optional[int] = None) -> DispatchResult:
+    """Send a parameter setting request to many avtomats in parallel."""
+    avtomat_numbers = list(avtomat_numbers)
+    result = DispatchResult()
+    if not avtomat_numbers:
+        return result
+
+    client = get_client()
+    try:
+        # Warm the key once so the worker threads do not all request it at the same time
+        api_key = client.get_api_key()
+    except ServerAPIError:
+        api_key = None
     if api_key is None:
-        credentials = {
-            'username': os.getenv('SERVER_API_USER'),
-            'password': os.getenv('SERVER_API_PASSWORD')
-        }
-        response = requests.post(f'{os.getenv("SERVER_API_URL")}/api_key', data=credentials)
-        if response.status_code == 200:
-            api_key = response.json().get('api_key')
-            cache.set('api_key', api_key, timeout=3600)
-    return api_key
-
-
-def set_param_for_avtomat(avtomat_number: int, param: str) -> Optional[int]:
-    """Send a parameter setting request for a given avtomat."""
-    request_body = {'avtomat_number': avtomat_number, 'param': param}
-    headers = {os.getenv('SERVER_API_SECURE_HEADERS'): get_api_key()}
-    response = requests.post(f'{os.getenv("SERVER_API_URL")}/param', json=request_body, headers=headers)
-    if response.status_code == 200:
-        return response.json().get('avtomat_number')
-    return None
-
-
-def log_change(request, obj, message: str):
-    """Log an admin action for a given object."""
-    LogEntry.objects.log_action(
-        user_id=request.user.id,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=force_str(obj),
-        action_flag=CHANGE,
-        change_message=message,
-    )
+        result.failed.extend(sorted(avtomat_numbers))
+        return result
+
+    max_workers = min(max_workers or settings.SERVER_API_MAX_WORKERS, len(avtomat_numbers))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each call runs in a copy of the caller's context, so request metrics include it
+        futures = {executor.submit(contextvars.copy_context().run, client.set_param, number, param): number
+                   for number in avtomat_numbers}
+        for future in as_completed(futures):
+            number = futures[future]
+            try:
+                busy_avtomat_number = future.result()
+            except ServerAPIError:
+                result.failed.append(number)
+                continue
+            if busy_avtomat_number:
+                result.busy.append(number)
+            else:
+                result.succeeded.append(number)
+
+    result.succeeded.sort()
+    result.busy.sort()
+    result.failed.sort()
+    return result
+
+
+def log_changes(user_id: int, objs: Iterable, message: str, action_flag: int = CHANGE):
+    """Log the same admin action for many objects, written in one batch with the rest of the request."""
+    audit.record(audit.entries(user_id, objs, action_flag, message))
+
+
+def update_avtomats(avtomat_numbers: list[int], log_entries: Optional[list] = None, **values):
+    """Set the same field values on many avtomats, one UPDATE per chunk in a single transaction.
+    ``log_entries`` are recorded with the transaction, so they are logged once it commits, also
+    when the cache work after it fails.
+    """
+    with transaction.atomic(using=router.db_for_write(Avtomat)):
+        for start in range(0, len(avtomat_numbers), UPDATE_CHUNK_SIZE):
+            chunk = avtomat_numbers[start:start + UPDATE_CHUNK_SIZE]
+            Avtomat.objects.filter(avtomat_number__in=chunk).update(**values)
+        if log_entries:
+            audit.record(log_entries)
+    facets.invalidate()
+    paginators.invalidate()
+    if geo.FIELDS.intersection(values):
+        geo.invalidate()
+    if fleet_status.FIELDS.intersection(values):
+        fleet_status.update(avtomat_numbers)
 
 
 def get_setting_value(setting_name: str) -> Optional[int]:
     """Fetch a setting value by name, handling missing cases."""
-    try:
-        return int(Setting.objects.get(name=setting_name).value)
-    except Setting.DoesNotExist:
-        return None
+    value = settings_cache.get_settings().get(setting_name)
+    return None if value is None else int(value)
+
+
+def max_sum_parameter(max_sum_value: int) -> str:
+    """Build the avtomat parameter that sets the maximum sum."""
+    command = '055be4'
+    max_sum_hex = f"{max_sum_value:04x}"
+    return f'{command}00{max_sum_hex[2:]}{max_sum_hex[:2]}'
+
+
+@jobs.register('set_max_sum')
+def apply_max_sum(job: dict, avtomat_numbers: list[int]) -> DispatchResult:
+    """Push the maximum sum to a batch of avtomats and apply the state-4/limit transitions."""
+    max_sum_value = job['params']['max_sum_value']
+
+    # Only the fields needed for the transitions and the log entries
+    avtomats = {item.avtomat_number: item
+                for item in Avtomat.objects.filter(avtomat_number__in=avtomat_numbers)
+                                           .only('avtomat_number', 'house', 'state')}
+    result = dispatch_param(avtomats, max_sum_parameter(max_sum_value))
+    result.failed.extend(number for number in avtomat_numbers if number not in avtomats)
+    succeeded = [avtomats[number] for number in result.succeeded]
+    # The avtomats have the new maximum sum whatever happens to the updates below
+    log_changes(job['user_id'], succeeded, f'Changed Max Sum to {max_sum_value}')
+
+    if max_sum_value == 0:
+        update_avtomats([item.avtomat_number for item in succeeded],
+                        state=4, price_for_app=None, visible_in_app=False)
+    else:
+        limited = [item.avtomat_number for item in succeeded if item.state == 4]
+        if limited:
+            update_avtomats(limited, state=1, price_for_app=get_setting_value('avtomat_price_for_app'),
+                            visible_in_app=True)
+    retries.record_results('set_max_sum', job, result)
+    return result
 
 # Admin Actions
 
 @admin.action(description='Set Max Sum')
 def set_max_sum(modeladmin, request, queryset):
-    command = '055be4'
     max_sum_value = get_setting_value('avtomat_max_sum')
 
     if max_sum_value is None:
         messages.warning(request, 'You have to set "avtomat_max_sum" in the settings table.')
         return
 
-    max_sum_hex = f"{max_sum_value:04x}"
-    parameter = f'{command}00{max_sum_hex[2:]}{max_sum_hex[:2]}'
-    busy_avtomats = []
-
-    for item in queryset:
-        busy_avtomat_number = set_param_for_avtomat(item.avtomat_number, parameter)
-        if busy_avtomat_number:
-            busy_avtomats.append(busy_avtomat_number)
-        else:
-            if max_sum_value == 0:
-                item.state = 4
-                item.price_for_app = None
-                item.visible_in_app = False
-            elif max_sum_value > 0 and item.state == 4:
-                item.state = 1
-                item.price_for_app = get_setting_value("avtomat_price_for_app")
-                item.visible_in_app = True
-            item.save()
-            log_change(request, item, f'Changed Max Sum to {max_sum_value}')
-
-    if busy_avtomats:
-        busy_list = ', '.join(str(avtomat) for avtomat in busy_avtomats)
-        messages.warning(request, f"Avtomat(s) busy: {busy_list}")
-    else:
-        messages.info(request, 'The maximum sum for selected avtomats was set.')
+    job_id = jobs.enqueue('set_max_sum', request.user.id, queryset.values_list('avtomat_number', flat=True),
+                          max_sum_value=max_sum_value)
+    messages.info(request, f'Setting the maximum sum to {max_sum_value} for selected avtomats.')
+    return HttpResponseRedirect(reverse('admin:server_panel_avtomat_job', args=(job_id, )))
 
 
 @admin.action(description='Set Price')
@@ -100,10 +153,10 @@ def set_price(modeladmin, request, queryset):
         messages.warning(request, 'You have to set "avtomat_price" in the settings table.')
         return
 
-    for item in queryset:
-        item.price = price
-        item.save()
-        log_change(request, item, f'Changed Price to {price / 100:.2f}')
+    avtomats = list(queryset.select_related(None).only('avtomat_number', 'house'))
+    update_avtomats([item.avtomat_number for item in avtomats],
+                    audit.entries(request.user.id, avtomats, CHANGE, f'Changed Price to {price / 100:.2f}'),
+                    price=price)
 
     messages.info(request, f"Avtomat's Price changed to {price / 100:.2f}")
 
@@ -116,19 +169,32 @@ def set_price_for_app(modeladmin, request, queryset):
         messages.warning(request, 'You have to set "avtomat_price_for_app" in the settings table.')
         return
 
-    for item in queryset:
-        item.price_for_app = price_for_app
-        item.save()
-        log_change(request, item, f'Changed Price for App to {price_for_app / 100:.2f}')
+    avtomats = list(queryset.select_related(None).only('avtomat_number', 'house'))
+    update_avtomats([item.avtomat_number for item in avtomats],
+                    audit.entries(request.user.id, avtomats, CHANGE,
+                                  f'Changed Price for App to {price_for_app / 100:.2f}'),
+                    price_for_app=price_for_app)
 
     messages.info(request, f"Avtomat's Price for App changed to {price_for_app / 100:.2f}")
 
 
 @admin.action(description='Disable Online Pay')
 def disable_online_pay(modeladmin, request, queryset):
-    for item in queryset:
-        item.price_for_app = None
-        item.save()
-        log_change(request, item, 'Changed Price for App (set to None)')
+    avtomats = list(queryset.select_related(None).only('avtomat_number', 'house'))
+    update_avtomats([item.avtomat_number for item in avtomats],
+                    audit.entries(request.user.id, avtomats, CHANGE, 'Changed Price for App (set to None)'),
+                    price_for_app=None)
 
     messages.info(request, "Online Payments have been disabled for the selected avtomats.")
+
+
+@admin.action(description='Export CSV')
+def export_csv(modeladmin, request, queryset):
+    return export.csv_response(queryset)
+
+
+@admin.action(description='Download QR stickers')
+def download_qr_stickers(modeladmin, request, queryset):
+    avtomat_numbers = list(queryset.order_by('avtomat_number').values_list('avtomat_number', flat=True))
+    return HttpResponse(qr.stickers_zip(avtomat_numbers), content_type='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename="qr_stickers.zip"'})
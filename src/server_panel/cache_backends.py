@@ -0,0 +1,23 @@
+from django.core.cache.backends.redis import RedisCache
+
+from . import metrics
+
+_MISSING = object()
+
+
+class InstrumentedRedisCache(RedisCache):
+    """Redis cache that counts the hits and misses of the current request for the metrics."""
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        if value is _MISSING:
+            metrics.record_cache(0, 1)
+            return default
+        metrics.record_cache(1, 0)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super().get_many(keys, version)
+        metrics.record_cache(len(values), len(keys) - len(values))
+        return values
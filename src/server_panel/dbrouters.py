@@ -1,15 +1,121 @@
+"""Database routing of the server tables.
+
+Writes go to the primary ``vodomat_server`` database. Reads go to the read replicas of
+``DATABASE_REPLICAS`` when there are any, spread by smooth weighted round-robin, so browsing the
+admin does not compete with the vodomat server for the primary; a request reads from one replica.
+Reads stay on the primary inside its transactions, after a write in the same request, and for the
+next requests of a browser that wrote in the last ``REPLICA_STICKY_SECONDS`` (see
+``PrimaryStickinessMiddleware``), so operators never see stale data after saving. Outside a
+request, ``use_primary`` reads from the primary and ``bind`` from one replica, for work whose
+queries depend on each other; other reads take the next replica each.
+"""
+import contextvars
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PRIMARY = 'vodomat_server'
+
+
+@dataclass
+class RequestState:
+    """Where the reads of a request go, shared with the threads it starts."""
+    pinned: bool = False
+    wrote: bool = False
+    replica: Optional[str] = None
+
+
+_state: contextvars.ContextVar[Optional[RequestState]] = contextvars.ContextVar('db_routing', default=None)
+
+
+def start_request(pinned: bool = False) -> contextvars.Token:
+    return _state.set(RequestState(pinned=pinned))
+
+
+def end_request(token: contextvars.Token):
+    _state.reset(token)
+
+
+def current() -> Optional[RequestState]:
+    return _state.get()
+
+
+@contextmanager
+def bind(state: Optional[RequestState] = None):
+    """Route the reads of the block by a state, e.g. the one of the request that returned a streaming
+    response, or by a new one reading from a single replica.
+    """
+    token = _state.set(state if state is not None else RequestState())
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary, e.g. in job workers that read what they are about to change."""
+    token = start_request(pinned=True)
+    try:
+        yield
+    finally:
+        end_request(token)
+
+
+class WeightedRoundRobin:
+    """Smooth weighted round-robin: each alias is picked in proportion to its weight, evenly interleaved."""
+
+    def __init__(self, weights: dict[str, int]):
+        self.weights = {alias: weight for alias, weight in weights.items() if weight > 0}
+        self.total = sum(self.weights.values())
+        self.current = dict.fromkeys(self.weights, 0)
+        self.lock = threading.Lock()
+
+    def next(self) -> str:
+        with self.lock:
+            for alias, weight in self.weights.items():
+                self.current[alias] += weight
+            alias = max(self.current, key=self.current.get)
+            self.current[alias] -= self.total
+            return alias
+
+
 class ServerRouter:
 
     route_app_labels = ['server_panel']
 
+    # Apps migrated only on the database of the panel: the server tables are not managed, and the
+    # admin log and its indexes (migration 0002) do not belong in the server database
+    default_app_labels = ['server_panel', 'admin']
+
+    def __init__(self):
+        self.replicas = WeightedRoundRobin(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None
+
     def db_for_read(self, model, **hints):
-        if model._meta.app_label in self.route_app_labels:
-            return 'vodomat_server'
-        return None
+        if model._meta.app_label not in self.route_app_labels:
+            return None
+        if self.replicas is None or self.replicas.total == 0 or connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        state = current()
+        if state is None:
+            return self.replicas.next()
+        if state.pinned or state.wrote:
+            return PRIMARY
+        # One replica per request, replicas may lag behind by different amounts
+        if state.replica is None:
+            state.replica = self.replicas.next()
+        return state.replica
 
     def db_for_write(self, model, **hints):
         if model._meta.app_label in self.route_app_labels:
-            return 'vodomat_server'
+            state = current()
+            if state is not None:
+                state.wrote = True
+            return PRIMARY
         return None
 
     def allow_relation(self, obj1, obj2, **hints):
@@ -19,3 +125,10 @@ class ServerRouter:
         ):
             return True
         return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        if app_label in self.default_app_labels:
+            return db == DEFAULT_DB_ALIAS
+        return None
@@ -0,0 +1,80 @@
+"""Streaming CSV export of avtomats.
+
+Rows are read with ``values_list`` in batches of consecutive avtomat numbers and written one by
+one into the response through a pseudo-buffer. PyMySQL buffers a whole result set on the client
+even for ``.iterator()``, so the batches (``avtomat_number > last exported number``) are what
+keeps memory use flat for the whole fleet; the first rows are sent after the first batch.
+"""
+import csv
+from datetime import datetime
+
+from django.http import StreamingHttpResponse
+
+from . import dbrouters
+from .models import Avtomat
+
+# (header, lookup) of the exported columns
+COLUMNS = (
+    ('Number', 'avtomat_number'),
+    ('Street', 'street__street'),
+    ('House', 'house'),
+    ('City', 'street__city__city'),
+    ('Route', 'route__name'),
+    ('State', 'state'),
+    ('Size', 'size'),
+    ('Price', 'price'),
+    ('Price for app', 'price_for_app'),
+    ('Max sum', 'max_sum'),
+    ('Latitude', 'latitude'),
+    ('Longitude', 'longitude'),
+    ('RRO ID', 'rro_id'),
+    ('Security ID', 'security_id'),
+    ('Security state', 'security_state'),
+    ('Visible in app', 'visible_in_app'),
+)
+
+# Rows fetched from the database per query
+CHUNK_SIZE = 2000
+
+# Columns exported with the label of their choice instead of the stored value
+_CHOICES = {
+    'state': dict(Avtomat.STATE),
+    'size': dict(Avtomat.SIZE),
+    'security_state': dict(Avtomat.SECURITY_STATE),
+}
+
+
+class Echo:
+    """File-like object that returns what is written instead of buffering it."""
+
+    def write(self, value):
+        return value
+
+
+def _rows(queryset, state):
+    lookups = [lookup for _, lookup in COLUMNS]
+    choices = [_CHOICES.get(lookup) for lookup in lookups]
+    yield [header for header, _ in COLUMNS]
+    queryset = queryset.values_list(*lookups).order_by('avtomat_number')
+    last = None
+    # The batches run after the request returned, all of them read from where the request read
+    with dbrouters.bind(state):
+        while True:
+            batch = queryset if last is None else queryset.filter(avtomat_number__gt=last)
+            rows = list(batch[:CHUNK_SIZE])
+            for row in rows:
+                yield [value if labels is None else labels.get(value, value) for value, labels in zip(row, choices)]
+            if len(rows) < CHUNK_SIZE:
+                break
+            last = rows[-1][0]
+
+
+def csv_response(queryset) -> StreamingHttpResponse:
+    """Stream the avtomats of a queryset as a CSV attachment."""
+    writer = csv.writer(Echo())
+    filename = f'avtomats_{datetime.now():%Y%m%d_%H%M}.csv'
+    return StreamingHttpResponse(
+        (writer.writerow(row) for row in _rows(queryset, dbrouters.current())),
+        content_type='text/csv; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
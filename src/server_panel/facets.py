@@ -0,0 +1,34 @@
+"""Cached choices for the Avtomat changelist filters.
+
+Only ``(pk, label)`` tuples and plain values are stored. The cache is cleared when a route,
+city, street or avtomat is changed through the admin or by an avtomat action.
+"""
+from django.core.cache import cache
+
+from .models import Avtomat, City, Route
+
+ROUTES_KEY = 'server_panel:facets:routes'
+CITIES_KEY = 'server_panel:facets:cities'
+PRICES_FOR_APP_KEY = 'server_panel:facets:prices_for_app'
+TIMEOUT = 3600
+
+
+def route_choices() -> list[tuple[int, str]]:
+    return cache.get_or_set(ROUTES_KEY, lambda: list(Route.objects.values_list('pk', 'name')), TIMEOUT)
+
+
+def city_choices() -> list[tuple[int, str]]:
+    return cache.get_or_set(CITIES_KEY, lambda: list(City.objects.values_list('pk', 'city')), TIMEOUT)
+
+
+def price_for_app_choices() -> list[int]:
+    return cache.get_or_set(
+        PRICES_FOR_APP_KEY,
+        lambda: list(Avtomat.objects.exclude(price_for_app=None).order_by('price_for_app')
+                     .values_list('price_for_app', flat=True).distinct()),
+        TIMEOUT,
+    )
+
+
+def invalidate():
+    cache.delete_many([ROUTES_KEY, CITIES_KEY, PRICES_FOR_APP_KEY])
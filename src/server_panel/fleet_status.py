@@ -0,0 +1,296 @@
+"""Avtomat counts of the fleet status page, kept in Redis.
+
+Every avtomat falls in one group (state, city, route, size, online payment, security state). The
+counts of all groups are one Redis hash filled by a single ``GROUP BY`` query, and the group of
+every avtomat is kept in a second hash: when avtomats change through the admin, only their rows
+are read again and the counts of their old and new groups are adjusted with HINCRBY, so the
+page never counts the fleet itself. The job workers rebuild both hashes every
+``FLEET_STATUS_REFRESH_INTERVAL`` seconds for changes made outside the admin, e.g. the states
+reported by the vodomat server.
+
+The tables of the page are cached per filter selection until the counts change next.
+"""
+import hashlib
+import json
+import time
+import uuid
+from collections import Counter
+from collections.abc import Iterable
+from typing import Optional
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, Count, Value, When
+
+from . import dbrouters, facets
+from .models import Avtomat
+from .redis_client import get_redis
+
+COUNTS_KEY = 'server_panel:fleet:counts'
+GROUPS_KEY = 'server_panel:fleet:groups'
+REFRESHED_KEY = 'server_panel:fleet:refreshed'
+VERSION_KEY = 'server_panel:fleet:version'
+LOCK_KEY = 'server_panel:fleet:lock'
+
+# Seconds one rebuild may take before another process may start rebuilding
+LOCK_TIMEOUT = 600
+
+# Seconds the tables of a filter selection are cached, unless the counts change before
+SUMMARY_TIMEOUT = 300
+
+DIMENSIONS = ('state', 'city', 'route', 'size', 'online_pay', 'security_state')
+
+TITLES = {
+    'state': 'State',
+    'city': 'City',
+    'route': 'Route',
+    'size': 'Size',
+    'online_pay': 'Online payment',
+    'security_state': 'Security state',
+}
+
+# Avtomat fields that move an avtomat to another group when changed
+FIELDS = {'state', 'street', 'street_id', 'route', 'route_id', 'size', 'price_for_app', 'security_state'}
+
+_COLUMNS = ('state', 'street__city_id', 'route_id', 'size', 'online_pay', 'security_state')
+
+
+def _queryset(queryset):
+    # Online payment is on when the avtomat has a price for the app, as the Disable Online Pay action clears it
+    return queryset.annotate(online_pay=Case(When(price_for_app__gt=0, then=Value(True)), default=Value(False),
+                                             output_field=BooleanField())).order_by()
+
+
+def _group(row: Iterable) -> str:
+    state, city, route, size, online_pay, security_state = row
+    return json.dumps([state, city, route, size, bool(online_pay), security_state])
+
+
+def is_built() -> bool:
+    return bool(get_redis().exists(GROUPS_KEY))
+
+
+def rebuild() -> Optional[int]:
+    """Count the groups and record the group of every avtomat, return the number of avtomats.
+
+    Returns None when another process is rebuilding.
+    """
+    r = get_redis()
+    if not r.set(LOCK_KEY, 1, nx=True, ex=LOCK_TIMEOUT):
+        return None
+    try:
+        # The counts and the groups are read from the same replica
+        with dbrouters.bind(dbrouters.current()):
+            return _rebuild(r)
+    finally:
+        r.delete(LOCK_KEY)
+
+
+def _count() -> dict[str, int]:
+    return {
+        _group(row[:-1]): row[-1]
+        for row in _queryset(Avtomat.objects.all()).values_list(*_COLUMNS).annotate(count=Count('pk'))
+    }
+
+
+def _rebuild(r) -> int:
+    counts = _count()
+    # Keys of this run, a rebuild that outlived its lock does not write into those of the next one
+    run = uuid.uuid4().hex
+    tmp_counts, tmp_groups = f'{COUNTS_KEY}:tmp:{run}', f'{GROUPS_KEY}:tmp:{run}'
+    try:
+        pipe = r.pipeline(transaction=False)
+        count = 0
+        for avtomat_number, *row in _queryset(Avtomat.objects.all()).values_list('avtomat_number', *_COLUMNS) \
+                .iterator(chunk_size=2000):
+            pipe.hset(tmp_groups, avtomat_number, _group(row))
+            count += 1
+            if count % 1000 == 0:
+                pipe.execute()
+        # Keeps the groups hash present, which marks the counts as built, also for an empty fleet
+        pipe.hset(tmp_groups, '', '')
+        if counts:
+            pipe.hset(tmp_counts, mapping=counts)
+        pipe.execute()
+
+        with r.pipeline() as pipe:
+            if counts:
+                pipe.rename(tmp_counts, COUNTS_KEY)
+            else:
+                pipe.delete(COUNTS_KEY)
+            pipe.rename(tmp_groups, GROUPS_KEY)
+            pipe.set(REFRESHED_KEY, time.time())
+            pipe.execute()
+    finally:
+        # Left over when the build failed
+        r.delete(tmp_counts, tmp_groups)
+    _changed()
+    return count
+
+
+def rebuild_if_due() -> Optional[int]:
+    """Rebuild when the last rebuild is older than the refresh interval."""
+    refreshed = get_redis().get(REFRESHED_KEY)
+    if refreshed is not None and time.time() - float(refreshed) < settings.FLEET_STATUS_REFRESH_INTERVAL:
+        return None
+    return rebuild()
+
+
+def update(avtomat_numbers: Iterable[int]):
+    """Move the given avtomats to their current groups, removing those that no longer exist.
+
+    Concurrent changes of the same avtomat may count it twice until the next rebuild.
+    """
+    avtomat_numbers = list(avtomat_numbers)
+    if not avtomat_numbers or not is_built():
+        return
+    r = get_redis()
+    old = dict(zip(avtomat_numbers, r.hmget(GROUPS_KEY, avtomat_numbers)))
+    new = {avtomat_number: _group(row) for avtomat_number, *row in
+           _queryset(Avtomat.objects.filter(avtomat_number__in=avtomat_numbers))
+           .values_list('avtomat_number', *_COLUMNS)}
+    deltas = Counter()
+    for number in avtomat_numbers:
+        if old[number] == new.get(number):
+            continue
+        if old[number]:
+            deltas[old[number]] -= 1
+        if number in new:
+            deltas[new[number]] += 1
+    with r.pipeline() as pipe:
+        for group, delta in deltas.items():
+            if delta:
+                pipe.hincrby(COUNTS_KEY, group, delta)
+        for number in avtomat_numbers:
+            if number in new:
+                pipe.hset(GROUPS_KEY, number, new[number])
+            else:
+                pipe.hdel(GROUPS_KEY, number)
+        pipe.execute()
+    if deltas:
+        _changed()
+
+
+def update_streets(street_ids: Iterable[int]):
+    """Move the avtomats on the given streets, e.g. after a street moved to another city."""
+    update(Avtomat.objects.filter(street_id__in=list(street_ids)).values_list('avtomat_number', flat=True))
+
+
+def invalidate():
+    """Forget the counts, e.g. after a route or city was deleted; the next read rebuilds them."""
+    get_redis().delete(COUNTS_KEY, GROUPS_KEY, REFRESHED_KEY)
+    _changed()
+
+
+def _changed():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_counts() -> list[tuple[dict, int]]:
+    """Return the groups with avtomats and their counts, built on first use.
+
+    While another process builds them, the groups are counted without keeping the counts.
+    """
+    if not is_built() and rebuild() is None:
+        groups = _count()
+    else:
+        groups = get_redis().hgetall(COUNTS_KEY)
+    counts = []
+    for group, count in groups.items():
+        if int(count) > 0:
+            counts.append((dict(zip(DIMENSIONS, json.loads(group))), int(count)))
+    return counts
+
+
+def labels() -> dict[str, dict]:
+    """Return the display names of the values of every dimension."""
+    return {
+        'state': dict(Avtomat.STATE),
+        'city': {None: 'No city', **dict(facets.city_choices())},
+        'route': {None: 'No route', **dict(facets.route_choices())},
+        'size': {None: 'Undefined', **dict(Avtomat.SIZE)},
+        'online_pay': {True: 'Enabled', False: 'Disabled'},
+        'security_state': dict(Avtomat.SECURITY_STATE),
+    }
+
+
+def param(value) -> str:
+    """Return a dimension value as in the query string of the page."""
+    return 'none' if value is None else str(value).lower()
+
+
+def _changelist_params(dimension: str, value) -> Optional[dict]:
+    if dimension == 'state':
+        return {'state__isnull': 'True'} if value is None else {'state__exact': value}
+    if dimension == 'size':
+        return {'size__isnull': 'True'} if value is None else {'size__exact': value}
+    if dimension == 'city' and value is not None:
+        return {'city': value}
+    if dimension == 'route':
+        return {'route_number': 'no_route' if value is None else value}
+    if dimension == 'online_pay' and not value:
+        return {'price_for_app': 'empty'}
+    # The changelist has no filter for the rest
+    return None
+
+
+def changelist_query(selection: dict) -> Optional[str]:
+    """Return the changelist query string of the avtomats of a selection of dimension values."""
+    params = {}
+    for dimension, value in selection.items():
+        dimension_params = _changelist_params(dimension, value)
+        if dimension_params is None:
+            return None
+        params.update(dimension_params)
+    return urlencode(params)
+
+
+def summary(filters: dict[str, str]) -> dict:
+    """Return the counts of the groups matching ``{dimension: param}`` filters: the total, the
+    states present, and a table of counts by state for every other dimension.
+    """
+    version = cache.get_or_set(VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+    digest = hashlib.md5(json.dumps(filters, sort_keys=True).encode()).hexdigest()
+    return cache.get_or_set(f'server_panel:fleet:summary:{version}:{digest}', lambda: _summary(filters),
+                            SUMMARY_TIMEOUT)
+
+
+def _summary(filters: dict[str, str]) -> dict:
+    counts = [(group, count) for group, count in get_counts()
+              if all(param(group[dimension]) == value for dimension, value in filters.items())]
+    names = labels()
+    selected = {dimension: group[dimension] for group, _ in counts[:1] for dimension in filters}
+    by_state = Counter()
+    for group, count in counts:
+        by_state[group['state']] += count
+    states = sorted(by_state, key=lambda state: (state is None, state or 0))
+
+    tables = []
+    for dimension in DIMENSIONS[1:]:
+        rows = {}
+        for group, count in counts:
+            rows.setdefault(group[dimension], Counter())[group['state']] += count
+        table = []
+        for value, row in rows.items():
+            table.append({
+                'value': param(value),
+                'label': names[dimension].get(value, value),
+                'total': sum(row.values()),
+                'query': changelist_query({**selected, dimension: value}),
+                'states': [(row[state], changelist_query({**selected, dimension: value, 'state': state}))
+                           for state in states],
+            })
+        table.sort(key=lambda row: (-row['total'], str(row['label'])))
+        tables.append({'dimension': dimension, 'title': TITLES[dimension], 'rows': table})
+
+    return {
+        'total': sum(by_state.values()),
+        'total_query': changelist_query(selected),
+        'states': [{'value': param(state), 'label': names['state'].get(state, 'Not set'),
+                    'count': by_state[state], 'query': changelist_query({**selected, 'state': state})}
+                   for state in states],
+        'tables': tables,
+        'filters': {TITLES[dimension]: names[dimension].get(value, value) for dimension, value in selected.items()}
+        if counts else {TITLES[dimension]: value for dimension, value in filters.items()},
+    }
@@ -1,44 +1,65 @@
 import bcrypt
 from django import forms
+from django.contrib.admin.models import ACTION_FLAG_CHOICES
 from .models import User
 
 
+# Avtomat rules shared by the admin form and the CSV import
+
+def validate_rro_id(rro_id):
+    if rro_id and not rro_id.isdigit():
+        raise forms.ValidationError('Invalid Characters')
+
+
+def validate_security_state(security_id, security_state):
+    if security_id and not security_state:
+        raise forms.ValidationError('Check Security State! SecurityID is not empty!')
+    if not security_id and security_state in (1, 2):
+        raise forms.ValidationError('Check Security State! SecurityID is empty!')
+
+
+def has_price_for_app(price_for_app) -> bool:
+    return price_for_app is not None and price_for_app > 0
+
+
+def validate_price_for_app(visible_in_app, price_for_app):
+    if visible_in_app and not has_price_for_app(price_for_app):
+        raise forms.ValidationError('Check Price for App! It should be > 0!')
+
+
+def house_changed(house_db, house_new) -> bool:
+    """The coordinates belong to the old house and have to be cleared."""
+    return bool(house_db) and house_db != house_new
+
+
 class AvtomatAdminForm(forms.ModelForm):
 
     def clean_rro_id(self):
         rro_id = self.cleaned_data.get('rro_id')
-        if rro_id and not rro_id.isdigit():
-            raise forms.ValidationError('Invalid Characters')
+        validate_rro_id(rro_id)
         return rro_id
 
     def clean_security_state(self):
         security_id = self.cleaned_data.get('security_id')
         security_state = self.cleaned_data.get('security_state')
-        if security_id and not security_state:
-            raise forms.ValidationError('Check Security State! SecurityID is not empty!')
-        if not security_id and security_state in (1, 2):
-            raise forms.ValidationError('Check Security State! SecurityID is empty!')
+        validate_security_state(security_id, security_state)
         return security_state
 
     def clean_price_for_app(self):
         price_for_app = self.cleaned_data.get('price_for_app')
-        if price_for_app is None or price_for_app <= 0:
+        if not has_price_for_app(price_for_app):
             self.instance.visible_in_app = False
         return price_for_app
 
     def clean(self):
         cleaned_data = super().clean()
-        house_db = self.instance.house
-        house_form = cleaned_data.get('house')
-        if house_db and house_db != house_form:
+        if house_changed(self.instance.house, cleaned_data.get('house')):
             cleaned_data['longitude'] = None
             cleaned_data['latitude'] = None
 
         visible_in_app = cleaned_data.get('visible_in_app', self.instance.visible_in_app)
         price_for_app = cleaned_data.get('price_for_app', self.instance.price_for_app)
-
-        if visible_in_app and (price_for_app is None or price_for_app <= 0):
-            raise forms.ValidationError('Check Price for App! It should be > 0!')
+        validate_price_for_app(visible_in_app, price_for_app)
 
         return cleaned_data
 
@@ -90,3 +111,22 @@ class CSVFilterForm(forms.Form):
         label='Select CSV file',
         help_text='Upload a CSV file with machine IDs'
     )
+
+
+class AvtomatImportForm(forms.Form):
+    csv_file = forms.FileField(
+        label='CSV file',
+        help_text='Columns as in the CSV export, only Number is required and empty cells clear the value. '
+                  'Avtomats that do not exist yet are created.'
+    )
+
+
+class AvtomatChangesForm(forms.Form):
+    avtomat_number = forms.IntegerField(required=False, min_value=1, label='Avtomat')
+    action_flag = forms.TypedChoiceField(
+        required=False, label='Action', choices=[('', 'All'), *ACTION_FLAG_CHOICES], coerce=int, empty_value=None,
+    )
+    date_from = forms.DateField(required=False, label='From', widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, label='To', widget=forms.DateInput(attrs={'type': 'date'}))
+    # Id of the last entry of the previous page
+    before = forms.IntegerField(required=False, widget=forms.HiddenInput)
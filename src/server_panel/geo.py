@@ -0,0 +1,132 @@
+"""GeoJSON of the avtomat fleet for the map.
+
+All avtomats with coordinates are loaded with one query into a cached snapshot: the serialized
+GeoJSON of the whole fleet with its ETag, the features, and a grid index of the features by
+cell of ``GRID_SIZE`` degrees. Bounding-box requests of a panning map read only the grid cells
+they cover. Each process keeps its own copy of the snapshot for the current ETag, so a request
+costs two cache lookups and no database query. Admin changes of coordinates or state, and of the
+streets and cities of the addresses, bump the version; changes made by the server itself are
+picked up when the snapshot expires.
+"""
+import hashlib
+import json
+import math
+import uuid
+from typing import Optional
+
+from django.core.cache import cache
+
+from .models import Avtomat, Street
+
+VERSION_KEY = 'server_panel:geo:version'
+
+# Seconds a snapshot is used before it is rebuilt, picks up state changes made outside the admin
+TIMEOUT = 60
+
+# Degrees of latitude and longitude covered by one grid cell
+GRID_SIZE = 0.05
+
+# Fields shown on the map, changing one of them invalidates the snapshot
+FIELDS = {'latitude', 'longitude', 'state', 'route', 'route_id', 'search_radius', 'street', 'street_id', 'house'}
+
+_STATES = dict(Avtomat.STATE)
+
+_local = {'etag': None, 'snapshot': None}
+
+
+def invalidate():
+    """Rebuild the snapshot on the next request, e.g. after avtomats were moved."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _cell(latitude: float, longitude: float) -> tuple[int, int]:
+    return math.floor(latitude / GRID_SIZE), math.floor(longitude / GRID_SIZE)
+
+
+def _build() -> dict:
+    features = []
+    rows = Avtomat.objects.filter(latitude__isnull=False, longitude__isnull=False) \
+                          .values_list('avtomat_number', 'latitude', 'longitude', 'state', 'route__name',
+                                       'search_radius', 'street__street', 'street__city__city', 'house')
+    for number, latitude, longitude, state, route, search_radius, street, city, house in rows:
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'properties': {
+                'avtomat_number': number,
+                'state': state,
+                'state_label': _STATES.get(state, ''),
+                'route': route,
+                'search_radius': search_radius,
+                'address': '' if street is None else f'{Street.label(street, city)} {house or ""}'.strip(),
+            },
+        })
+    payload = to_geojson(features)
+    grid = {}
+    for i, feature in enumerate(features):
+        longitude, latitude = feature['geometry']['coordinates']
+        grid.setdefault('%d:%d' % _cell(latitude, longitude), []).append(i)
+    return {
+        'etag': hashlib.md5(payload.encode()).hexdigest(),
+        'payload': payload,
+        'features': features,
+        'grid': grid,
+    }
+
+
+def get_snapshot() -> dict:
+    """Return the current snapshot, from the process, the cache or built from the database."""
+    version = cache.get_or_set(VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+    etag_key = f'server_panel:geo:{version}:etag'
+    etag = cache.get(etag_key)
+    if etag is not None and etag == _local['etag']:
+        return _local['snapshot']
+
+    snapshot = cache.get(f'server_panel:geo:{version}:snapshot') if etag is not None else None
+    if snapshot is None:
+        snapshot = _build()
+        cache.set_many({f'server_panel:geo:{version}:snapshot': snapshot, etag_key: snapshot['etag']}, TIMEOUT)
+    _local.update(etag=snapshot['etag'], snapshot=snapshot)
+    return snapshot
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[tuple[float, float, float, float]]:
+    """Parse ``west,south,east,north``, return None for a missing or invalid box."""
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if west > east or south > north:
+        return None
+    return west, south, east, north
+
+
+def etag(snapshot: dict, bbox: Optional[tuple[float, float, float, float]]) -> str:
+    """Return the quoted ETag of the whole fleet or of the features in a box."""
+    if bbox is None:
+        return f'"{snapshot["etag"]}"'
+    return '"%s"' % hashlib.md5(f'{snapshot["etag"]}:{bbox}'.encode()).hexdigest()
+
+
+def features_in(snapshot: dict, bbox: tuple[float, float, float, float]) -> list[dict]:
+    """Return the features inside the box, read from the grid cells it covers."""
+    west, south, east, north = bbox
+    features = snapshot['features']
+    (bottom, left), (top, right) = _cell(south, west), _cell(north, east)
+    if (top - bottom + 1) * (right - left + 1) > len(snapshot['grid']):
+        # Zoomed out over most of the fleet, the cells cost more than the features
+        candidates = range(len(features))
+    else:
+        candidates = [i for row in range(bottom, top + 1) for column in range(left, right + 1)
+                      for i in snapshot['grid'].get(f'{row}:{column}', ())]
+    selected = []
+    for i in candidates:
+        longitude, latitude = features[i]['geometry']['coordinates']
+        if west <= longitude <= east and south <= latitude <= north:
+            selected.append(features[i])
+    return selected
+
+
+def to_geojson(features: list[dict]) -> str:
+    """Serialize features as a GeoJSON FeatureCollection."""
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, ensure_ascii=False)
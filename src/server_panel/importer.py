@@ -0,0 +1,391 @@
+"""CSV import of avtomats.
+
+An upload is read row by row and validated in batches: the existing avtomats of a batch are
+loaded with one query, streets and routes are resolved through dicts loaded once per import,
+and every row is checked with the rules of ``AvtomatAdminForm``. The result is a plan kept in
+Redis that is shown as a dry-run diff with a per-row error report, and written only when it is
+applied, with ``bulk_create``/``bulk_update`` in one transaction per chunk.
+
+The file uses the headers of the CSV export. Only the columns present are imported, so a file
+with ``Number``, ``Street``, ``City`` and ``House`` re-addresses avtomats and keeps the rest;
+an empty cell clears the value, like an empty cell of the export.
+"""
+import csv
+import io
+import json
+import uuid
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Optional
+
+from django.contrib.admin.models import ADDITION
+from django.core.exceptions import ValidationError
+from django.db import router, transaction
+
+from . import facets, fleet_status, geo, paginators, search_index
+from .avtomat_actions import log_changes
+from .forms import has_price_for_app, house_changed, validate_price_for_app, validate_rro_id, \
+    validate_security_state
+from .models import Avtomat, Route, Street
+from .redis_client import get_redis
+
+# Rows validated with one query for their existing avtomats
+BATCH_SIZE = 500
+
+# Avtomats written per bulk query and transaction
+CHUNK_SIZE = 500
+
+# Seconds a dry run can be applied
+PLAN_TTL = 3600
+
+_TRUE = {'1', 'true', 'yes', 'y', '+'}
+_FALSE = {'0', 'false', 'no', 'n', '-'}
+
+
+def _text(value: str) -> Optional[str]:
+    return value or None
+
+
+def _integer(value: str) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'"{value}" is not a whole number') from None
+
+
+def _float(value: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        raise ValueError(f'"{value}" is not a number') from None
+
+
+def _boolean(value: str) -> Optional[bool]:
+    if not value:
+        return None
+    if value.casefold() in _TRUE:
+        return True
+    if value.casefold() in _FALSE:
+        return False
+    raise ValueError(f'"{value}" is not yes or no')
+
+
+def _choice(choices) -> Callable[[str], Optional[int]]:
+    values = {str(value): value for value, _ in choices}
+    values.update({label.casefold(): value for value, label in choices})
+
+    def parse(value: str) -> Optional[int]:
+        if not value:
+            return None
+        if value.casefold() not in values:
+            raise ValueError(f'"{value}" is not one of {", ".join(label for _, label in choices)}')
+        return values[value.casefold()]
+    return parse
+
+
+# Column header (lower case) to model field and parser, Street, City and Route are resolved separately
+COLUMNS = {
+    'house': ('house', _text),
+    'state': ('state', _choice(Avtomat.STATE)),
+    'size': ('size', _choice(Avtomat.SIZE)),
+    'price': ('price', _integer),
+    'price for app': ('price_for_app', _integer),
+    'max sum': ('max_sum', _integer),
+    'latitude': ('latitude', _float),
+    'longitude': ('longitude', _float),
+    'rro id': ('rro_id', _text),
+    'security id': ('security_id', _text),
+    'security state': ('security_state', _choice(Avtomat.SECURITY_STATE)),
+    'visible in app': ('visible_in_app', _boolean),
+}
+
+FIELDS = ('street_id', 'route_id') + tuple(name for name, _ in COLUMNS.values())
+
+_LABELS = {'street_id': 'Street', 'route_id': 'Route'}
+_LABELS.update({name: header.capitalize() for header, (name, _) in COLUMNS.items()})
+_LABELS.update(rro_id='RRO ID', security_id='Security ID')
+
+_CHOICES = {
+    'state': dict(Avtomat.STATE),
+    'size': dict(Avtomat.SIZE),
+    'security_state': dict(Avtomat.SECURITY_STATE),
+}
+
+
+class _Lookups:
+    """Streets and routes of the whole import, loaded with one query each."""
+
+    def __init__(self):
+        self.streets = defaultdict(list)
+        self.street_labels = {}
+        for street_id, street, city in Street.objects.values_list('id', 'street', 'city__city'):
+            self.streets[street.casefold()].append((city.casefold() if city else None, street_id))
+            self.street_labels[street_id] = Street.label(street, city)
+        self.routes = dict(Route.objects.values_list('name', 'id'))
+        self.route_names = {route_id: name for name, route_id in self.routes.items()}
+
+    def street_id(self, street: str, city: Optional[str], match_city: bool) -> Optional[int]:
+        if not street:
+            return None
+        candidates = self.streets.get(street.casefold(), [])
+        if match_city:
+            city_key = city.casefold() if city else None
+            candidates = [candidate for candidate in candidates if candidate[0] == city_key]
+        if not candidates:
+            raise ValueError(f'Unknown street "{street}"' + (f' in "{city}"' if city else ''))
+        if len(candidates) > 1:
+            raise ValueError(f'Street "{street}" exists in several cities, add the City column')
+        return candidates[0][1]
+
+    def route_id(self, name: str) -> Optional[int]:
+        if not name:
+            return None
+        if name not in self.routes:
+            raise ValueError(f'Unknown route "{name}"')
+        return self.routes[name]
+
+    def display(self, name: str, value) -> str:
+        if value is None:
+            return ''
+        if name == 'street_id':
+            return self.street_labels.get(value, value)
+        if name == 'route_id':
+            return self.route_names.get(value, value)
+        if name in _CHOICES:
+            return _CHOICES[name].get(value, value)
+        return str(value)
+
+
+@dataclass
+class ImportPlan:
+    id: str
+    user_id: int
+    rows: int = 0
+    unchanged: int = 0
+    # {'number', 'create', 'values': {field: new value}, 'changes': [(label, old, new)]}
+    changes: list[dict] = field(default_factory=list)
+    # {'line', 'number', 'errors': [message]}
+    errors: list[dict] = field(default_factory=list)
+
+    @property
+    def created(self) -> int:
+        return sum(1 for change in self.changes if change['create'])
+
+    @property
+    def updated(self) -> int:
+        return len(self.changes) - self.created
+
+
+def _parse_row(row: dict, lookups: _Lookups, has_city: bool) -> tuple[Optional[int], dict, list[str]]:
+    """Return the avtomat number, the parsed field values and the errors of a row."""
+    values, errors = {}, []
+    try:
+        number = int(row.get('number') or '')
+    except ValueError:
+        return None, values, [f'Number: "{row.get("number", "")}" is not a number']
+
+    if 'street' in row:
+        try:
+            values['street_id'] = lookups.street_id(row['street'], row.get('city'), has_city)
+        except ValueError as e:
+            errors.append(f'Street: {e}')
+    if 'route' in row:
+        try:
+            values['route_id'] = lookups.route_id(row['route'])
+        except ValueError as e:
+            errors.append(f'Route: {e}')
+    for header, (name, parse) in COLUMNS.items():
+        if header not in row:
+            continue
+        try:
+            values[name] = parse(row[header])
+            if values[name] is not None:
+                Avtomat._meta.get_field(name).run_validators(values[name])
+        except ValueError as e:
+            errors.append(f'{_LABELS[name]}: {e}')
+        except ValidationError as e:
+            errors.extend(f'{_LABELS[name]}: {message}' for message in e.messages)
+    return number, values, errors
+
+
+def _check(errors: list[str], validator, *args):
+    try:
+        validator(*args)
+    except ValidationError as e:
+        errors.extend(e.messages)
+
+
+def _validate(current: dict, values: dict) -> tuple[dict, list[str]]:
+    """Apply the admin form rules to the row values over the current ones, return the new values."""
+    new = {**current, **values}
+    if 'house' in values and house_changed(current['house'], new['house']):
+        # Coordinates given in the same row belong to the new house
+        for coordinate in ('latitude', 'longitude'):
+            if coordinate not in values:
+                new[coordinate] = None
+
+    errors = []
+    _check(errors, validate_rro_id, new['rro_id'])
+    _check(errors, validate_security_state, new['security_id'], new['security_state'])
+    if 'visible_in_app' in values:
+        _check(errors, validate_price_for_app, new['visible_in_app'], new['price_for_app'])
+    if not has_price_for_app(new['price_for_app']):
+        new['visible_in_app'] = False
+    return new, errors
+
+
+def _defaults() -> dict:
+    avtomat = Avtomat()
+    return {name: getattr(avtomat, name) for name in FIELDS}
+
+
+def _process_batch(plan: ImportPlan, batch: list[tuple[int, int, dict]], lookups: _Lookups):
+    numbers = [number for _, number, _ in batch]
+    existing = {row['avtomat_number']: row for row in
+                Avtomat.objects.filter(avtomat_number__in=numbers).values('avtomat_number', *FIELDS)}
+    defaults = _defaults()
+    for line, number, values in batch:
+        create = number not in existing
+        current = defaults if create else existing[number]
+        new, errors = _validate(current, values)
+        if errors:
+            plan.errors.append({'line': line, 'number': number, 'errors': errors})
+            continue
+        changed = {name: value for name, value in new.items() if create or value != current[name]}
+        if not changed:
+            plan.unchanged += 1
+            continue
+        plan.changes.append({
+            'number': number,
+            'create': create,
+            'values': changed,
+            'changes': [(_LABELS[name], '' if create else lookups.display(name, current[name]),
+                         lookups.display(name, value))
+                        for name, value in changed.items() if not create or value is not None],
+        })
+
+
+def prepare(uploaded_file, user_id: int) -> ImportPlan:
+    """Validate an uploaded CSV file and store the changes it makes as a plan to apply."""
+    plan = ImportPlan(id=uuid.uuid4().hex, user_id=user_id)
+    reader = csv.reader(io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline=''))
+    header = [column.strip().casefold() for column in next(reader, [])]
+    if 'number' not in header:
+        plan.errors.append({'line': 1, 'number': '', 'errors': ['The file has no Number column']})
+        return plan
+
+    lookups = _Lookups()
+    has_city = 'city' in header
+    seen = {}
+    batch = []
+    for line, row in enumerate(reader, start=2):
+        if not any(value.strip() for value in row):
+            continue
+        plan.rows += 1
+        row = {name: value.strip() for name, value in zip(header, row)}
+        number, values, errors = _parse_row(row, lookups, has_city)
+        if number in seen:
+            errors.append(f'Duplicate avtomat number, first on line {seen[number]}')
+        if errors:
+            plan.errors.append({'line': line, 'number': row.get('number', ''), 'errors': errors})
+            continue
+        seen[number] = line
+        batch.append((line, number, values))
+        if len(batch) == BATCH_SIZE:
+            _process_batch(plan, batch, lookups)
+            batch = []
+    if batch:
+        _process_batch(plan, batch, lookups)
+
+    plan.changes.sort(key=lambda change: change['number'])
+    plan.errors.sort(key=lambda error: error['line'])
+    get_redis().set(_key(plan.id), json.dumps(asdict(plan)), ex=PLAN_TTL)
+    return plan
+
+
+def _key(plan_id: str) -> str:
+    return f'server_panel:imports:{plan_id}'
+
+
+def _chunks(items: list, size: int = CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_errors(plan_id: str, user_id: int) -> Optional[list[dict]]:
+    """Return the per-row errors of a prepared plan, None when it expired or was applied."""
+    data = get_redis().get(_key(plan_id))
+    if data is None:
+        return None
+    plan = json.loads(data)
+    return plan['errors'] if plan['user_id'] == user_id else None
+
+
+def apply(plan_id: str, user_id: int) -> Optional[tuple[int, int, list[int]]]:
+    """Write a prepared plan, return the number of created and updated avtomats and the numbers
+    of the avtomats to update that were deleted since the dry run, which are skipped.
+
+    Returns None when the plan expired, was applied already or belongs to another user.
+    """
+    r = get_redis()
+    data = r.get(_key(plan_id))
+    if data is None:
+        return None
+    plan = json.loads(data)
+    # Deleting the plan claims it, a second submit of the same dry run does nothing
+    if plan['user_id'] != user_id or not r.delete(_key(plan_id)):
+        return None
+
+    changes = plan['changes']
+    numbers = [change['number'] for change in changes]
+    # Avtomats added since the dry run are updated instead of created; the changes of deleted
+    # avtomats hold only the changed fields, so they are not created again
+    existing = set()
+    for chunk in _chunks(numbers):
+        existing.update(Avtomat.objects.filter(avtomat_number__in=chunk).values_list('avtomat_number', flat=True))
+    creates = [change for change in changes if change['create'] and change['number'] not in existing]
+    updates = [change for change in changes if change['number'] in existing]
+    deleted = [change['number'] for change in changes if not change['create'] and change['number'] not in existing]
+
+    db = router.db_for_write(Avtomat)
+    created = []
+    for chunk in _chunks(creates):
+        avtomats = [Avtomat(avtomat_number=change['number'], **change['values']) for change in chunk]
+        with transaction.atomic(using=db):
+            Avtomat.objects.bulk_create(avtomats)
+            # Logged with each committed chunk, so a later failure does not lose them
+            log_changes(user_id, avtomats, 'Imported from CSV', action_flag=ADDITION)
+        created.extend(avtomats)
+
+    updated = 0
+    for chunk in _chunks(updates):
+        with transaction.atomic(using=db):
+            avtomats = Avtomat.objects.select_for_update().in_bulk([change['number'] for change in chunk])
+            by_fields = defaultdict(list)
+            fields = set()
+            for change in chunk:
+                avtomat = avtomats.get(change['number'])
+                if avtomat is None:
+                    deleted.append(change['number'])
+                    continue
+                for name, value in change['values'].items():
+                    setattr(avtomat, name, value)
+                fields.update(change['values'])
+                by_fields[tuple(sorted(change['values']))].append(avtomat)
+            if avtomats:
+                Avtomat.objects.bulk_update(list(avtomats.values()), sorted(fields))
+            for names, changed in by_fields.items():
+                log_changes(user_id, changed, f'Changed {", ".join(_LABELS[name] for name in names)} from CSV import')
+                updated += len(changed)
+
+    facets.invalidate()
+    paginators.invalidate()
+    if any(geo.FIELDS.intersection(change['values']) for change in changes):
+        geo.invalidate()
+    search_index.update(numbers)
+    fleet_status.update(numbers)
+    return len(created), updated, sorted(deleted)
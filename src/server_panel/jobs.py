@@ -0,0 +1,234 @@
+"""Redis-backed queue for avtomat actions that are too slow for the admin request.
+
+A job keeps the avtomat numbers still to process in its ``pending`` list and moves them to
+the ``succeeded``/``busy``/``failed`` sets batch by batch. Workers take job ids from the queue
+with BLMOVE into a processing list and keep a heartbeat key alive while they work, so a job
+whose worker died is put back on the queue and resumed from its pending list.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'server_panel:jobs:queue'
+PROCESSING_KEY = 'server_panel:jobs:processing'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+RESULTS = ('succeeded', 'busy', 'failed')
+
+# Seconds a job in the processing list must stay without a heartbeat before it is requeued,
+# covers the moment between taking a job from the queue and its first heartbeat
+RECOVERY_GRACE = 10
+
+_handlers: dict[str, Callable] = {}
+
+
+def register(action: str):
+    """Register the function that processes one batch of avtomat numbers for an action.
+
+    The handler is called as ``handler(job, avtomat_numbers)`` and returns an object with
+    ``succeeded``, ``busy`` and ``failed`` lists of avtomat numbers.
+    """
+    def decorator(func):
+        _handlers[action] = func
+        return func
+    return decorator
+
+
+def get_handler(action: str) -> Optional[Callable]:
+    """Return the batch handler registered for an action."""
+    return _handlers.get(action)
+
+
+def _key(job_id: str, suffix: str = '') -> str:
+    return f'server_panel:jobs:{job_id}' + (f':{suffix}' if suffix else '')
+
+
+def enqueue(action: str, user_id: int, avtomat_numbers: Iterable[int], **params) -> str:
+    """Create a job for the given avtomats and put it on the queue."""
+    job_id = uuid.uuid4().hex
+    avtomat_numbers = list(avtomat_numbers)
+    now = time.time()
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.hset(_key(job_id), mapping={
+            'id': job_id,
+            'action': action,
+            'user_id': user_id,
+            'params': json.dumps(params),
+            'status': QUEUED,
+            'total': len(avtomat_numbers),
+            'created': now,
+            'updated': now,
+        })
+        if avtomat_numbers:
+            pipe.rpush(_key(job_id, 'pending'), *avtomat_numbers)
+        pipe.lpush(QUEUE_KEY, job_id)
+        pipe.execute()
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """Return the job fields with its parameters decoded, or None for an unknown job."""
+    job = get_redis().hgetall(_key(job_id))
+    if not job:
+        return None
+    job['params'] = json.loads(job['params'])
+    job['user_id'] = int(job['user_id'])
+    job['total'] = int(job['total'])
+    return job
+
+
+def get_status(job_id: str, avtomats: bool = False) -> Optional[dict]:
+    """Return the progress of a job for the status endpoint.
+
+    The numbers of the avtomats of every result are included once the job finished, or with ``avtomats``.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return None
+    avtomats = avtomats or job['status'] in (DONE, ERROR)
+    r = get_redis()
+    with r.pipeline() as pipe:
+        for result in RESULTS:
+            pipe.scard(_key(job_id, result))
+        pipe.llen(_key(job_id, 'pending'))
+        if avtomats:
+            for result in RESULTS:
+                pipe.smembers(_key(job_id, result))
+        counts = pipe.execute()
+    status = {
+        'id': job_id,
+        'action': job['action'],
+        'status': job['status'],
+        'error': job.get('error', ''),
+        'total': job['total'],
+        'pending': counts[len(RESULTS)],
+    }
+    for i, result in enumerate(RESULTS):
+        status[result] = counts[i]
+        if avtomats:
+            status[f'{result}_avtomats'] = sorted(int(number) for number in counts[len(RESULTS) + 1 + i])
+    return status
+
+
+def recover_stale_jobs() -> list[str]:
+    """Put jobs whose worker stopped sending heartbeats back on the queue."""
+    r = get_redis()
+    now = time.time()
+    recovered = []
+    for job_id in r.lrange(PROCESSING_KEY, 0, -1):
+        if r.exists(_key(job_id, 'heartbeat')):
+            continue
+        suspect_key = _key(job_id, 'suspect')
+        if r.set(suspect_key, now, nx=True, ex=settings.JOBS_HEARTBEAT_TIMEOUT):
+            continue
+        if now - float(r.get(suspect_key) or now) < RECOVERY_GRACE:
+            continue
+        r.delete(suspect_key)
+        # Only the worker that removes the id from the processing list requeues it
+        if r.lrem(PROCESSING_KEY, 1, job_id):
+            r.rpush(QUEUE_KEY, job_id)
+            recovered.append(job_id)
+            logger.warning('Job %s lost its worker and was requeued', job_id)
+    return recovered
+
+
+class _Heartbeat(threading.Thread):
+
+    def __init__(self, job_id: str):
+        super().__init__(daemon=True)
+        self.key = _key(job_id, 'heartbeat')
+        self.value = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopped = threading.Event()
+
+    def beat(self):
+        get_redis().set(self.key, self.value, ex=settings.JOBS_HEARTBEAT_TIMEOUT)
+
+    def run(self):
+        while not self.stopped.wait(settings.JOBS_HEARTBEAT_TIMEOUT / 3):
+            self.beat()
+
+    def stop(self):
+        self.stopped.set()
+        get_redis().delete(self.key)
+
+
+def run_job(job_id: str):
+    """Process the pending avtomats of a job batch by batch."""
+    r = get_redis()
+    job = get_job(job_id)
+    if job is None or job['status'] in (DONE, ERROR):
+        return
+
+    handler = get_handler(job['action'])
+    if handler is None:
+        r.hset(_key(job_id), mapping={'status': ERROR, 'error': f'Unknown action {job["action"]}',
+                                      'updated': time.time()})
+        return
+
+    r.hset(_key(job_id), mapping={'status': RUNNING, 'updated': time.time()})
+    pending_key = _key(job_id, 'pending')
+    while True:
+        batch = [int(number) for number in r.lrange(pending_key, 0, settings.JOBS_BATCH_SIZE - 1)]
+        if not batch:
+            break
+        close_old_connections()
+        result = handler(job, batch)
+        with r.pipeline() as pipe:
+            for name in RESULTS:
+                numbers = getattr(result, name)
+                if numbers:
+                    pipe.sadd(_key(job_id, name), *numbers)
+            pipe.ltrim(pending_key, len(batch), -1)
+            pipe.hset(_key(job_id), 'updated', time.time())
+            pipe.execute()
+
+    r.hset(_key(job_id), mapping={'status': DONE, 'updated': time.time()})
+
+
+def _expire(job_id: str):
+    r = get_redis()
+    with r.pipeline() as pipe:
+        for suffix in ('', 'pending') + RESULTS:
+            pipe.expire(_key(job_id, suffix), settings.JOBS_RESULT_TTL)
+        pipe.execute()
+
+
+def work(timeout: int = 5, once: bool = False):
+    """Take jobs from the queue and run them until interrupted."""
+    r = get_redis()
+    while True:
+        recover_stale_jobs()
+        job_id = r.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, 'RIGHT', 'LEFT')
+        if job_id is not None:
+            heartbeat = _Heartbeat(job_id)
+            heartbeat.beat()
+            heartbeat.start()
+            try:
+                run_job(job_id)
+            except Exception as e:
+                logger.exception('Job %s failed', job_id)
+                r.hset(_key(job_id), mapping={'status': ERROR, 'error': str(e), 'updated': time.time()})
+            finally:
+                heartbeat.stop()
+                r.lrem(PROCESSING_KEY, 1, job_id)
+                _expire(job_id)
+                close_old_connections()
+        if once:
+            return
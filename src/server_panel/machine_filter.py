@@ -0,0 +1,63 @@
+"""Avtomat numbers uploaded as a CSV file to filter the Avtomat changelist.
+
+The numbers are kept in Redis per session instead of in the session itself, and the changelist
+filters by them with one ``IN`` list on every page. An upload may hold at most ``MAX_NUMBERS``
+numbers, which keeps that list short enough to look up by the primary key at the cost of a plain
+page; the panel cannot create a table to join in the server database. The file has to be UTF-8
+encoded, as spreadsheets export "CSV UTF-8".
+"""
+import csv
+import io
+import json
+from typing import Optional
+
+from django.db.models import Q
+
+from .redis_client import get_redis
+
+# Seconds an uploaded filter is kept
+TTL = 24 * 3600
+
+# Avtomat numbers one upload may hold
+MAX_NUMBERS = 1000
+
+
+def _key(session_key: str, suffix: str) -> str:
+    return f'server_panel:machine_filter:{session_key}:{suffix}'
+
+
+def parse_csv(uploaded_file) -> tuple[set[int], int]:
+    """Read avtomat numbers from the first column, return the unique numbers and the invalid rows count.
+    Raises ``UnicodeDecodeError`` when the file is not UTF-8 encoded.
+    """
+    numbers, invalid = set(), 0
+    reader = csv.reader(io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        try:
+            numbers.add(int(row[0].strip()))
+        except ValueError:
+            invalid += 1
+    return numbers, invalid
+
+
+def store(session_key: str, numbers: set[int]):
+    get_redis().set(_key(session_key, 'numbers'), json.dumps(sorted(numbers)), ex=TTL)
+
+
+def get_numbers(session_key: str) -> Optional[list[int]]:
+    numbers = get_redis().get(_key(session_key, 'numbers'))
+    return None if numbers is None else json.loads(numbers)
+
+
+def get_q(session_key: str) -> Optional[Q]:
+    """Return the filter for the uploaded numbers, or None when the filter expired."""
+    numbers = get_numbers(session_key)
+    if numbers is None:
+        return None
+    return Q(avtomat_number__in=numbers)
+
+
+def clear(session_key: str):
+    get_redis().delete(_key(session_key, 'numbers'))
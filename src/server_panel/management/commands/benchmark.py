@@ -0,0 +1,195 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from server_panel import activity, jobs, machine_filter, search_index, synthetic
+from server_panel.admin import AvtomatAdmin
+from server_panel.models import Avtomat, City, Route
+from server_panel.redis_client import get_redis
+
+
+class Command(BaseCommand):
+    help = ('Time the Avtomat admin hot paths on a synthetic fleet and write the results as JSON. '
+            'Needs SQLite databases (--settings=config.settings.test); the server tables and the '
+            'Redis database of the cache are recreated.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--avtomats', type=int, default=50000)
+        parser.add_argument('--streets', type=int, default=5000)
+        parser.add_argument('--routes', type=int, default=200)
+        parser.add_argument('--selected', type=int, default=1000,
+                            help='Avtomats selected for the bulk actions')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed runs of every case, after one warm-up run')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds the stub server API takes per parameter request')
+        parser.add_argument('--no-seed', action='store_true',
+                            help='Reuse the fleet seeded by a previous run')
+        parser.add_argument('--output', default='benchmark.json')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        started = time.perf_counter()
+        try:
+            fleet = synthetic.setup_databases(None if options['no_seed'] else {
+                'avtomats': options['avtomats'], 'streets': options['streets'], 'routes': options['routes'],
+            })
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        if fleet is not None:
+            self.stdout.write(f'Seeded {fleet} in {time.perf_counter() - started:.1f}s')
+
+        search_index.rebuild()
+        # Roll up the synthetic statistic rows as if the rollup had watched the table for a whole window
+        r = get_redis()
+        r.delete(activity.HIGH_WATER_MARK_KEY)
+        r.set(activity.STARTED_KEY, time.time() - settings.ACTIVITY_WINDOW_DAYS * activity.DAY)
+        activity.refresh()
+
+        user = get_user_model().objects.filter(username='benchmark').first() or \
+            get_user_model().objects.create_superuser('benchmark', 'benchmark@localhost', 'benchmark')
+        self.client = Client()
+        self.client.force_login(user)
+        self.repeat = options['repeat']
+        self.results = {}
+
+        selected = list(Avtomat.objects.order_by('avtomat_number')
+                        .values_list('avtomat_number', flat=True)[:options['selected']])
+        with synthetic.StubServerAPI(busy=selected[::20], latency=options['latency']) as stub:
+            os.environ['SERVER_API_URL'] = stub.url
+            os.environ.setdefault('SERVER_API_SECURE_HEADERS', 'X-Api-Key')
+            self.run_cases(user, selected)
+
+        report = {
+            'commit': self.git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'fleet': fleet or {'avtomat': Avtomat.objects.count()},
+            'selected': len(selected),
+            'repeat': self.repeat,
+            'results': self.results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def run_cases(self, user, selected):
+        changelist = reverse('admin:server_panel_avtomat_changelist')
+        get = self.client.get
+
+        self.measure('changelist', lambda: get(changelist))
+        last_page = -(-Avtomat.objects.count() // AvtomatAdmin.list_per_page)
+        self.measure('changelist:last_page', lambda: get(changelist, {'p': last_page}))
+
+        route_id = Route.objects.order_by('id').values_list('id', flat=True).first()
+        city_id = City.objects.order_by('-id').values_list('id', flat=True).first()
+        for name, params in (
+            ('state', {'state__exact': 3}),
+            ('size', {'size__exact': 940}),
+            ('price_for_app', {'price_for_app': 140}),
+            ('price_for_app:empty', {'price_for_app': 'empty'}),
+            ('price_type', {'street__city__price_type__exact': 1}),
+            ('route', {'route_number': route_id}),
+            ('route:none', {'route_number': 'no_route'}),
+            ('city', {'city': city_id}),
+            ('activity', {'activity_status': 'inactive'}),
+        ):
+            self.measure(f'filter:{name}', lambda params=params: get(changelist, params))
+
+        for name, term in (
+            ('number', str(selected[len(selected) // 2])),
+            ('number_prefix', '12'),
+            ('street_prefix', 'Вулиця 12'),
+            ('substring', 'лиця 12'),
+        ):
+            self.measure(f'search:{name}', lambda term=term: get(changelist, {'q': term}))
+
+        self.measure('autocomplete:street', lambda: get(reverse('admin:autocomplete'), {
+            'app_label': 'server_panel', 'model_name': 'avtomat', 'field_name': 'street', 'term': 'Вулиця 1',
+        }))
+        self.measure('change_form', lambda: get(
+            reverse('admin:server_panel_avtomat_change', args=(selected[0], ))))
+
+        # The first run counts the fleet, the next ones read the counts from Redis
+        status = reverse('admin:server_panel_avtomat_status')
+        self.measure('fleet_status', lambda: get(status))
+        self.measure('fleet_status:city', lambda: get(status, {'city': city_id}))
+
+        csv_numbers = list(Avtomat.objects.values_list('avtomat_number', flat=True)[::10])[:machine_filter.MAX_NUMBERS]
+        csv_content = ('avtomat_number\n' + '\n'.join(map(str, csv_numbers))).encode()
+        self.measure('csv_filter:upload', lambda: self.client.post(changelist, {
+            'csv_file': SimpleUploadedFile('avtomats.csv', csv_content, content_type='text/csv'),
+        }))
+        self.measure('csv_filter:changelist', lambda: get(changelist))
+        get(changelist, {'clear_csv_filter': 1})
+
+        for action in ('set_price', 'set_price_for_app', 'disable_online_pay', 'set_max_sum', 'export_csv',
+                       'download_qr_stickers', 'delete_selected'):
+            # delete_selected only renders its confirmation page
+            self.measure(f'action:{action}', lambda action=action: self.client.post(changelist, {
+                'action': action, '_selected_action': selected, 'index': 0,
+            }))
+
+        # Jobs queued by Set Max Sum, as run by a worker
+        r = get_redis()
+        r.delete(jobs.QUEUE_KEY)
+        self.measure('job:set_max_sum', lambda: jobs.work(timeout=1, once=True),
+                     setup=lambda: jobs.enqueue('set_max_sum', user.id, selected, max_sum_value=5000))
+
+    def measure(self, name, func, setup=None):
+        """Time one warm-up run and ``repeat`` runs of a case, with their SQL queries per database."""
+        timings = []
+        for run in range(self.repeat + 1):
+            if setup is not None:
+                setup()
+            with ExitStack() as stack:
+                captured = {alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+                            for alias in connections}
+                started = time.perf_counter()
+                response = func()
+                if getattr(response, 'streaming', False):
+                    for _ in response.streaming_content:
+                        pass
+                elapsed = time.perf_counter() - started
+            if response is not None and response.status_code >= 400:
+                raise CommandError(f'{name} failed with {response.status_code}')
+            if run == 0:
+                first = elapsed
+            else:
+                timings.append(elapsed)
+
+        self.results[name] = {
+            'first_ms': round(first * 1000, 2),
+            'min_ms': round(min(timings) * 1000, 2),
+            'median_ms': round(statistics.median(timings) * 1000, 2),
+            'mean_ms': round(statistics.mean(timings) * 1000, 2),
+            'max_ms': round(max(timings) * 1000, 2),
+            'queries': {alias: len(queries) for alias, queries in captured.items()},
+        }
+        self.stdout.write(f'{name:<32} {self.results[name]["median_ms"]:>10.2f} ms  '
+                          f'{sum(self.results[name]["queries"].values()):>5} queries')
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=settings.BASE_DIR, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,168 @@
+import json
+import multiprocessing
+import random
+import statistics
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from server_panel import synthetic
+from server_panel.models import Avtomat
+
+# (name, weight) of the requests an operator makes
+SCENARIOS = (
+    ('changelist', 5),
+    ('filter', 3),
+    ('csv_filter', 1),
+    ('set_price', 1),
+    ('set_price_for_app', 1),
+)
+
+
+class Command(BaseCommand):
+    help = ('Run concurrent admin operators, one process each, against a synthetic fleet and report '
+            'latency and errors, "database is locked" ones counted apart. Needs SQLite databases '
+            '(--settings=config.settings.test); --baseline uses database sessions and the default SQLite '
+            'options for comparison.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operators', type=int, default=8,
+                            help='Concurrent logged in operators, each in its own process')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+        parser.add_argument('--avtomats', type=int, default=5000)
+        parser.add_argument('--selected', type=int, default=100, help='Avtomats changed by one action')
+        parser.add_argument('--no-seed', action='store_true', help='Reuse the fleet seeded by a previous run')
+        parser.add_argument('--baseline', action='store_true',
+                            help='Database sessions, default SQLite options and the admin log written in the '
+                                 'request, as before the cached sessions and the audit writer')
+        parser.add_argument('--output', help='Write the results as JSON')
+
+    def handle(self, *args, **options):
+        # The test settings write the admin log in the request thread, as the baseline does
+        overrides = override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db') \
+            if options['baseline'] else override_settings(AUDIT_ASYNC=True)
+        if options['baseline']:
+            for alias in connections:
+                if connections[alias].vendor == 'sqlite':
+                    connections[alias].close()
+                    connections[alias].settings_dict['OPTIONS'] = {}
+
+        with overrides:
+            try:
+                synthetic.setup_databases(None if options['no_seed'] else {
+                    'avtomats': options['avtomats'], 'streets': max(1, options['avtomats'] // 10),
+                    'routes': max(1, options['avtomats'] // 250),
+                })
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            numbers = list(Avtomat.objects.values_list('avtomat_number', flat=True))
+            selected = min(options['selected'], len(numbers))
+            users = [
+                (get_user_model().objects.filter(username=f'operator{i}').first() or
+                 get_user_model().objects.create_superuser(f'operator{i}', f'operator{i}@localhost', 'operator')).pk
+                for i in range(options['operators'])
+            ]
+
+            # Processes, as the operators of a deployment are served by separate workers that each
+            # hold their own SQLite connections and wait for the write lock of the others; forked so
+            # they inherit the settings overridden above
+            connections.close_all()
+            deadline = time.monotonic() + options['duration']
+            with multiprocessing.get_context('fork').Pool(len(users)) as pool:
+                operators = pool.starmap(operator, [(user, deadline, i, numbers, selected)
+                                                    for i, user in enumerate(users)])
+
+        results = {name: {'timings': [], 'errors': Counter(), 'locked': 0} for name, _ in SCENARIOS}
+        for operator_results in operators:
+            for name, result in operator_results.items():
+                results[name]['timings'].extend(result['timings'])
+                results[name]['errors'].update(result['errors'])
+                results[name]['locked'] += result['locked']
+
+        report = {
+            'baseline': options['baseline'],
+            'session_engine': 'django.contrib.sessions.backends.db' if options['baseline'] else settings.SESSION_ENGINE,
+            'operators': options['operators'],
+            'duration': options['duration'],
+            'results': {name: summary(result) for name, result in results.items()},
+        }
+        for name, result in report['results'].items():
+            self.stdout.write(f'{name:<20} {result["requests"]:>6} requests  p50 {result["p50_ms"]:>8.1f} ms  '
+                              f'p95 {result["p95_ms"]:>8.1f} ms  max {result["max_ms"]:>8.1f} ms  '
+                              f'{sum(result["errors"].values())} error(s), {result["locked"]} locked')
+            for error, count in sorted(result['errors'].items(), key=lambda item: -item[1]):
+                self.stdout.write(f'    {count:>6} x {error}')
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+def operator(user_id, deadline, seed, numbers, selected) -> dict:
+    """Make random requests as one operator until the deadline, in a process of its own."""
+    results = {name: {'timings': [], 'errors': Counter(), 'locked': 0} for name, _ in SCENARIOS}
+    rng = random.Random(seed)
+    client = Client()
+    names, weights = zip(*SCENARIOS)
+    changelist = reverse('admin:server_panel_avtomat_changelist')
+    try:
+        client.force_login(get_user_model().objects.get(pk=user_id))
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            error = locked = None
+            try:
+                response = request(client, changelist, name, rng, numbers, selected)
+                if response.status_code >= 400:
+                    error = f'HTTP {response.status_code}'
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                locked = isinstance(e, OperationalError) and 'locked' in str(e)
+            result = results[name]
+            result['timings'].append(time.perf_counter() - started)
+            if error:
+                result['errors'][error] += 1
+                result['locked'] += bool(locked)
+    finally:
+        connections.close_all()
+    return results
+
+
+def request(client, changelist, name, rng, numbers, selected):
+    if name == 'changelist':
+        return client.get(changelist, {'p': rng.randint(1, 10)})
+    if name == 'filter':
+        return client.get(changelist, rng.choice(({'state__exact': 1}, {'price_for_app': 'empty'},
+                                                  {'size__exact': 940})))
+    if name == 'csv_filter':
+        content = ('avtomat_number\n' + '\n'.join(map(str, rng.sample(numbers, min(500, len(numbers)))))).encode()
+        response = client.post(changelist, {
+            'csv_file': SimpleUploadedFile('avtomats.csv', content, content_type='text/csv'),
+        })
+        client.get(changelist, {'clear_csv_filter': 1})
+        return response
+    return client.post(changelist, {
+        'action': name, '_selected_action': rng.sample(numbers, selected), 'index': 0,
+    })
+
+
+def summary(result) -> dict:
+    timings = sorted(result['timings'])
+    if not timings:
+        return {'requests': 0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0,
+                'errors': dict(result['errors']), 'locked': result['locked']}
+    return {
+        'requests': len(timings),
+        'p50_ms': round(statistics.median(timings) * 1000, 1),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 1),
+        'max_ms': round(timings[-1] * 1000, 1),
+        'errors': dict(result['errors']),
+        'locked': result['locked'],
+    }
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from server_panel import search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis prefix search index of the Avtomat changelist'
+
+    def handle(self, *args, **options):
+        count = search_index.rebuild()
+        if count is None:
+            self.stdout.write('Another process is rebuilding the search index')
+        else:
+            self.stdout.write(f'Indexed {count} avtomat(s)')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from server_panel import activity
+
+
+class Command(BaseCommand):
+    help = 'Roll up the statistic rows added since the last refresh of the avtomat activity'
+
+    def handle(self, *args, **options):
+        added = activity.refresh()
+        if added is None:
+            self.stdout.write('Another process is refreshing the activity')
+        else:
+            self.stdout.write(f'Rolled up {added} statistic row(s)')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from server_panel import activity, dbrouters, fleet_status, jobs, retries, search_index
+
+
+class Command(BaseCommand):
+    help = 'Run queued avtomat actions (e.g. Set Max Sum), retry busy avtomats and refresh the activity rollup, ' \
+           'the fleet status counts and the search index in a worker process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process at most one job and the due retries and exit')
+        parser.add_argument('--timeout', type=int, default=5, help='Seconds to wait for a job per poll')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Waiting for jobs...')
+        try:
+            while True:
+                # Persistent connections are checked and recycled as between two requests
+                close_old_connections()
+                # Jobs read the avtomats they change, replicas may lag behind
+                with dbrouters.use_primary():
+                    jobs.work(timeout=options['timeout'], once=True)
+                    retries.run_due()
+                activity.refresh_if_due()
+                fleet_status.rebuild_if_due()
+                search_index.rebuild_if_due()
+                if options['once']:
+                    break
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,197 @@
+"""Request metrics in Prometheus format.
+
+``MetricsMiddleware`` collects the SQL queries per database alias, the cache hits and misses
+and the server API calls of a request in a ``RequestStats`` held in a context variable, and
+adds them to histograms and counters when the response is ready. The metrics are aggregated
+in Redis hashes with one pipeline per request, so ``/metrics`` reports all web and worker
+processes. Server API calls made outside a request, e.g. by the job workers, are added to the
+server API histogram directly.
+"""
+import contextvars
+import heapq
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import redis
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Slowest queries kept per request for the slow request log
+TOP_QUERIES = 5
+
+# name: (type, help)
+METRICS = {
+    'vodomat_admin_request_duration_seconds': ('histogram', 'Latency of admin requests by view'),
+    'vodomat_admin_db_duration_seconds': ('histogram', 'Time spent in SQL queries per request by view and database'),
+    'vodomat_admin_db_queries_total': ('counter', 'SQL queries by view and database'),
+    'vodomat_admin_cache_requests_total': ('counter', 'Cache lookups by view and result'),
+    'vodomat_server_api_request_duration_seconds': ('histogram', 'Latency of server API requests by endpoint'),
+    'vodomat_server_api_errors_total': ('counter', 'Failed server API requests by endpoint'),
+}
+
+
+def _key(name: str) -> str:
+    return f'server_panel:metrics:{name}'
+
+
+@dataclass
+class RequestStats:
+    """What one request spent its time on, shared with the threads it starts."""
+    queries: dict[str, list] = field(default_factory=dict)  # alias: [count, seconds]
+    top_queries: list[tuple[float, str, str]] = field(default_factory=list)  # (seconds, alias, sql)
+    cache_hits: int = 0
+    cache_misses: int = 0
+    server_api: list[tuple[str, float, bool]] = field(default_factory=list)  # (endpoint, seconds, error)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_query(self, alias: str, sql: str, seconds: float):
+        with self.lock:
+            totals = self.queries.setdefault(alias, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            item = (seconds, alias, sql)
+            if len(self.top_queries) < TOP_QUERIES:
+                heapq.heappush(self.top_queries, item)
+            elif seconds > self.top_queries[0][0]:
+                heapq.heapreplace(self.top_queries, item)
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_request() -> contextvars.Token:
+    return _current.set(RequestStats())
+
+
+def end_request(token: contextvars.Token):
+    _current.reset(token)
+
+
+def current() -> Optional[RequestStats]:
+    return _current.get()
+
+
+class QueryTimer:
+    """``connection.execute_wrapper`` that adds every query to the current request."""
+
+    def __init__(self, alias: str):
+        self.alias = alias
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats = current()
+            if stats is not None:
+                stats.add_query(self.alias, sql, time.perf_counter() - started)
+
+
+def record_cache(hits: int, misses: int):
+    stats = current()
+    if stats is not None:
+        with stats.lock:
+            stats.cache_hits += hits
+            stats.cache_misses += misses
+
+
+def record_server_api(endpoint: str, seconds: float, error: bool):
+    """Add a server API call to the current request, or straight to the metrics outside a request."""
+    stats = current()
+    if stats is not None:
+        with stats.lock:
+            stats.server_api.append((endpoint, seconds, error))
+        return
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            _observe_server_api(pipe, endpoint, seconds, error)
+            pipe.execute()
+    except redis.RedisError:
+        logger.debug('Server API metrics not recorded', exc_info=True)
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+def _observe(pipe, name: str, labels: str, value: float):
+    key = _key(name)
+    for bucket in BUCKETS:
+        if value <= bucket:
+            pipe.hincrby(key, f'{labels}|{bucket}', 1)
+    pipe.hincrby(key, f'{labels}|+Inf', 1)
+    pipe.hincrbyfloat(key, f'{labels}|sum', value)
+
+
+def _increment(pipe, name: str, labels: str, amount: float = 1):
+    if amount:
+        pipe.hincrbyfloat(_key(name), labels, amount)
+
+
+def _observe_server_api(pipe, endpoint: str, seconds: float, error: bool):
+    labels = _labels(endpoint=endpoint)
+    _observe(pipe, 'vodomat_server_api_request_duration_seconds', labels, seconds)
+    if error:
+        _increment(pipe, 'vodomat_server_api_errors_total', labels)
+
+
+def record_request(view: str, seconds: float, stats: RequestStats):
+    """Add a finished request to the metrics."""
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            _observe(pipe, 'vodomat_admin_request_duration_seconds', _labels(view=view), seconds)
+            for alias, (count, query_seconds) in stats.queries.items():
+                labels = _labels(view=view, database=alias)
+                _observe(pipe, 'vodomat_admin_db_duration_seconds', labels, query_seconds)
+                _increment(pipe, 'vodomat_admin_db_queries_total', labels, count)
+            _increment(pipe, 'vodomat_admin_cache_requests_total', _labels(view=view, result='hit'), stats.cache_hits)
+            _increment(pipe, 'vodomat_admin_cache_requests_total', _labels(view=view, result='miss'),
+                       stats.cache_misses)
+            for endpoint, api_seconds, error in stats.server_api:
+                _observe_server_api(pipe, endpoint, api_seconds, error)
+            pipe.execute()
+    except redis.RedisError:
+        logger.debug('Request metrics not recorded', exc_info=True)
+
+
+def _format_value(value: str) -> str:
+    number = float(value)
+    return str(int(number)) if number.is_integer() else repr(number)
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    r = get_redis()
+    with r.pipeline(transaction=False) as pipe:
+        for name in METRICS:
+            pipe.hgetall(_key(name))
+        values = pipe.execute()
+
+    lines = []
+    for (name, (kind, description)), fields in zip(METRICS.items(), values):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for labels, value in sorted(fields.items()):
+                lines.append(f'{name}{{{labels}}} {_format_value(value)}')
+            continue
+        series = {}
+        for field_name, value in fields.items():
+            labels, suffix = field_name.rsplit('|', 1)
+            series.setdefault(labels, {})[suffix] = value
+        for labels, series_values in sorted(series.items()):
+            for bucket in BUCKETS:
+                lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {series_values.get(str(bucket), 0)}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series_values.get("+Inf", 0)}')
+            lines.append(f'{name}_sum{{{labels}}} {_format_value(series_values.get("sum", 0))}')
+            lines.append(f'{name}_count{{{labels}}} {series_values.get("+Inf", 0)}')
+    return '\n'.join(lines) + '\n'
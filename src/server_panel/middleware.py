@@ -0,0 +1,93 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from . import audit, dbrouters, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware:
+    """Time every request with its SQL queries, cache lookups and server API calls.
+
+    Queries of a streaming response that run after the view returned are not included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = metrics.start_request()
+        stats = metrics.current()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics.QueryTimer(alias)))
+                response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        metrics.record_request(view, duration, stats)
+        if duration >= settings.SLOW_REQUEST_THRESHOLD:
+            self.log_slow_request(request, view, duration, stats)
+        return response
+
+    @staticmethod
+    def log_slow_request(request, view, duration, stats):
+        queries = ', '.join(f'{alias}: {count} in {seconds:.3f}s'
+                            for alias, (count, seconds) in stats.queries.items())
+        top = ''.join(f'\n  {seconds:.3f}s {alias}: {sql[:500]}'
+                      for seconds, alias, sql in sorted(stats.top_queries, reverse=True))
+        logger.warning('Slow request %s %s (%s) took %.3fs; queries %s; cache %d hit(s) %d miss(es); '
+                       '%d server API call(s)%s',
+                       request.method, request.path, view, duration, queries or 'none',
+                       stats.cache_hits, stats.cache_misses, len(stats.server_api), top)
+
+
+class PrimaryStickinessMiddleware:
+    """Keep the reads of a browser on the primary database for a while after it changed something.
+
+    A request that wrote sets a cookie for ``REPLICA_STICKY_SECONDS``; while it is present, the
+    requests of the browser read from the primary instead of a possibly lagging replica.
+    """
+
+    cookie_name = 'server_panel_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = dbrouters.start_request(pinned=self.cookie_name in request.COOKIES)
+        state = dbrouters.current()
+        try:
+            response = self.get_response(request)
+        finally:
+            dbrouters.end_request(token)
+
+        # Safe requests may open a transaction on the primary without writing, e.g. the change form
+        if state.wrote and settings.DATABASE_REPLICAS and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(self.cookie_name, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+class AuditMiddleware:
+    """Hand the admin log entries of a request to the audit writer in one batch after the view returned."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = audit.start_request()
+        try:
+            return self.get_response(request)
+        finally:
+            # Only the entries of committed changes were recorded, also by a view that raised
+            audit.submit(audit.end_request(token))
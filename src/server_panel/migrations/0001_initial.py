@@ -0,0 +1,124 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Avtomat',
+            fields=[
+                ('avtomat_number', models.IntegerField(primary_key=True, serialize=False)),
+                ('house', models.CharField(blank=True, max_length=16, null=True)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('search_radius', models.IntegerField(blank=True, default=300, null=True)),
+                ('price', models.IntegerField(blank=True, null=True)),
+                ('price_for_app', models.IntegerField(blank=True, null=True)),
+                ('visible_in_app', models.BooleanField(blank=True, default=False, null=True, verbose_name='Visible in app')),
+                ('payment_app_url', models.CharField(blank=True, max_length=64, null=True)),
+                ('payment_gateway_name', models.CharField(blank=True, choices=[('portmone', 'Portmone'), ('monobank', 'Monobank')], max_length=64, null=True)),
+                ('payment_gateway_url', models.CharField(blank=True, max_length=64, null=True)),
+                ('max_sum', models.IntegerField(blank=True, null=True)),
+                ('size', models.IntegerField(blank=True, choices=[(470, 'Single'), (940, 'Double'), (471, 'Double/1')], default=470, null=True)),
+                ('competitors', models.IntegerField(blank=True, choices=[(0, 'No'), (1, 'Yes')], default=0, null=True)),
+                ('state', models.IntegerField(blank=True, choices=[(0, 'Undefined'), (1, 'Normal'), (2, 'No Volt'), (3, 'Crashed'), (4, 'Limit')], default=0, null=True)),
+                ('rro_id', models.CharField(blank=True, max_length=9, null=True, verbose_name='RRO ID')),
+                ('security_id', models.CharField(blank=True, max_length=9, null=True, verbose_name='Security ID')),
+                ('security_state', models.IntegerField(blank=True, choices=[(None, 'Undefined'), (1, 'Security ON'), (2, 'Security OFF'), (3, 'No security')], null=True, verbose_name='Security State')),
+            ],
+            options={
+                'db_table': 'avtomat',
+                'ordering': ['avtomat_number'],
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(max_length=32, unique=True)),
+                ('price_type', models.IntegerField(blank=True, choices=[(0, 'Main'), (1, 'Other')], default=0, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'cities',
+                'db_table': 'city',
+                'ordering': ['city'],
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Route',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=16, unique=True, verbose_name='Route Number')),
+                ('car_number', models.CharField(blank=True, max_length=16, null=True, unique=True)),
+                ('driver_1', models.CharField(blank=True, max_length=32, null=True)),
+                ('driver_2', models.CharField(blank=True, max_length=32, null=True)),
+            ],
+            options={
+                'db_table': 'route',
+                'ordering': ['name'],
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Setting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('value', models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'setting',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Statistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+            options={
+                'db_table': 'statistic',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Street',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('street', models.CharField(max_length=64)),
+            ],
+            options={
+                'db_table': 'street',
+                'ordering': ['street'],
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=64, unique=True)),
+                ('last_name', models.CharField(blank=True, max_length=64, null=True)),
+                ('first_name', models.CharField(blank=True, max_length=64, null=True)),
+                ('email', models.CharField(blank=True, max_length=120, null=True)),
+                ('password_hash', models.CharField(max_length=128)),
+                ('permission', models.CharField(choices=[('admin', 'Administrator'), ('operator', 'Operator'), ('driver', 'Driver'), ('api', 'API')], default='operator', max_length=64)),
+                ('city', models.CharField(blank=True, max_length=64, null=True)),
+                ('last_visit', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'user',
+                'ordering': ['username'],
+                'managed': False,
+            },
+        ),
+    ]
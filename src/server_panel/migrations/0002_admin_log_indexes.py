@@ -0,0 +1,35 @@
+from django.db import migrations, models, router
+
+# Indexes of the admin log for the avtomat changes view: by object, by action and by time, each
+# in the order of the keyset pagination (action time, then the implicit id)
+INDEXES = [
+    models.Index(fields=['content_type', 'object_id', 'action_time'], name='admin_log_object_time_idx'),
+    models.Index(fields=['content_type', 'action_flag', 'action_time'], name='admin_log_action_time_idx'),
+    models.Index(fields=['content_type', 'action_time'], name='admin_log_type_time_idx'),
+]
+
+
+def add_indexes(apps, schema_editor):
+    log_entry = apps.get_model('admin', 'LogEntry')
+    if router.allow_migrate_model(schema_editor.connection.alias, log_entry):
+        for index in INDEXES:
+            schema_editor.add_index(log_entry, index)
+
+
+def remove_indexes(apps, schema_editor):
+    log_entry = apps.get_model('admin', 'LogEntry')
+    if router.allow_migrate_model(schema_editor.connection.alias, log_entry):
+        for index in INDEXES:
+            schema_editor.remove_index(log_entry, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin', '0003_logentry_add_action_flag_choices'),
+        ('server_panel', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_indexes, remove_indexes),
+    ]
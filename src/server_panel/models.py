@@ -71,7 +71,11 @@ class Street(models.Model):
         ordering = ['street']
 
     def __str__(self):
-        return f'{self.street}' + (f' ({self.city})' if self.city.city != 'Харків м.' else '')
+        return self.label(self.street, self.city.city if self.city else None)
+
+    @staticmethod
+    def label(street: str, city: str | None) -> str:
+        return f'{street}' + (f' ({city})' if city is not None and city != 'Харків м.' else '')
 
 
 class Avtomat(models.Model):
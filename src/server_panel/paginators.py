@@ -0,0 +1,92 @@
+"""Paginator for the Avtomat changelist.
+
+Counts are cached, so a page does not run ``COUNT(*)`` over the changelist join on every
+request, and pages ordered by ``avtomat_number`` are fetched with a seek condition
+(``avtomat_number > last number of the previous page``) instead of ``OFFSET``.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Paginator
+from django.utils.functional import cached_property
+
+VERSION_KEY = 'server_panel:paginator:version'
+
+# Seconds the count of the whole table and of a filtered changelist are cached
+TOTAL_COUNT_TIMEOUT = 300
+FILTERED_COUNT_TIMEOUT = 30
+
+# Seconds the first avtomat number of a page is remembered
+BOUNDARY_TIMEOUT = 60
+
+
+def invalidate():
+    """Forget cached counts and page boundaries, e.g. after avtomats were added or deleted."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+class KeysetPaginator(Paginator):
+    key_field = 'avtomat_number'
+
+    @cached_property
+    def _cache_prefix(self) -> str:
+        version = cache.get_or_set(VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+        sql, params = self.object_list.query.sql_with_params()
+        digest = hashlib.md5(repr((self.object_list.db, sql, params)).encode()).hexdigest()
+        return f'server_panel:paginator:{version}:{digest}'
+
+    @cached_property
+    def count(self) -> int:
+        unfiltered = not self.object_list.query.where
+        timeout = TOTAL_COUNT_TIMEOUT if unfiltered else FILTERED_COUNT_TIMEOUT
+        return cache.get_or_set(f'{self._cache_prefix}:count', self.object_list.count, timeout)
+
+    def _direction(self):
+        """Return '' or '-' when the list is ordered by the key field only, otherwise None."""
+        ordering = self.object_list.query.order_by
+        if len(ordering) != 1:
+            return None
+        field = ordering[0]
+        descending = field.startswith('-')
+        if field.lstrip('-') not in (self.key_field, 'pk'):
+            return None
+        return '-' if descending else ''
+
+    def page(self, number):
+        number = self.validate_number(number)
+        direction = self._direction()
+        if direction is None or number == 1:
+            page = super().page(number)
+        else:
+            page = self._page_after(number, self._boundary(number, direction), direction)
+        self._remember_next_boundary(page, direction)
+        return page
+
+    def _boundary(self, number: int, direction: str):
+        """Return the last key of the previous page, from the cache or with a key-only offset query."""
+        boundary = cache.get(f'{self._cache_prefix}:page:{number}')
+        if boundary is None:
+            keys = self.object_list.values_list(self.key_field, flat=True)
+            bottom = (number - 1) * self.per_page
+            try:
+                boundary = keys[bottom - 1]
+            except IndexError:
+                # The cached count is stale, e.g. avtomats were deleted by the server: forget it, the
+                # admin then redirects to the first page, which counts again
+                cache.delete(f'{self._cache_prefix}:count')
+                raise EmptyPage('That page contains no results')
+        return boundary
+
+    def _page_after(self, number: int, boundary, direction: str):
+        lookup = f'{self.key_field}__lt' if direction else f'{self.key_field}__gt'
+        object_list = self.object_list.filter(**{lookup: boundary})[:self.per_page]
+        return self._get_page(object_list, number, self)
+
+    def _remember_next_boundary(self, page, direction):
+        if direction is None or not page.has_next():
+            return
+        objects = list(page.object_list)
+        if objects:
+            cache.set(f'{self._cache_prefix}:page:{page.number + 1}',
+                      getattr(objects[-1], self.key_field), BOUNDARY_TIMEOUT)
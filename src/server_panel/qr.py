@@ -0,0 +1,74 @@
+"""QR codes of the app links of avtomats.
+
+Images are generated locally with segno and cached by avtomat number; the image of a number
+never changes. Batches render the cache misses in a process pool, since encoding and PNG
+compression are CPU bound.
+"""
+import io
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import segno
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+APP_URL = 'https://app.roganska.com?vodomat_id={}'
+
+# Seconds a rendered image is cached
+TIMEOUT = 30 * 24 * 3600
+
+# Cache misses rendered in the request process instead of a process pool
+INLINE_LIMIT = 20
+
+# Pixels per QR module of the PNG images
+SCALE = 10
+
+
+def _key(avtomat_number: int) -> str:
+    return f'server_panel:qr:{avtomat_number}'
+
+
+def render_png(avtomat_number: int) -> bytes:
+    """Render the QR code of an avtomat as PNG, runs in the pool processes."""
+    buffer = io.BytesIO()
+    segno.make(APP_URL.format(avtomat_number), error='m').save(buffer, kind='png', scale=SCALE, border=2)
+    return buffer.getvalue()
+
+
+def get_png(avtomat_number: int) -> bytes:
+    return get_pngs([avtomat_number])[avtomat_number]
+
+
+def get_pngs(avtomat_numbers: list[int]) -> dict[int, bytes]:
+    """Return the QR images of many avtomats, rendering the cache misses in parallel."""
+    cached = cache.get_many([_key(number) for number in avtomat_numbers])
+    images = {number: cached[_key(number)] for number in avtomat_numbers if _key(number) in cached}
+    missing = [number for number in avtomat_numbers if number not in images]
+    if not missing:
+        return images
+
+    if len(missing) <= INLINE_LIMIT:
+        rendered = [render_png(number) for number in missing]
+    else:
+        # Spawned processes, forking a threaded web worker is not safe
+        workers = min(settings.QR_PROCESSES, len(missing))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+            rendered = list(executor.map(render_png, missing, chunksize=max(1, len(missing) // (workers * 4))))
+    images.update(zip(missing, rendered))
+    cache.set_many({_key(number): image for number, image in zip(missing, rendered)}, TIMEOUT)
+    return images
+
+
+def stickers_zip(avtomat_numbers: list[int]) -> bytes:
+    """Build a ZIP with the QR image of every avtomat and a printable sticker sheet."""
+    images = get_pngs(avtomat_numbers)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for number in avtomat_numbers:
+            archive.writestr(f'qr/{number}.png', images[number])
+        archive.writestr('stickers.html', render_to_string('admin/server_panel/avtomat/qr_stickers.html', {
+            'avtomat_numbers': avtomat_numbers,
+        }))
+    return buffer.getvalue()
@@ -0,0 +1,14 @@
+from typing import Optional
+
+import redis
+from django.conf import settings
+
+_pool: Optional[redis.ConnectionPool] = None
+
+
+def get_redis() -> redis.Redis:
+    """Return a client for the Redis server that also backs the cache."""
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool.from_url(settings.REDIS_URL, decode_responses=True)
+    return redis.Redis(connection_pool=_pool)
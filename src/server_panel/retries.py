@@ -0,0 +1,235 @@
+"""Persistent retry queue for avtomats that were busy when an action pushed a parameter.
+
+Each busy avtomat gets a Redis hash with the action parameters and its attempt history,
+and a member in the ``due`` sorted set scored by the time of its next attempt. Attempts are
+spaced by exponential backoff with jitter until the avtomat accepts the parameter or the
+maximum number of attempts is reached; an attempt that fails, e.g. because the vodomat server
+is down, counts like one that found the avtomat busy. A newer action for the same avtomat replaces the
+pending retry and starts counting attempts again.
+"""
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import jobs
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = 'server_panel:retries:due'
+ALL_KEY = 'server_panel:retries:all'
+
+PENDING = 'pending'
+SUCCEEDED = 'succeeded'
+GAVE_UP = 'gave up'
+
+# Seconds a claimed retry stays hidden from other workers while it is processed
+CLAIM_TIMEOUT = 600
+
+# Seconds finished retries stay visible in the admin
+FINISHED_TTL = 24 * 3600
+
+
+def _member(action: str, avtomat_number: int) -> str:
+    return f'{action}:{avtomat_number}'
+
+
+def _key(member: str) -> str:
+    return f'server_panel:retries:{member}'
+
+
+def backoff(attempts: int) -> float:
+    """Delay before the next attempt: exponential in the attempts made, with equal jitter."""
+    delay = min(settings.RETRY_MAX_DELAY, settings.RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def record_results(action: str, job: dict, result):
+    """Schedule busy avtomats for a retry and close the retries of avtomats that accepted.
+
+    A failed attempt of a pending retry counts as an attempt, failures of a new action are not retried.
+    """
+    _record(action, job, busy=result.busy, succeeded=result.succeeded, failed=result.failed)
+
+
+def _record(action: str, job: dict, busy=(), succeeded=(), failed=()):
+    r = get_redis()
+    now = time.time()
+    params = json.dumps(job['params'], sort_keys=True)
+    numbers = list(busy) + list(succeeded) + list(failed)
+    if not numbers:
+        return
+
+    with r.pipeline() as pipe:
+        for number in numbers:
+            pipe.hmget(_key(_member(action, number)), 'status', 'params', 'attempts', 'history')
+        existing = dict(zip(numbers, pipe.execute()))
+
+    def is_pending(number):
+        status, old_params, _, _ = existing[number]
+        return status == PENDING and old_params == params
+
+    attempts_made = [(number, 'busy') for number in busy] + \
+                    [(number, 'failed') for number in failed if is_pending(number)]
+    with r.pipeline() as pipe:
+        for number, outcome in attempts_made:
+            member = _member(action, number)
+            _, _, attempts, history = existing[number]
+            if is_pending(number):
+                attempts = int(attempts) + 1
+                history = json.loads(history)
+            else:
+                attempts, history = 1, []
+            history.append({'time': now, 'result': outcome})
+            entry = {
+                'action': action,
+                'avtomat_number': number,
+                'user_id': job['user_id'],
+                'params': params,
+                'attempts': attempts,
+                'history': json.dumps(history),
+                'updated': now,
+            }
+            if attempts >= settings.RETRY_MAX_ATTEMPTS:
+                entry.update(status=GAVE_UP, next_attempt='')
+                pipe.zrem(DUE_KEY, member)
+                pipe.hset(_key(member), mapping=entry)
+                pipe.expire(_key(member), FINISHED_TTL)
+            else:
+                next_attempt = now + backoff(attempts)
+                entry.update(status=PENDING, next_attempt=next_attempt)
+                pipe.zadd(DUE_KEY, {member: next_attempt})
+                pipe.hset(_key(member), mapping=entry)
+                pipe.persist(_key(member))
+            pipe.zadd(ALL_KEY, {member: now})
+
+        for number in succeeded:
+            status, _, _, history = existing[number]
+            if status != PENDING:
+                continue
+            member = _member(action, number)
+            history = json.loads(history) + [{'time': now, 'result': 'succeeded'}]
+            pipe.zrem(DUE_KEY, member)
+            pipe.hset(_key(member), mapping={'status': SUCCEEDED, 'next_attempt': '',
+                                             'history': json.dumps(history), 'updated': now})
+            pipe.expire(_key(member), FINISHED_TTL)
+            pipe.zadd(ALL_KEY, {member: now})
+        pipe.execute()
+
+
+def _claim_key(member: str) -> str:
+    return f'server_panel:retries:claim:{member}'
+
+
+def _claim_due(limit: int) -> list[str]:
+    """Claim due retries for this worker, each one by a single worker.
+
+    A claim is a ``SET NX`` key per retry. The score is read again once the key is held: a
+    worker that read the member before another one retried and rescheduled it finds it no
+    longer due. Claimed retries are hidden for ``CLAIM_TIMEOUT`` seconds, so those of a
+    worker that died become due again.
+    """
+    r = get_redis()
+    now = time.time()
+    members = r.zrangebyscore(DUE_KEY, '-inf', now, start=0, num=limit)
+    if not members:
+        return []
+    with r.pipeline(transaction=False) as pipe:
+        for member in members:
+            pipe.set(_claim_key(member), now, nx=True, ex=CLAIM_TIMEOUT)
+            pipe.zscore(DUE_KEY, member)
+        results = pipe.execute()
+
+    claimed, released = [], []
+    for member, held, score in zip(members, results[::2], results[1::2]):
+        if not held:
+            continue
+        if score is None or score > now:
+            released.append(member)
+        else:
+            claimed.append(member)
+    with r.pipeline() as pipe:
+        for member in claimed:
+            pipe.zadd(DUE_KEY, {member: now + CLAIM_TIMEOUT})
+        if released:
+            pipe.delete(*map(_claim_key, released))
+        pipe.execute()
+    return claimed
+
+
+def run_due(limit: int = 500) -> int:
+    """Retry the avtomats whose next attempt is due, return how many were retried."""
+    r = get_redis()
+    claimed = _claim_due(limit)
+    if not claimed:
+        return 0
+    try:
+        _run(r, claimed)
+    finally:
+        # Retried and rescheduled, the next due attempt may be claimed again
+        r.delete(*map(_claim_key, claimed))
+    return len(claimed)
+
+
+def _run(r, claimed: list[str]):
+    with r.pipeline() as pipe:
+        for member in claimed:
+            pipe.hmget(_key(member), 'action', 'avtomat_number', 'user_id', 'params')
+        entries = pipe.execute()
+
+    # One handler call per action and parameters, like the job that scheduled them
+    groups = defaultdict(list)
+    for member, (action, number, user_id, params) in zip(claimed, entries):
+        if action is None:
+            r.zrem(DUE_KEY, member)
+            continue
+        groups[(action, int(user_id), params)].append(int(number))
+
+    for (action, user_id, params), numbers in groups.items():
+        handler = jobs.get_handler(action)
+        if handler is None:
+            logger.error('No handler for retried action %s', action)
+            continue
+        close_old_connections()
+        try:
+            handler({'user_id': user_id, 'params': json.loads(params)}, numbers)
+        except Exception:
+            logger.exception('Retrying %s for avtomats %s failed', action, numbers)
+            _record(action, {'params': json.loads(params), 'user_id': user_id}, failed=numbers)
+
+
+def _datetime(timestamp) -> datetime:
+    return datetime.fromtimestamp(float(timestamp), tz=timezone.utc)
+
+
+def list_retries(limit: int = 500) -> list[dict]:
+    """Return pending and recently finished retries, most recently updated first."""
+    r = get_redis()
+    members = r.zrevrange(ALL_KEY, 0, limit - 1)
+    with r.pipeline() as pipe:
+        for member in members:
+            pipe.hgetall(_key(member))
+        entries = pipe.execute()
+
+    retries, expired = [], []
+    for member, entry in zip(members, entries):
+        if not entry:
+            expired.append(member)
+            continue
+        entry['avtomat_number'] = int(entry['avtomat_number'])
+        entry['attempts'] = int(entry['attempts'])
+        entry['params'] = json.loads(entry['params'])
+        entry['history'] = [{'time': _datetime(attempt['time']), 'result': attempt['result']}
+                            for attempt in json.loads(entry['history'])]
+        entry['next_attempt'] = _datetime(entry['next_attempt']) if entry['next_attempt'] else None
+        entry['updated'] = _datetime(entry['updated'])
+        retries.append(entry)
+    if expired:
+        r.zrem(ALL_KEY, *expired)
+    return retries
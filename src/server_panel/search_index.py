@@ -0,0 +1,170 @@
+"""Prefix search index for the Avtomat changelist.
+
+Every avtomat is indexed under the normalized words of its street name, its house, number,
+RRO ID and security ID. Terms are members ``<term>\\x00<avtomat_number>`` of one Redis sorted
+set with equal scores, so a prefix lookup is a ZRANGEBYLEX range scan. Like the admin search,
+every word of a query has to match (a prefix of) one of the fields.
+
+Admin changes re-index their avtomats; the job workers rebuild the whole index every
+``SEARCH_INDEX_REFRESH_INTERVAL`` seconds for avtomats the vodomat server added or changed.
+"""
+import json
+import re
+import time
+import uuid
+from collections.abc import Iterable
+from typing import Optional
+
+from django.conf import settings
+
+from . import dbrouters
+from .models import Avtomat
+from .redis_client import get_redis
+
+TERMS_KEY = 'server_panel:search:terms'
+MEMBERS_KEY = 'server_panel:search:members'
+REFRESHED_KEY = 'server_panel:search:refreshed'
+LOCK_KEY = 'server_panel:search:lock'
+
+# Seconds one rebuild may take before another process may start rebuilding
+LOCK_TIMEOUT = 600
+
+# More hits than this for one word and the search falls back to the database
+MAX_HITS = 5000
+
+_SEPARATORS = re.compile(r'[\s.,;:/\\"\'()-]+')
+
+
+def normalize(text) -> list[str]:
+    """Split a value into lower-case words without punctuation."""
+    if text is None:
+        return []
+    return [word for word in _SEPARATORS.split(str(text).casefold()) if word]
+
+
+def _members(avtomat_number: int, street: Optional[str], house: Optional[str],
+             rro_id: Optional[str], security_id: Optional[str]) -> list[str]:
+    terms = set(normalize(street)) | set(normalize(house)) | {str(avtomat_number)}
+    terms |= set(normalize(rro_id)) | set(normalize(security_id))
+    return [f'{term}\x00{avtomat_number}' for term in sorted(terms)]
+
+
+def _rows(queryset) -> Iterable[tuple]:
+    return queryset.values_list('avtomat_number', 'street__street', 'house', 'rro_id', 'security_id') \
+                   .iterator(chunk_size=2000)
+
+
+def is_built() -> bool:
+    return bool(get_redis().exists(MEMBERS_KEY))
+
+
+def rebuild() -> Optional[int]:
+    """Index all avtomats into temporary keys and swap them in, return the number indexed.
+
+    Returns None when another process is rebuilding.
+    """
+    r = get_redis()
+    if not r.set(LOCK_KEY, 1, nx=True, ex=LOCK_TIMEOUT):
+        return None
+    try:
+        with dbrouters.bind(dbrouters.current()):
+            return _rebuild(r)
+    finally:
+        r.delete(LOCK_KEY)
+
+
+def _rebuild(r) -> int:
+    # Keys of this run, a rebuild that outlived its lock does not write into those of the next one
+    run = uuid.uuid4().hex
+    tmp_terms, tmp_members = f'{TERMS_KEY}:tmp:{run}', f'{MEMBERS_KEY}:tmp:{run}'
+    try:
+        count = 0
+        pipe = r.pipeline(transaction=False)
+        for row in _rows(Avtomat.objects.all()):
+            members = _members(*row)
+            pipe.zadd(tmp_terms, dict.fromkeys(members, 0))
+            pipe.hset(tmp_members, row[0], json.dumps(members))
+            count += 1
+            if count % 1000 == 0:
+                pipe.execute()
+        # Keeps the members hash present, which marks the index as built, also for an empty fleet
+        pipe.hset(tmp_members, '', '[]')
+        pipe.execute()
+
+        has_terms = r.exists(tmp_terms)
+        with r.pipeline() as pipe:
+            if has_terms:
+                pipe.rename(tmp_terms, TERMS_KEY)
+            else:
+                pipe.delete(TERMS_KEY)
+            pipe.rename(tmp_members, MEMBERS_KEY)
+            pipe.set(REFRESHED_KEY, time.time())
+            pipe.execute()
+    finally:
+        # Left over when the build failed
+        r.delete(tmp_terms, tmp_members)
+    return count
+
+
+def rebuild_if_due() -> Optional[int]:
+    """Rebuild when the last rebuild is older than the refresh interval."""
+    refreshed = get_redis().get(REFRESHED_KEY)
+    if refreshed is not None and time.time() - float(refreshed) < settings.SEARCH_INDEX_REFRESH_INTERVAL:
+        return None
+    return rebuild()
+
+
+def update(avtomat_numbers: Iterable[int]):
+    """Re-index the given avtomats, removing those that no longer exist."""
+    avtomat_numbers = list(avtomat_numbers)
+    if not avtomat_numbers or not is_built():
+        return
+    r = get_redis()
+    old = dict(zip(avtomat_numbers, r.hmget(MEMBERS_KEY, avtomat_numbers)))
+    rows = {row[0]: row for row in _rows(Avtomat.objects.filter(avtomat_number__in=avtomat_numbers))}
+    with r.pipeline() as pipe:
+        for number in avtomat_numbers:
+            if old[number]:
+                old_members = json.loads(old[number])
+                if old_members:
+                    pipe.zrem(TERMS_KEY, *old_members)
+            if number in rows:
+                members = _members(*rows[number])
+                pipe.zadd(TERMS_KEY, dict.fromkeys(members, 0))
+                pipe.hset(MEMBERS_KEY, number, json.dumps(members))
+            else:
+                pipe.hdel(MEMBERS_KEY, number)
+        pipe.execute()
+
+
+def update_streets(street_ids: Iterable[int]):
+    """Re-index the avtomats on the given streets, e.g. after a street was renamed."""
+    update(Avtomat.objects.filter(street_id__in=list(street_ids)).values_list('avtomat_number', flat=True))
+
+
+def _prefix_hits(word: str) -> Optional[set[int]]:
+    prefix = word.encode()
+    members = get_redis().zrangebylex(TERMS_KEY, b'[' + prefix, b'[' + prefix + b'\xff', start=0, num=MAX_HITS + 1)
+    if len(members) > MAX_HITS:
+        return None
+    return {int(member.rsplit('\x00', 1)[1]) for member in members}
+
+
+def search(search_term: str) -> Optional[set[int]]:
+    """Return the avtomat numbers matching every word of the term by prefix.
+
+    Returns None when the index cannot answer: it is not built, the term has no words, or a
+    word is too common.
+    """
+    words = normalize(search_term)
+    if not words or not is_built():
+        return None
+    numbers = None
+    for word in words:
+        hits = _prefix_hits(word)
+        if hits is None:
+            return None
+        numbers = hits if numbers is None else numbers & hits
+        if not numbers:
+            break
+    return numbers
@@ -0,0 +1,287 @@
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+
+class ServerAPIError(Exception):
+    """The server API could not be reached or answered with a server error."""
+
+
+class CircuitOpenError(ServerAPIError):
+    """The circuit breaker is open, the request was not sent."""
+
+
+class CircuitBreaker:
+    """Fail fast after consecutive failures, let one trial request through after a cool-down."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class ServerAPIClient:
+    """Client for the vodomat server API.
+
+    Keeps one pooled keep-alive session per process. Both endpoints are safe to repeat
+    (``/api_key`` only reads, ``/param`` sets the same value again), so POST requests are
+    retried with backoff on connection errors and gateway responses.
+
+    The API key is shared by all processes through the cache. Only the holder of the
+    refresh lock requests a new key, and the key is renewed in the background before it
+    expires, so requests do not wait for ``/api_key`` while a valid key exists.
+    """
+
+    API_KEY_CACHE_KEY = 'server_api:api_key'
+    API_KEY_LOCK_KEY = 'server_api:api_key:lock'
+    API_KEY_FAILED_KEY = 'server_api:api_key:failed'
+    API_KEY_TTL = 3600
+    API_KEY_REFRESH_AHEAD = 300
+    API_KEY_FAILURE_TTL = 30
+    API_KEY_LOCK_TIMEOUT = 60
+    API_KEY_WAIT_INTERVAL = 0.1
+
+    def __init__(self, base_url: str, secure_header: str, username: str, password: str,
+                 connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 2, backoff_factor: float = 0.3, pool_size: int = 10,
+                 failure_threshold: int = 5, reset_timeout: float = 30):
+        self.base_url = (base_url or '').rstrip('/')
+        self.secure_header = secure_header
+        self.username = username
+        self.password = password
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._session: Optional[requests.Session] = None
+        self._session_pid: Optional[int] = None
+        self._session_lock = threading.Lock()
+        self._stats: dict[str, dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+        self._background_refresh: Optional[threading.Thread] = None
+
+    @property
+    def session(self) -> requests.Session:
+        """The pooled session, recreated after a fork so workers never share sockets."""
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._session_lock:
+                if self._session is None or self._session_pid != pid:
+                    self._session = self._build_session()
+                    self._session_pid = pid
+        return self._session
+
+    def _build_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _post(self, endpoint: str, **kwargs) -> requests.Response:
+        if not self.breaker.allow_request():
+            self._record(endpoint, 0.0, error=True)
+            raise CircuitOpenError(f'Server API circuit is open, {endpoint} was not requested')
+
+        started = time.perf_counter()
+        try:
+            response = self.session.post(f'{self.base_url}{endpoint}', timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            self._record(endpoint, time.perf_counter() - started, error=True)
+            raise ServerAPIError(f'Server API request to {endpoint} failed: {e}') from e
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            self._record(endpoint, time.perf_counter() - started, error=True)
+            raise ServerAPIError(f'Server API request to {endpoint} failed with {response.status_code}')
+
+        self.breaker.record_success()
+        self._record(endpoint, time.perf_counter() - started)
+        return response
+
+    def _record(self, endpoint: str, duration: float, error: bool = False):
+        metrics.record_server_api(endpoint, duration, error)
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {'count': 0, 'errors': 0, 'total_seconds': 0.0,
+                                                      'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['total_seconds'] += duration
+            stats['max_seconds'] = max(stats['max_seconds'], duration)
+
+    def latency_stats(self) -> dict[str, dict[str, float]]:
+        """Request count, error count, total and max latency per endpoint in this process."""
+        with self._stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def get_api_key(self) -> Optional[str]:
+        """Return the cached API key, requesting a new one only when there is none."""
+        entry = cache.get(self.API_KEY_CACHE_KEY)
+        if entry is not None:
+            if time.time() >= entry['refresh_at']:
+                self._refresh_api_key_in_background()
+            return entry['api_key']
+        if cache.get(self.API_KEY_FAILED_KEY):
+            return None
+        return self.refresh_api_key(wait=True)
+
+    def refresh_api_key(self, wait: bool = False) -> Optional[str]:
+        """Request a new API key unless another process is already doing it.
+
+        With ``wait`` a caller that lost the race waits for the winner's key.
+        """
+        token = uuid.uuid4().hex
+        if not cache.add(self.API_KEY_LOCK_KEY, token, timeout=self.API_KEY_LOCK_TIMEOUT):
+            return self._wait_for_api_key() if wait else None
+        try:
+            return self._request_api_key()
+        finally:
+            if cache.get(self.API_KEY_LOCK_KEY) == token:
+                cache.delete(self.API_KEY_LOCK_KEY)
+
+    def _request_api_key(self) -> Optional[str]:
+        credentials = {'username': self.username, 'password': self.password}
+        try:
+            response = self._post('/api_key', data=credentials)
+        except ServerAPIError:
+            cache.set(self.API_KEY_FAILED_KEY, True, timeout=self.API_KEY_FAILURE_TTL)
+            raise
+        try:
+            api_key = response.json().get('api_key') if response.status_code == 200 else None
+        except ValueError as e:
+            cache.set(self.API_KEY_FAILED_KEY, True, timeout=self.API_KEY_FAILURE_TTL)
+            raise ServerAPIError(f'Server API answered the key request with a body that is not JSON: {e}') from e
+        if api_key is None:
+            cache.set(self.API_KEY_FAILED_KEY, True, timeout=self.API_KEY_FAILURE_TTL)
+            return None
+        entry = {'api_key': api_key, 'refresh_at': time.time() + self.API_KEY_TTL - self.API_KEY_REFRESH_AHEAD}
+        cache.set(self.API_KEY_CACHE_KEY, entry, timeout=self.API_KEY_TTL)
+        cache.delete(self.API_KEY_FAILED_KEY)
+        return api_key
+
+    def _wait_for_api_key(self) -> Optional[str]:
+        deadline = time.monotonic() + self.API_KEY_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(self.API_KEY_WAIT_INTERVAL)
+            entry = cache.get(self.API_KEY_CACHE_KEY)
+            if entry is not None:
+                return entry['api_key']
+            if cache.get(self.API_KEY_FAILED_KEY) or cache.get(self.API_KEY_LOCK_KEY) is None:
+                return None
+        return None
+
+    def _refresh_api_key_in_background(self):
+        with self._session_lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = threading.Thread(target=self._refresh_quietly, daemon=True)
+            self._background_refresh.start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh_api_key()
+        except ServerAPIError:
+            pass  # The current key stays valid until its TTL, the next request tries again
+
+    def set_param(self, avtomat_number: int, param: str) -> Optional[int]:
+        """Send a parameter setting request for a given avtomat, return its number if it is busy."""
+        api_key = self.get_api_key()
+        if api_key is None:
+            raise ServerAPIError('Server API key is not available')
+        request_body = {'avtomat_number': avtomat_number, 'param': param}
+        headers = {self.secure_header: api_key}
+        response = self._post('/param', json=request_body, headers=headers)
+        if response.status_code == 200:
+            try:
+                return response.json().get('avtomat_number')
+            except ValueError as e:
+                raise ServerAPIError(f'Server API answered the parameter of avtomat {avtomat_number} '
+                                     f'with a body that is not JSON: {e}') from e
+        return None
+
+
+_client: Optional[ServerAPIClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ServerAPIClient:
+    """Return the process-wide server API client."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ServerAPIClient(
+                    base_url=os.getenv('SERVER_API_URL'),
+                    secure_header=os.getenv('SERVER_API_SECURE_HEADERS'),
+                    username=os.getenv('SERVER_API_USER'),
+                    password=os.getenv('SERVER_API_PASSWORD'),
+                    connect_timeout=settings.SERVER_API_CONNECT_TIMEOUT,
+                    read_timeout=settings.SERVER_API_READ_TIMEOUT,
+                    retries=settings.SERVER_API_RETRIES,
+                    backoff_factor=settings.SERVER_API_BACKOFF_FACTOR,
+                    pool_size=settings.SERVER_API_MAX_WORKERS,
+                    failure_threshold=settings.SERVER_API_CIRCUIT_FAILURE_THRESHOLD,
+                    reset_timeout=settings.SERVER_API_CIRCUIT_RESET_TIMEOUT,
+                )
+    return _client
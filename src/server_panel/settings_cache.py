@@ -0,0 +1,49 @@
+"""Cached values of the ``setting`` table.
+
+The whole table is loaded with one query and stored in the cache under a versioned key, and
+each process keeps its own copy for the current version. Reading a setting costs one cache
+lookup of the version and no database query. Saving or deleting a setting through the admin
+bumps the version, so every process reloads on its next read.
+"""
+import time
+import uuid
+from typing import Optional
+
+from django.core.cache import cache
+
+from .models import Setting
+
+VERSION_KEY = 'server_panel:settings:version'
+
+# Seconds after which the values are reloaded even without a new version,
+# picks up changes made to the table outside the admin
+TTL = 300
+
+_local = {'version': None, 'loaded': 0.0, 'values': {}}
+
+
+def _values_key(version: str) -> str:
+    return f'server_panel:settings:values:{version}'
+
+
+def get_settings() -> dict[str, Optional[int]]:
+    """Return all settings as a name to value dict."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+
+    if _local['version'] == version and time.monotonic() - _local['loaded'] < TTL:
+        return _local['values']
+
+    values = cache.get(_values_key(version))
+    if values is None:
+        values = dict(Setting.objects.values_list('name', 'value'))
+        cache.set(_values_key(version), values, timeout=TTL)
+    _local.update(version=version, loaded=time.monotonic(), values=values)
+    return values
+
+
+def invalidate():
+    """Make every process reload the settings on its next read."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
@@ -0,0 +1,9 @@
+from django.contrib import admin
+
+from .views import StreetAutocompleteJsonView
+
+
+class ServerAdminSite(admin.AdminSite):
+
+    def autocomplete_view(self, request):
+        return StreetAutocompleteJsonView.as_view(admin_site=self)(request)
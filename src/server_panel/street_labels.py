@@ -0,0 +1,41 @@
+"""Display labels of all streets, kept in a Redis hash (street id -> label).
+
+The hash is built with one query and dropped when a street or city is changed through the
+admin, so showing many streets never needs a city query per street.
+"""
+from collections.abc import Iterable
+
+from .models import Street
+from .redis_client import get_redis
+
+KEY = 'server_panel:street_labels'
+TIMEOUT = 24 * 3600
+
+
+def rebuild() -> dict[int, str]:
+    labels = {pk: Street.label(street, city)
+              for pk, street, city in Street.objects.values_list('pk', 'street', 'city__city')}
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.delete(KEY)
+        if labels:
+            pipe.hset(KEY, mapping=labels)
+            pipe.expire(KEY, TIMEOUT)
+        pipe.execute()
+    return labels
+
+
+def get_labels(street_ids: Iterable[int]) -> dict[int, str]:
+    """Return the labels of the given streets, building the map when it is missing."""
+    street_ids = list(street_ids)
+    if not street_ids:
+        return {}
+    labels = dict(zip(street_ids, get_redis().hmget(KEY, street_ids)))
+    if any(label is None for label in labels.values()):
+        all_labels = rebuild()
+        labels = {pk: all_labels.get(pk) for pk in street_ids}
+    return {pk: label for pk, label in labels.items() if label is not None}
+
+
+def invalidate():
+    get_redis().delete(KEY)
@@ -0,0 +1,237 @@
+"""Synthetic fleet for benchmarks and tests.
+
+The server tables are not managed by Django migrations, so ``create_schema`` creates them from
+the models on a local database. ``seed`` fills them with a reproducible fleet of the given size:
+cities, streets, routes, users, avtomats with realistic gaps in their numbers, statistic rows and
+the settings read by the admin actions. ``StubServerAPI`` answers the server API endpoints in a
+thread, so actions run without a real server.
+"""
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections, router
+
+from .models import Avtomat, City, Route, Setting, Statistic, Street, User
+
+DEFAULT_CITY = 'Харків м.'
+
+# Rows inserted by one INSERT statement while seeding
+BATCH_SIZE = 2000
+
+SETTINGS = {
+    'avtomat_max_sum': 5000,
+    'avtomat_price': 150,
+    'avtomat_price_for_app': 140,
+}
+
+STREET_TYPES = ('вул.', 'просп.', 'пров.', "в'їзд", 'пл.')
+
+
+def _server_alias() -> str:
+    return router.db_for_write(Avtomat)
+
+
+def _server_models() -> list:
+    return list(apps.get_app_config('server_panel').get_models())
+
+
+def check_local(using: str = None):
+    """Refuse to touch anything but a local SQLite server database."""
+    connection = connections[using or _server_alias()]
+    if connection.vendor != 'sqlite':
+        raise RuntimeError(f'The synthetic fleet needs a SQLite "{connection.alias}" database, '
+                           f'not {connection.vendor}.')
+
+
+def create_schema(using: str = None):
+    """Create the tables of the server models, dropping the existing ones."""
+    using = using or _server_alias()
+    check_local(using)
+    connection = connections[using]
+    existing = set(connection.introspection.table_names())
+    with connection.schema_editor() as schema_editor:
+        for model in reversed(_server_models()):
+            if model._meta.db_table in existing:
+                schema_editor.delete_model(model)
+        for model in _server_models():
+            schema_editor.create_model(model)
+
+
+def seed(avtomats: int = 50000, streets: int = 5000, routes: int = 200, cities: int = 20, users: int = 20,
+         statistic_per_avtomat: int = 2, random_seed: int = 1) -> dict:
+    """Fill the empty server tables with a synthetic fleet, return the number of rows per table."""
+    check_local()
+    rng = random.Random(random_seed)
+
+    city_objs = [City(id=1, city=DEFAULT_CITY, price_type=0)]
+    city_objs += [City(id=i, city=f'Місто {i}', price_type=rng.choice((0, 1))) for i in range(2, cities + 1)]
+    City.objects.bulk_create(city_objs, batch_size=BATCH_SIZE)
+
+    # Most streets are in the main city
+    street_objs = [
+        Street(id=i, street=f'{rng.choice(STREET_TYPES)} Вулиця {i}',
+               city_id=1 if rng.random() < 0.7 else rng.randint(2, cities) if cities > 1 else 1)
+        for i in range(1, streets + 1)
+    ]
+    Street.objects.bulk_create(street_objs, batch_size=BATCH_SIZE)
+
+    route_objs = [
+        Route(id=i, name=str(i), car_number=f'AX{i:04d}XA', driver_1=f'Driver {i}',
+              driver_2=f'Driver {i + routes}' if i % 3 == 0 else None)
+        for i in range(1, routes + 1)
+    ]
+    Route.objects.bulk_create(route_objs, batch_size=BATCH_SIZE)
+
+    # Numbers with gaps, as left by decommissioned avtomats
+    numbers = sorted(rng.sample(range(1, int(avtomats * 1.2) + 1), avtomats))
+    avtomat_objs = []
+    for number in numbers:
+        has_address = rng.random() < 0.97
+        avtomat_objs.append(Avtomat(
+            avtomat_number=number,
+            street_id=rng.randint(1, streets) if has_address and streets else None,
+            house=str(rng.randint(1, 200)) if has_address else None,
+            latitude=round(rng.uniform(49.90, 50.10), 6) if has_address else None,
+            longitude=round(rng.uniform(36.10, 36.40), 6) if has_address else None,
+            search_radius=300,
+            price=rng.choice((120, 130, 150)),
+            price_for_app=rng.choice((None, 110, 140)),
+            visible_in_app=rng.random() < 0.6,
+            payment_gateway_name=rng.choice((None, 'portmone', 'monobank')),
+            max_sum=rng.choice((None, 5000)),
+            size=rng.choice((470, 470, 940, 471)),
+            competitors=rng.choice((0, 1)),
+            state=rng.choices((0, 1, 2, 3, 4), weights=(2, 85, 5, 5, 3))[0],
+            route_id=rng.randint(1, routes) if routes and rng.random() < 0.9 else None,
+            rro_id=f'{rng.randint(0, 10 ** 9 - 1):09d}' if rng.random() < 0.8 else None,
+            security_id=f'{rng.randint(0, 10 ** 9 - 1):09d}' if rng.random() < 0.3 else None,
+            security_state=rng.choice((None, 1, 2, 3)),
+        ))
+    Avtomat.objects.bulk_create(avtomat_objs, batch_size=BATCH_SIZE)
+
+    # Some avtomats report nothing, for the inactive avtomats filter
+    statistic_objs = [Statistic(avtomat_id=number) for number in numbers if rng.random() < 0.9
+                      for _ in range(statistic_per_avtomat)]
+    Statistic.objects.bulk_create(statistic_objs, batch_size=BATCH_SIZE)
+
+    Setting.objects.bulk_create([Setting(name=name, value=value) for name, value in SETTINGS.items()])
+
+    user_objs = [
+        User(id=i, username=f'user{i}', last_name=f'Прізвище {i}', first_name=f"Ім'я {i}",
+             email=f'user{i}@localhost', password_hash='!', permission=rng.choice(User.USER_PERMISSION)[0],
+             city=DEFAULT_CITY)
+        for i in range(1, users + 1)
+    ]
+    User.objects.bulk_create(user_objs, batch_size=BATCH_SIZE)
+
+    return {
+        'city': len(city_objs),
+        'street': len(street_objs),
+        'route': len(route_objs),
+        'avtomat': len(avtomat_objs),
+        'statistic': len(statistic_objs),
+        'setting': len(SETTINGS),
+        'user': len(user_objs),
+    }
+
+
+def setup_databases(fleet: Optional[dict] = None) -> Optional[dict]:
+    """Migrate the local databases, seed a new fleet of the given size and empty the cache.
+
+    Without a fleet the server tables of a previous run are kept. Returns the seeded rows per table.
+    """
+    check_local()
+    for alias in connections:
+        name = str(connections[alias].settings_dict['NAME'])
+        if connections[alias].vendor == 'sqlite' and not name.startswith((':memory:', 'file:')):
+            Path(name).parent.mkdir(parents=True, exist_ok=True)
+    call_command('migrate', verbosity=0)
+    counts = None
+    if fleet is not None:
+        create_schema()
+        counts = seed(**fleet)
+    cache.clear()
+    return counts
+
+
+class StubServerAPI:
+    """Local server API in a thread: issues API keys and accepts parameters.
+
+    Avtomats in ``busy`` answer as busy; ``latency`` seconds are added to every parameter request;
+    the first ``failures`` parameter requests answer 503.
+    """
+
+    def __init__(self, busy=(), latency: float = 0.0, failures: int = 0):
+        self.busy = set(busy)
+        self.latency = latency
+        self.failures = failures
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self) -> 'StubServerAPI':
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with stub.lock:
+                    stub.requests.append(self.path)
+                if self.path == '/api_key':
+                    self._reply(200, {'api_key': 'synthetic'})
+                elif self.path == '/param':
+                    with stub.lock:
+                        fail = stub.failures > 0
+                        stub.failures -= int(fail)
+                    if fail:
+                        self._reply(503)
+                        return
+                    if stub.latency:
+                        threading.Event().wait(stub.latency)
+                    avtomat_number = json.loads(body)['avtomat_number']
+                    if avtomat_number in stub.busy:
+                        self._reply(200, {'avtomat_number': avtomat_number})
+                    else:
+                        self._reply(204)
+                else:
+                    self._reply(404)
+
+            def _reply(self, status: int, data: dict = None):
+                payload = b'' if data is None else json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self) -> 'StubServerAPI':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,3 +1,1134 @@
-from django.test import TestCase
+"""Query budgets of the admin pages and actions, and behaviour tests of the modules behind them.
 
-# Create your tests here.
+Every changelist, change form and avtomat action runs against synthetic fleets of different
+sizes with an empty cache and must stay within a fixed number of SQL queries per database, so
+a query per row (a ``save()`` per avtomat, a setting read per avtomat, a ``Street.__str__``
+lookup per row) fails on the larger fleet. A failure lists the queries by the code path of
+this project that made them. Run with the local settings:
+
+    python manage.py test server_panel --settings=config.settings.test
+"""
+import csv
+import io
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+import redis
+import requests
+from django.conf import settings
+from django.contrib.admin.models import CHANGE, LogEntry
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.paginator import EmptyPage
+from django.core.signals import request_finished
+from django.db import DataError, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import activity, audit, avtomat_actions, dbrouters, export, facets, fleet_status, importer, jobs, \
+    machine_filter, metrics, paginators, qr, retries, search_index, settings_cache, street_labels, synthetic
+from .avtomat_actions import DispatchResult, apply_max_sum, dispatch_param, update_avtomats
+from .middleware import AuditMiddleware, PrimaryStickinessMiddleware
+from .server_api import CircuitBreaker, CircuitOpenError, ServerAPIClient, ServerAPIError
+from .models import Avtomat, City, Route, Setting, Statistic, Street, User
+from .redis_client import get_redis
+
+SOURCE_DIR = str(settings.BASE_DIR)
+
+SAVEPOINT_RE = re.compile(r'(RELEASE |ROLLBACK TO )?SAVEPOINT ', re.IGNORECASE)
+
+# (default, vodomat_server) queries of every changelist, the session and the user are in default
+CHANGELIST_BUDGETS = {
+    User: (2, 3),
+    Route: (2, 3),
+    City: (2, 3),
+    Street: (2, 3),
+    Avtomat: (2, 5),
+    Setting: (2, 3),
+}
+
+CHANGE_FORM_BUDGETS = {
+    User: (3, 3),
+    Route: (3, 3),
+    City: (3, 3),
+    Street: (3, 4),
+    Avtomat: (3, 5),
+    Setting: (3, 3),
+}
+
+AVTOMAT_CHANGELIST_PARAMS = {
+    'state': {'state__exact': 1},
+    'size': {'size__exact': 940},
+    'price_for_app': {'price_for_app': 140},
+    'price_for_app_empty': {'price_for_app': 'empty'},
+    'price_type': {'street__city__price_type__exact': 1},
+    'route': {'route_number': 1},
+    'no_route': {'route_number': 'no_route'},
+    'city': {'city': 2},
+    'search_number': {'q': '1'},
+    'search_street': {'q': 'Вулиця 1'},
+    'search_substring': {'q': 'лиця 1'},
+}
+
+# Actions run on the whole fleet
+ACTION_BUDGETS = {
+    'set_price': (3, 8),
+    'set_price_for_app': (3, 7),
+    'set_max_sum': (2, 6),
+    'disable_online_pay': (3, 3),
+    'export_csv': (2, 6),
+    'download_qr_stickers': (2, 2),
+    'delete_selected': (2, 3),
+}
+
+# Actions that also insert their admin log entries in batches
+LOGGED_ACTIONS = {'set_price', 'set_price_for_app', 'disable_online_pay'}
+
+stub_server_api = synthetic.StubServerAPI()
+
+
+def setUpModule():
+    synthetic.create_schema()
+    stub_server_api.start()
+    os.environ['SERVER_API_URL'] = stub_server_api.url
+    os.environ.setdefault('SERVER_API_SECURE_HEADERS', 'X-Api-Key')
+
+
+def tearDownModule():
+    stub_server_api.stop()
+
+
+def _code_path() -> str:
+    """Return the lines of this project in the current stack, outside the tests and the middleware."""
+    lines = []
+    for frame in traceback.extract_stack()[:-3]:
+        path = os.path.relpath(frame.filename, SOURCE_DIR)
+        if frame.filename.startswith(SOURCE_DIR) and 'site-packages' not in path \
+                and frame.filename != __file__ and path not in ('manage.py', 'server_panel/middleware.py'):
+            lines.append(f'{path}:{frame.lineno} in {frame.name}')
+    return ' > '.join(lines) or 'django'
+
+
+class QueryLog:
+    """``connection.execute_wrapper`` keeping every query with the code path that made it."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        # Savepoints only exist because the test runs in a transaction
+        if not SAVEPOINT_RE.match(sql):
+            self.queries.append((_code_path(), sql))
+        return execute(sql, params, many, context)
+
+    def report(self, alias: str, budget: int) -> str:
+        """List the queries by code path and statement, the most repeated first."""
+        lines = [f'{alias}: {len(self.queries)} queries, budget {budget}']
+        for (code_path, sql), count in Counter(self.queries).most_common():
+            lines.append(f'  {count:>5} x {code_path}\n          {sql[:300]}')
+        return '\n'.join(lines)
+
+
+class QueryBudgetTests:
+    """Budgets of the admin, run by a ``TestCase`` per fleet size."""
+
+    databases = {'default', 'vodomat_server'}
+    avtomats = None
+
+    @classmethod
+    def setUpTestData(cls):
+        synthetic.seed(avtomats=cls.avtomats, streets=max(1, cls.avtomats // 5),
+                       routes=max(1, cls.avtomats // 20), cities=3, users=max(1, cls.avtomats // 10))
+        cls.superuser = get_user_model().objects.create_superuser('admin', 'admin@localhost', 'admin')
+
+    def setUp(self):
+        cache.clear()
+        ContentType.objects.clear_cache()
+        self.client.force_login(self.superuser)
+
+    @contextmanager
+    def assertMaxQueries(self, default: int, vodomat_server: int):
+        logs = {'default': QueryLog(), 'vodomat_server': QueryLog()}
+        with ExitStack() as stack:
+            for alias, log in logs.items():
+                stack.enter_context(connections[alias].execute_wrapper(log))
+            yield
+        budgets = {'default': default, 'vodomat_server': vodomat_server}
+        errors = [log.report(alias, budgets[alias]) for alias, log in logs.items()
+                  if len(log.queries) > budgets[alias]]
+        if errors:
+            self.fail(f'Query budget exceeded on a fleet of {self.avtomats} avtomats\n' + '\n'.join(errors))
+
+    def log_entry_batches(self) -> int:
+        """Return the INSERT statements of one admin log entry per avtomat of the fleet."""
+        fields = [field for field in LogEntry._meta.concrete_fields if not field.primary_key]
+        batch_size = connections['default'].ops.bulk_batch_size(fields, [None] * self.avtomats)
+        return -(-self.avtomats // batch_size)
+
+    def get(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_changelists(self):
+        for model, budget in CHANGELIST_BUDGETS.items():
+            with self.subTest(model=model.__name__), self.assertMaxQueries(*budget):
+                self.get(reverse(f'admin:server_panel_{model._meta.model_name}_changelist'))
+
+    def test_change_forms(self):
+        for model, budget in CHANGE_FORM_BUDGETS.items():
+            obj = model.objects.order_by('pk').last()
+            with self.subTest(model=model.__name__), self.assertMaxQueries(*budget):
+                self.get(reverse(f'admin:server_panel_{model._meta.model_name}_change', args=(obj.pk, )))
+
+    def test_avtomat_changelist_filters_and_search(self):
+        url = reverse('admin:server_panel_avtomat_changelist')
+        for name, params in AVTOMAT_CHANGELIST_PARAMS.items():
+            with self.subTest(name), self.assertMaxQueries(*CHANGELIST_BUDGETS[Avtomat]):
+                self.get(url, params)
+
+    def test_street_autocomplete(self):
+        with self.assertMaxQueries(2, 3):
+            self.get(reverse('admin:autocomplete'), {
+                'app_label': 'server_panel', 'model_name': 'avtomat', 'field_name': 'street', 'term': 'Вулиця',
+            })
+
+    def test_actions(self):
+        url = reverse('admin:server_panel_avtomat_changelist')
+        selected = list(Avtomat.objects.values_list('avtomat_number', flat=True))
+        for action, (default, vodomat_server) in ACTION_BUDGETS.items():
+            if action in LOGGED_ACTIONS:
+                default += self.log_entry_batches()
+            with self.subTest(action), self.assertMaxQueries(default, vodomat_server), \
+                    self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+                response = self.client.post(url, {'action': action, '_selected_action': selected, 'index': 0})
+                self.assertLess(response.status_code, 400)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+
+    def test_export(self):
+        url = reverse('admin:server_panel_avtomat_export')
+        # The response streams the rows, the view only builds the query of the changelist: no page, no
+        # count, only the choices of the filters, cached for the next requests
+        params = {'state__exact': 1, 'q': 'Вулиця'}
+        with self.assertMaxQueries(1, 3):
+            response = self.get(url, params)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        changelist = self.get(reverse('admin:server_panel_avtomat_changelist'), params).context['cl']
+        self.assertEqual(len(rows) - 1, changelist.result_count)
+
+    def test_avtomat_changes(self):
+        audit.write(audit.entries(self.superuser.id, Avtomat.objects.all(), CHANGE, 'Changed Price to 1.50') * 3)
+        url = reverse('admin:server_panel_avtomat_changes')
+        before = LogEntry.objects.order_by('-action_time', '-pk').values_list('pk', flat=True)[self.avtomats]
+        for name, params in {
+            'all': {},
+            'avtomat': {'avtomat_number': 1},
+            'action': {'action_flag': CHANGE},
+            'dates': {'date_from': '2020-01-01', 'date_to': '2030-12-31'},
+            'older': {'before': before},
+        }.items():
+            with self.subTest(name), self.assertMaxQueries(4, 0):
+                self.get(url, params)
+
+    def test_fleet_status(self):
+        url = reverse('admin:server_panel_avtomat_status')
+        # Counted once with one GROUP BY and one scan, with the route and city names of the facets,
+        # then read from Redis
+        with self.assertMaxQueries(1, 4):
+            self.get(url)
+        for params in ({}, {'city': 2}, {'state': 1, 'online_pay': 'true'}, {'route': 'none'}):
+            with self.subTest(params), self.assertMaxQueries(1, 0):
+                self.get(url, params)
+
+        # An action reads the groups of the avtomats it changed once
+        changelist = reverse('admin:server_panel_avtomat_changelist')
+        self.get(changelist)
+        default, vodomat_server = ACTION_BUDGETS['disable_online_pay']
+        selected = list(Avtomat.objects.values_list('avtomat_number', flat=True))
+        with self.assertMaxQueries(default + self.log_entry_batches(), vodomat_server + 1), \
+                self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(changelist, {'action': 'disable_online_pay', '_selected_action': selected, 'index': 0})
+        counts = fleet_status.get_counts()
+        fleet_status.rebuild()
+        self.assertCountEqual(counts, fleet_status.get_counts())
+
+    def test_set_max_sum_job(self):
+        job = {'id': 'test', 'user_id': self.superuser.id, 'params': {'max_sum_value': 5000}}
+        avtomat_numbers = list(Avtomat.objects.values_list('avtomat_number', flat=True))
+        with self.assertMaxQueries(1 + self.log_entry_batches(), 3):
+            result = apply_max_sum(job, avtomat_numbers)
+        self.assertEqual(len(result.succeeded), len(avtomat_numbers))
+
+
+class SmallFleetQueryBudgetTests(QueryBudgetTests, TestCase):
+    avtomats = 10
+
+
+class LargeFleetQueryBudgetTests(QueryBudgetTests, TestCase):
+    avtomats = 250
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_opens_after_consecutive_failures_and_lets_one_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+        for _ in range(2):
+            breaker.record_failure()
+        breaker.record_success()
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 30):
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertTrue(breaker.allow_request())
+            self.assertFalse(breaker.allow_request())
+            # A failed trial opens the circuit for another cool-down
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 60):
+            self.assertTrue(breaker.allow_request())
+            breaker.record_success()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            self.assertTrue(breaker.allow_request())
+
+
+class ServerAPITestCase(SimpleTestCase):
+    """Clients of stub server APIs of their own, with an empty API key cache."""
+
+    def setUp(self):
+        cache.clear()
+
+    def client_of(self, stub, **options) -> ServerAPIClient:
+        self.addCleanup(stub.stop)
+        return ServerAPIClient(stub.start().url, 'X-Api-Key', 'user', 'password', backoff_factor=0, **options)
+
+
+class ServerAPIClientTests(ServerAPITestCase):
+
+    def test_gateway_errors_are_retried(self):
+        stub = synthetic.StubServerAPI(busy=[7], failures=2)
+        self.assertEqual(self.client_of(stub, retries=2).set_param(7, 'param'), 7)
+        self.assertEqual(stub.requests, ['/api_key', '/param', '/param', '/param'])
+
+    def test_circuit_opens_after_failed_requests(self):
+        stub = synthetic.StubServerAPI(failures=3)
+        client = self.client_of(stub, retries=0, failure_threshold=2)
+        for _ in range(2):
+            with self.assertRaises(ServerAPIError):
+                client.set_param(1, 'param')
+        with self.assertRaises(CircuitOpenError):
+            client.set_param(1, 'param')
+        self.assertEqual(stub.requests.count('/param'), 2)
+        self.assertEqual(client.latency_stats()['/param']['errors'], 3)
+
+    def test_body_that_is_not_json_is_an_error(self):
+        client = self.client_of(synthetic.StubServerAPI())
+        client.get_api_key()
+        response = requests.Response()
+        response.status_code, response._content = 200, b'<html>Bad gateway</html>'
+        with mock.patch.object(client, '_post', return_value=response), self.assertRaises(ServerAPIError):
+            client.set_param(1, 'param')
+
+
+class APIKeyTests(ServerAPITestCase):
+
+    def test_concurrent_callers_request_one_key(self):
+        stub = synthetic.StubServerAPI()
+        client = self.client_of(stub)
+        start = threading.Barrier(8)
+
+        def get_api_key():
+            start.wait()
+            return client.get_api_key()
+
+        with ThreadPoolExecutor(8) as executor:
+            keys = list(executor.map(lambda _: get_api_key(), range(8)))
+        self.assertEqual(keys, ['synthetic'] * 8)
+        self.assertEqual(stub.requests, ['/api_key'])
+
+    def test_key_is_renewed_in_the_background_before_it_expires(self):
+        stub = synthetic.StubServerAPI()
+        client = self.client_of(stub)
+        cache.set(client.API_KEY_CACHE_KEY, {'api_key': 'old', 'refresh_at': time.time() - 1})
+        self.assertEqual(client.get_api_key(), 'old')
+        client._background_refresh.join(5)
+        self.assertEqual(client.get_api_key(), 'synthetic')
+        self.assertEqual(stub.requests, ['/api_key'])
+
+    def test_failed_key_request_is_not_repeated_by_every_caller(self):
+        stub = synthetic.StubServerAPI()
+        client = self.client_of(stub, retries=0)
+        stub.stop()
+        with self.assertRaises(ServerAPIError):
+            client.get_api_key()
+        # Until the failure marker expires, callers give up without a request
+        self.assertIsNone(client.get_api_key())
+        self.assertEqual(client.latency_stats()['/api_key']['count'], 1)
+
+    def test_key_response_that_is_not_json_is_a_failed_request(self):
+        client = self.client_of(synthetic.StubServerAPI())
+        response = requests.Response()
+        response.status_code, response._content = 200, b'<html>Bad gateway</html>'
+        with mock.patch.object(client, '_post', return_value=response) as post:
+            with self.assertRaises(ServerAPIError):
+                client.get_api_key()
+            self.assertIsNone(client.get_api_key())
+        self.assertEqual(post.call_count, 1)
+
+
+class StubClient:
+    """Server API client answering ``set_param`` per avtomat: busy, an exception or accepted."""
+
+    def __init__(self, api_key='key', busy=(), errors=None):
+        self.api_key = api_key
+        self.busy = set(busy)
+        self.errors = errors or {}
+
+    def get_api_key(self):
+        if isinstance(self.api_key, Exception):
+            raise self.api_key
+        return self.api_key
+
+    def set_param(self, avtomat_number, param):
+        if avtomat_number in self.errors:
+            raise self.errors[avtomat_number]
+        return avtomat_number if avtomat_number in self.busy else None
+
+
+class DispatchParamTests(SimpleTestCase):
+
+    def dispatch(self, client, avtomat_numbers=range(1, 7)) -> DispatchResult:
+        with mock.patch.object(avtomat_actions, 'get_client', return_value=client):
+            return dispatch_param(avtomat_numbers, 'param', max_workers=3)
+
+    def test_outcome_of_every_avtomat(self):
+        result = self.dispatch(StubClient(busy=[2, 5], errors={3: ServerAPIError('Timed out'),
+                                                                6: CircuitOpenError('Circuit open')}))
+        self.assertEqual(result, DispatchResult(succeeded=[1, 4], busy=[2, 5], failed=[3, 6]))
+
+    def test_without_an_api_key_every_avtomat_failed(self):
+        for api_key in (None, ServerAPIError('Key request failed'), CircuitOpenError('Circuit open')):
+            with self.subTest(api_key=api_key):
+                client = StubClient(api_key=api_key)
+                with mock.patch.object(client, 'set_param') as set_param:
+                    self.assertEqual(self.dispatch(client, [3, 1, 2]), DispatchResult(failed=[1, 2, 3]))
+                set_param.assert_not_called()
+
+    def test_nothing_to_dispatch(self):
+        with mock.patch.object(avtomat_actions, 'get_client') as get_client:
+            self.assertEqual(dispatch_param([], 'param'), DispatchResult())
+        get_client.assert_not_called()
+
+
+class ServerTestCase(TestCase):
+    """Behaviour tests on both databases with an empty Redis and a logged in superuser."""
+
+    databases = {'default', 'vodomat_server'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = get_user_model().objects.create_superuser('admin', 'admin@localhost', 'admin')
+        cls.city = City.objects.create(city='Харків м.')
+        cls.street = Street.objects.create(street='Сумська', city=cls.city)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.superuser)
+
+    def create_avtomat(self, avtomat_number: int, **values) -> Avtomat:
+        """Insert an avtomat as the vodomat server does, bypassing the admin."""
+        return Avtomat.objects.create(**{'avtomat_number': avtomat_number, 'street': self.street, 'house': '5',
+                                         'state': 1, **values})
+
+
+class SettingsCacheTests(ServerTestCase):
+
+    def test_saving_a_setting_in_the_admin_reloads_the_settings(self):
+        setting = Setting.objects.create(name='avtomat_price', value=150)
+        self.assertEqual(settings_cache.get_settings(), {'avtomat_price': 150})
+        # Changed outside the admin: the cached values are served without a query
+        Setting.objects.filter(pk=setting.pk).update(value=200)
+        with self.assertNumQueries(0, using='vodomat_server'):
+            self.assertEqual(settings_cache.get_settings(), {'avtomat_price': 150})
+
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            response = self.client.post(reverse('admin:server_panel_setting_change', args=[setting.pk]),
+                                        {'name': 'avtomat_price', 'value': 250})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(settings_cache.get_settings(), {'avtomat_price': 250})
+
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_setting_delete', args=[setting.pk]), {'post': 'yes'})
+        self.assertEqual(settings_cache.get_settings(), {})
+
+
+class StreetLabelTests(ServerTestCase):
+
+    def autocomplete(self) -> list[str]:
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'server_panel', 'model_name': 'avtomat', 'field_name': 'street', 'term': ''})
+        return [result['text'] for result in response.json()['results']]
+
+    def test_labels_name_the_city_outside_kharkiv(self):
+        city = City.objects.create(city='Люботин м.')
+        Street.objects.create(street='Шевченка', city=city)
+        Street.objects.create(street='Без міста')
+        self.assertEqual(self.autocomplete(), ['Без міста', 'Сумська', 'Шевченка (Люботин м.)'])
+        self.assertEqual(street_labels.get_labels([self.street.pk]), {self.street.pk: 'Сумська'})
+
+        # Renaming the city through the admin relabels its streets
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_city_change', args=[city.pk]), {'city': 'Мерефа м.'})
+        self.assertEqual(self.autocomplete(), ['Без міста', 'Сумська', 'Шевченка (Мерефа м.)'])
+
+
+class ExportTests(ServerTestCase):
+
+    def export(self, params=None) -> list[list[str]]:
+        response = self.client.get(reverse('admin:server_panel_avtomat_export'), params)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        return list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+    def test_rows_of_the_filtered_changelist_in_batches(self):
+        route = Route.objects.create(name='R1')
+        self.create_avtomat(1, route=route, size=940, price=150, price_for_app=140, max_sum=5000, latitude=50.0,
+                            longitude=36.25, rro_id='R001', security_id='S001', security_state=1, visible_in_app=True)
+        for number in range(2, 6):
+            self.create_avtomat(number, state=2 if number == 3 else 1)
+        with mock.patch.object(export, 'CHUNK_SIZE', 2):
+            rows = self.export({'state__exact': 1})
+        self.assertEqual(rows[0], [header for header, _ in export.COLUMNS])
+        self.assertEqual(rows[1], ['1', 'Сумська', '5', 'Харків м.', 'R1', 'Normal', 'Double', '150', '140', '5000',
+                                   '50.0', '36.25', 'R001', 'S001', 'Security ON', 'True'])
+        self.assertEqual(rows[2], ['2', 'Сумська', '5', 'Харків м.', '', 'Normal', 'Single', '', '', '',
+                                   '', '', '', '', 'Undefined', 'False'])
+        self.assertEqual([row[0] for row in rows[1:]], ['1', '2', '4', '5'])
+
+
+class MapDataTests(ServerTestCase):
+
+    def get(self, **params):
+        return self.client.get(reverse('admin:server_panel_avtomat_map_data'), params)
+
+    def features(self, **params) -> dict[int, dict]:
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200)
+        return {feature['properties']['avtomat_number']: feature for feature in response.json()['features']}
+
+    def test_bounding_box_and_conditional_requests(self):
+        self.create_avtomat(1, latitude=50.0, longitude=36.2)
+        self.create_avtomat(2, latitude=50.01, longitude=36.3, state=3)
+        self.create_avtomat(3, latitude=49.9, longitude=36.6)
+        self.create_avtomat(4)
+        self.assertEqual(set(self.features()), {1, 2, 3})
+        # Across grid cells, bounds included
+        features = self.features(bbox='36.2,49.95,36.5,50.01')
+        self.assertEqual(set(features), {1, 2})
+        self.assertEqual(features[2]['geometry']['coordinates'], [36.3, 50.01])
+        self.assertEqual(features[2]['properties']['state_label'], 'Crashed')
+        self.assertEqual(self.features(bbox='0,0,1,1'), {})
+        # An invalid box is ignored
+        self.assertEqual(set(self.features(bbox='36.5,50,36.2,49')), {1, 2, 3})
+
+        response = self.get(bbox='36.2,49.95,36.5,50.01')
+        self.assertEqual(self.client.get(reverse('admin:server_panel_avtomat_map_data'),
+                                         {'bbox': '36.2,49.95,36.5,50.01'},
+                                         headers={'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertNotEqual(self.get()['ETag'], response['ETag'])
+
+        # Moved by the panel: a new ETag for the same box
+        avtomat_actions.update_avtomats([1], latitude=40.0)
+        self.assertEqual(self.client.get(reverse('admin:server_panel_avtomat_map_data'),
+                                         {'bbox': '36.2,49.95,36.5,50.01'},
+                                         headers={'If-None-Match': response['ETag']}).status_code, 200)
+        self.assertEqual(set(self.features(bbox='36.2,49.95,36.5,50.01')), {2})
+
+    def test_renaming_a_street_or_city_updates_the_addresses(self):
+        self.create_avtomat(1, latitude=50.0, longitude=36.2)
+        self.assertEqual(self.features()[1]['properties']['address'], 'Сумська 5')
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_street_change', args=[self.street.pk]),
+                             {'street': 'Пушкінська', 'city': self.city.pk})
+        self.assertEqual(self.features()[1]['properties']['address'], 'Пушкінська 5')
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_city_change', args=[self.city.pk]), {'city': 'Мерефа м.'})
+        self.assertEqual(self.features()[1]['properties']['address'], 'Пушкінська (Мерефа м.) 5')
+
+
+class QRStickerTests(ServerTestCase):
+
+    def test_zip_of_cached_and_rendered_images(self):
+        for number in (1, 2, 3):
+            self.create_avtomat(number)
+        cache.set(qr._key(2), b'cached')
+        response = self.client.post(reverse('admin:server_panel_avtomat_changelist'), {
+            'action': 'download_qr_stickers', '_selected_action': [3, 1, 2], 'index': 0})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            self.assertEqual(archive.namelist(), ['qr/1.png', 'qr/2.png', 'qr/3.png', 'stickers.html'])
+            self.assertEqual(archive.read('qr/1.png'), qr.render_png(1))
+            self.assertEqual(archive.read('qr/2.png'), b'cached')
+            self.assertTrue(archive.read('qr/3.png').startswith(b'\x89PNG'))
+            stickers = archive.read('stickers.html').decode()
+        self.assertEqual(re.findall(r'src="(qr/\d+\.png)"', stickers), ['qr/1.png', 'qr/2.png', 'qr/3.png'])
+        # The misses are cached for the next download
+        self.assertEqual(cache.get(qr._key(3)), qr.render_png(3))
+
+    def test_misses_beyond_the_inline_limit_are_rendered_by_the_process_pool(self):
+        with mock.patch.object(qr, 'INLINE_LIMIT', 1), override_settings(QR_PROCESSES=2):
+            images = qr.get_pngs([4, 5, 6])
+        self.assertEqual(images, {number: qr.render_png(number) for number in (4, 5, 6)})
+
+
+class MetricsTests(ServerTestCase):
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_exposition_format(self):
+        stats = metrics.RequestStats(queries={'vodomat_server': [3, 0.02]}, cache_hits=2, cache_misses=1)
+        metrics.record_request('admin:server_panel_avtomat_changelist', 0.3, stats)
+        metrics.record_server_api('/param', 0.04, error=True)
+
+        self.assertEqual(self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer wrong'}).status_code,
+                         403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+
+        view = 'view="admin:server_panel_avtomat_changelist"'
+        name = 'vodomat_admin_request_duration_seconds'
+        start = lines.index(f'# TYPE {name} histogram')
+        self.assertEqual(lines[start - 1], f'# HELP {name} Latency of admin requests by view')
+        self.assertEqual(lines[start + 1:start + 15], [
+            *(f'{name}_bucket{{{view},le="{bucket}"}} {int(bucket >= 0.3)}' for bucket in metrics.BUCKETS),
+            f'{name}_bucket{{{view},le="+Inf"}} 1',
+            f'{name}_sum{{{view}}} 0.3',
+            f'{name}_count{{{view}}} 1',
+        ])
+        self.assertIn(f'vodomat_admin_db_queries_total{{{view},database="vodomat_server"}} 3', lines)
+        self.assertIn(f'vodomat_admin_db_duration_seconds_sum{{{view},database="vodomat_server"}} 0.02', lines)
+        self.assertIn(f'vodomat_admin_cache_requests_total{{{view},result="hit"}} 2', lines)
+        self.assertIn(f'vodomat_admin_cache_requests_total{{{view},result="miss"}} 1', lines)
+        self.assertIn('vodomat_server_api_request_duration_seconds_bucket{endpoint="/param",le="0.05"} 1', lines)
+        self.assertIn('vodomat_server_api_errors_total{endpoint="/param"} 1', lines)
+        # Every sample line is a metric name, labels and a number
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertRegex(line, r'^[a-z_]+\{[^{}]*\} -?\d+(\.\d+)?(e-?\d+)?$')
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual(metrics._labels(view='a"b\\c\nd'), 'view="a\\"b\\\\c\\nd"')
+
+
+class SearchTests(ServerTestCase):
+
+    def search(self, term: str) -> set[int]:
+        response = self.client.get(reverse('admin:server_panel_avtomat_changelist'), {'q': term})
+        self.assertEqual(response.status_code, 200)
+        return {avtomat.avtomat_number for avtomat in response.context['cl'].result_list}
+
+    def test_index_answers_without_a_like_scan(self):
+        self.create_avtomat(12)
+        self.create_avtomat(120)
+        search_index.rebuild()
+        with CaptureQueriesContext(connections['vodomat_server']) as queries:
+            self.assertEqual(self.search('12'), {12, 120})
+        self.assertFalse([query for query in queries if 'LIKE' in query['sql']])
+        # A part of a word is not indexed, the admin search finds it
+        self.assertEqual(self.search('умськ'), {12, 120})
+
+    def test_workers_index_avtomats_inserted_outside_the_admin(self):
+        self.create_avtomat(12)
+        self.assertEqual(search_index.rebuild_if_due(), 1)
+        self.create_avtomat(120)
+        self.assertIsNone(search_index.rebuild_if_due())
+        self.assertEqual(self.search('12'), {12})
+
+        get_redis().set(search_index.REFRESHED_KEY, time.time() - settings.SEARCH_INDEX_REFRESH_INTERVAL)
+        self.assertEqual(search_index.rebuild_if_due(), 2)
+        self.assertEqual(self.search('12'), {12, 120})
+
+    def test_admin_search_while_the_index_is_not_built(self):
+        self.create_avtomat(112)
+        self.assertEqual(self.search('12'), {112})
+
+    def test_index_adds_house_prefixes(self):
+        self.create_avtomat(12, house='17А')
+        search_index.rebuild()
+        self.assertEqual(self.search('Сумська 17'), {12})
+
+
+class FleetStatusTests(ServerTestCase):
+
+    def test_rebuild_runs_once_at_a_time(self):
+        self.create_avtomat(1)
+        self.create_avtomat(2, state=2)
+        get_redis().set(fleet_status.LOCK_KEY, 1)
+        self.assertIsNone(fleet_status.rebuild())
+        # Counted without keeping the counts while the other process builds them
+        self.assertEqual(sorted((group['state'], count) for group, count in fleet_status.get_counts()),
+                         [(1, 1), (2, 1)])
+        self.assertFalse(fleet_status.is_built())
+
+        get_redis().delete(fleet_status.LOCK_KEY)
+        self.assertEqual(fleet_status.rebuild(), 2)
+        self.assertTrue(fleet_status.is_built())
+        self.assertEqual(get_redis().keys(f'{fleet_status.COUNTS_KEY}:tmp:*'), [])
+        self.assertFalse(get_redis().exists(fleet_status.LOCK_KEY))
+
+    def test_deleting_a_route_rebuilds_the_counts(self):
+        route = Route.objects.create(name='1')
+        self.create_avtomat(1)
+        fleet_status.rebuild()
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_route_change', args=[route.pk]), {'name': '2'})
+        self.assertEqual(Route.objects.get().name, '2')
+        self.assertTrue(fleet_status.is_built())
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            self.client.post(reverse('admin:server_panel_route_delete', args=[route.pk]), {'post': 'yes'})
+        self.assertFalse(Route.objects.exists())
+        self.assertFalse(fleet_status.is_built())
+
+
+@override_settings(RETRY_MAX_ATTEMPTS=3)
+class RetryTests(ServerTestCase):
+    job = {'user_id': 1, 'params': {'max_sum_value': 5000}}
+
+    def setUp(self):
+        super().setUp()
+        self.outcomes = []
+        handler = mock.patch.dict(jobs._handlers, {'test': self.handler})
+        handler.start()
+        self.addCleanup(handler.stop)
+
+    def handler(self, job, avtomat_numbers):
+        outcome = self.outcomes.pop(0)
+        if outcome == 'error':
+            raise ConnectionError
+        result = DispatchResult(**{outcome: avtomat_numbers})
+        retries.record_results('test', job, result)
+        return result
+
+    def retry(self, *outcomes) -> dict:
+        """Run the pending retry once per outcome, as if it were due, and return its state."""
+        for outcome in outcomes:
+            self.outcomes.append(outcome)
+            get_redis().zadd(retries.DUE_KEY, {'test:7': 0})
+            self.assertEqual(retries.run_due(), 1)
+        return {retry['avtomat_number']: retry for retry in retries.list_retries()}[7]
+
+    def test_busy_avtomat_is_retried_until_it_accepts(self):
+        retries.record_results('test', self.job, DispatchResult(busy=[7], failed=[8]))
+        # Failures of the action itself are not retried
+        self.assertEqual([retry['avtomat_number'] for retry in retries.list_retries()], [7])
+        self.assertGreater(get_redis().zscore(retries.DUE_KEY, 'test:7'), time.time())
+
+        retry = self.retry('succeeded')
+        self.assertEqual(retry['status'], retries.SUCCEEDED)
+        self.assertEqual([attempt['result'] for attempt in retry['history']], ['busy', 'succeeded'])
+        self.assertIsNone(get_redis().zscore(retries.DUE_KEY, 'test:7'))
+
+    def test_failed_attempts_count_towards_the_limit(self):
+        retries.record_results('test', self.job, DispatchResult(busy=[7]))
+        retry = self.retry('failed')
+        self.assertEqual((retry['status'], retry['attempts']), (retries.PENDING, 2))
+        with self.assertLogs('server_panel.retries', 'ERROR'):
+            retry = self.retry('error')
+        self.assertEqual((retry['status'], retry['attempts']), (retries.GAVE_UP, 3))
+        self.assertEqual([attempt['result'] for attempt in retry['history']], ['busy', 'failed', 'failed'])
+        self.assertIsNone(get_redis().zscore(retries.DUE_KEY, 'test:7'))
+        self.assertEqual(retries.run_due(), 0)
+
+    def test_concurrent_workers_retry_each_avtomat_once(self):
+        numbers = list(range(1, 21))
+        retries.record_results('test', self.job, DispatchResult(busy=numbers))
+        get_redis().zadd(retries.DUE_KEY, {f'test:{number}': 0 for number in numbers})
+        dispatched = []
+
+        def handler(job, avtomat_numbers):
+            dispatched.extend(avtomat_numbers)
+            retries.record_results('test', job, DispatchResult(busy=avtomat_numbers))
+
+        start = threading.Barrier(2)
+
+        def work():
+            start.wait()
+            return retries.run_due()
+
+        with mock.patch.dict(jobs._handlers, {'test': handler}), ThreadPoolExecutor(2) as executor:
+            retried = list(executor.map(lambda _: work(), range(2)))
+        self.assertEqual(sum(retried), 20)
+        self.assertEqual(sorted(dispatched), numbers)
+        self.assertEqual({retry['attempts'] for retry in retries.list_retries()}, {2})
+        # Rescheduled by the attempt, not due again
+        self.assertEqual(retries.run_due(), 0)
+
+    def test_claim_of_a_retry_rescheduled_meanwhile_is_released(self):
+        retries.record_results('test', self.job, DispatchResult(busy=[7]))
+        # Read as due by a worker, then retried and rescheduled by another one
+        with mock.patch('redis.Redis.zrangebyscore', return_value=['test:7']):
+            self.assertEqual(retries._claim_due(10), [])
+        self.assertFalse(get_redis().exists(retries._claim_key('test:7')))
+
+    def test_newer_action_starts_counting_again(self):
+        retries.record_results('test', self.job, DispatchResult(busy=[7]))
+        self.retry('busy')
+        retries.record_results('test', {'user_id': 1, 'params': {'max_sum_value': 0}}, DispatchResult(busy=[7]))
+        retry = self.retry('busy')
+        self.assertEqual((retry['params'], retry['attempts']), ({'max_sum_value': 0}, 2))
+
+
+class JobStatusTests(ServerTestCase):
+
+    def status(self, job_id: str, **params) -> dict:
+        return self.client.get(reverse('admin:server_panel_avtomat_job_status', args=[job_id]), params).json()
+
+    def test_avtomats_are_listed_when_the_job_finished_or_on_request(self):
+        job_id = jobs.enqueue('test', self.superuser.id, [1, 2, 3])
+        status = self.status(job_id)
+        self.assertEqual((status['status'], status['pending'], status['busy']), (jobs.QUEUED, 3, 0))
+        self.assertNotIn('busy_avtomats', status)
+        self.assertEqual(self.status(job_id, avtomats=1)['busy_avtomats'], [])
+
+        get_redis().delete(jobs.QUEUE_KEY)
+        def handler(job, avtomat_numbers):
+            return DispatchResult(succeeded=[1], busy=[2, 3])
+
+        with mock.patch.dict(jobs._handlers, {'test': handler}):
+            jobs.run_job(job_id)
+        status = self.status(job_id)
+        self.assertEqual((status['status'], status['pending'], status['succeeded'], status['busy']),
+                         (jobs.DONE, 0, 1, 2))
+        self.assertEqual((status['busy_avtomats'], status['failed_avtomats']), ([2, 3], []))
+
+
+class ActivityTests(ServerTestCase):
+
+    def inactive(self) -> set[int]:
+        return set(Avtomat.objects.filter(activity.inactive_q()).values_list('avtomat_number', flat=True))
+
+    def test_rows_before_the_first_refresh_are_not_dated(self):
+        for number in range(1, 5):
+            self.create_avtomat(number)
+        Statistic.objects.create(avtomat_id=1)
+        self.assertEqual(activity.refresh(), 0)
+        self.assertEqual(activity.get_activity([1]), {1: (0, None)})
+        # Nothing is known about the window yet
+        self.assertEqual(activity.refresh(), 0)
+        self.assertFalse(activity.is_refreshed())
+
+        Statistic.objects.create(avtomat_id=2)
+        get_redis().set(activity.STARTED_KEY, time.time() - settings.ACTIVITY_WINDOW_DAYS * activity.DAY)
+        self.assertEqual(activity.refresh(), 1)
+        self.assertTrue(activity.is_refreshed())
+        self.assertEqual(activity.get_activity([2])[2][0], 1)
+        self.assertEqual(self.inactive(), {1, 3, 4})
+
+    def test_filter_lists_the_smaller_side(self):
+        for number in range(1, 5):
+            self.create_avtomat(number)
+        activity.refresh()
+        get_redis().set(activity.STARTED_KEY, 0)
+        Statistic.objects.bulk_create(Statistic(avtomat_id=number) for number in (1, 2, 3))
+        activity.refresh()
+        self.assertEqual(json.loads(get_redis().get(activity.INACTIVE_KEY)), {'inactive': [4]})
+        # Added by the server after the refresh and not seen yet
+        self.create_avtomat(5)
+        self.assertEqual(self.inactive(), {4})
+
+        Statistic.objects.all().delete()
+        get_redis().delete(activity.LAST_SEEN_KEY)
+        Statistic.objects.create(avtomat_id=1)
+        activity.refresh()
+        self.assertEqual(json.loads(get_redis().get(activity.INACTIVE_KEY)), {'active': [1]})
+        self.assertEqual(self.inactive(), {2, 3, 4, 5})
+
+
+class MachineFilterTests(ServerTestCase):
+
+    def upload(self, numbers):
+        content = '\n'.join(map(str, numbers)).encode()
+        return self.client.post(reverse('admin:server_panel_avtomat_changelist'), {
+            'csv_file': SimpleUploadedFile('avtomats.csv', content, content_type='text/csv')})
+
+    def changelist(self) -> set[int]:
+        response = self.client.get(reverse('admin:server_panel_avtomat_changelist'))
+        return {avtomat.avtomat_number for avtomat in response.context['cl'].result_list}
+
+    def test_filters_by_the_uploaded_numbers(self):
+        for number in range(1, 6):
+            self.create_avtomat(number)
+        self.upload([2, 4, 4, 9])
+        self.assertEqual(self.changelist(), {2, 4})
+        self.client.get(reverse('admin:server_panel_avtomat_changelist'), {'clear_csv_filter': 1})
+        self.assertEqual(self.changelist(), {1, 2, 3, 4, 5})
+
+    def test_rejects_too_many_numbers(self):
+        self.create_avtomat(1)
+        with mock.patch.object(machine_filter, 'MAX_NUMBERS', 2):
+            response = self.upload([1, 2, 3])
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         ['The CSV file has 3 avtomat numbers, at most 2 can be filtered by.'])
+        self.assertNotIn('machine_filter_count', self.client.session)
+
+    def test_rejects_a_file_not_utf8_encoded(self):
+        self.create_avtomat(1)
+        response = self.client.post(reverse('admin:server_panel_avtomat_changelist'), {
+            'csv_file': SimpleUploadedFile('avtomats.csv', 'Номер\n1\n'.encode('cp1251'), content_type='text/csv')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         ['The CSV file is not UTF-8 encoded, save it as "CSV UTF-8" and upload it again.'])
+        self.assertNotIn('machine_filter_count', self.client.session)
+
+
+class AuditTests(TransactionTestCase):
+    """The writer thread has its own connection, so the entries are committed for real."""
+
+    databases = {'default'}
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('operator')
+
+    def request(self, fail=False, committed=True) -> HttpResponse:
+        def view(request):
+            with transaction.atomic():
+                audit.record(audit.entries(self.user.pk, [self.user], CHANGE, 'Changed'))
+                if fail and not committed:
+                    raise RuntimeError('Rolled back')
+            if fail:
+                raise RuntimeError('Failed after the commit')
+            return HttpResponse()
+
+        response = AuditMiddleware(convert_exception_to_response(view))(RequestFactory().post('/'))
+        request_finished.send(sender=self.__class__)
+        return response
+
+    def test_writer_thread_writes_the_entries_by_the_end_of_the_request(self):
+        with override_settings(AUDIT_ASYNC=True):
+            self.request()
+            self.request()
+        self.assertEqual(LogEntry.objects.filter(object_id=str(self.user.pk)).count(), 2)
+        self.assertTrue(audit.get_writer().is_alive())
+
+    def test_entries_are_written_when_their_change_is_committed(self):
+        for audit_async in (False, True):
+            with self.subTest(audit_async=audit_async), override_settings(AUDIT_ASYNC=audit_async):
+                with self.assertLogs('django.request', 'ERROR'):
+                    self.assertEqual(self.request(fail=True, committed=False).status_code, 500)
+                self.assertFalse(LogEntry.objects.exists())
+                # Committed, then the view failed, e.g. on the cache work after a bulk update
+                with self.assertLogs('django.request', 'ERROR'):
+                    self.assertEqual(self.request(fail=True).status_code, 500)
+                self.assertEqual(LogEntry.objects.count(), 1)
+                LogEntry.objects.all().delete()
+
+    def test_failed_batch_is_written_request_by_request(self):
+        def put(object_id: str) -> tuple[list[LogEntry], threading.Event]:
+            log_entries = audit.entries(self.user.pk, [self.user], CHANGE, 'Changed')
+            log_entries[0].object_id = object_id
+            return log_entries, threading.Event()
+
+        # The object id of the second request does not fit the column
+        batch = [put('1'), put('2' * 300), put('3')]
+        write = audit.write
+
+        def strict_write(log_entries):
+            if any(len(entry.object_id) > 200 for entry in log_entries):
+                raise DataError('value too long')
+            write(log_entries)
+
+        with mock.patch.object(audit, 'write', strict_write), self.assertLogs('server_panel.audit') as logs:
+            audit.Writer.write(batch)
+        self.assertEqual(sorted(LogEntry.objects.values_list('object_id', flat=True)), ['1', '3'])
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING', 'ERROR'])
+        self.assertTrue(all(written.is_set() for _, written in batch))
+
+
+class AvtomatActionTests(ServerTestCase):
+
+    def test_bulk_update_is_logged_when_the_cache_work_after_the_commit_fails(self):
+        avtomat = self.create_avtomat(1)
+        with mock.patch.object(facets, 'invalidate', side_effect=redis.ConnectionError), \
+                self.assertRaises(redis.ConnectionError), \
+                self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            update_avtomats([1], audit.entries(self.superuser.id, [avtomat], CHANGE, 'Changed Price to 1.50'),
+                            price=150)
+        self.assertEqual(Avtomat.objects.get().price, 150)
+        self.assertEqual(list(LogEntry.objects.values_list('object_id', 'change_message')),
+                         [('1', 'Changed Price to 1.50')])
+
+    def test_rolled_back_bulk_update_is_not_logged(self):
+        avtomat = self.create_avtomat(1)
+        with mock.patch.object(Avtomat.objects, 'filter', side_effect=DataError), self.assertRaises(DataError), \
+                self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            update_avtomats([1], audit.entries(self.superuser.id, [avtomat], CHANGE, 'Changed Price to 1.50'),
+                            price=150)
+        self.assertFalse(LogEntry.objects.exists())
+
+
+class ImporterTests(ServerTestCase):
+
+    def prepare(self, content: str) -> importer.ImportPlan:
+        response = self.client.post(reverse('admin:server_panel_avtomat_import'), {
+            'csv_file': SimpleUploadedFile('avtomats.csv', content.encode(), content_type='text/csv')})
+        return response.context['plan']
+
+    def test_dry_run_then_apply(self):
+        self.create_avtomat(1)
+        plan = self.prepare('Number,Street,City,House\n'
+                            '1,Сумська,Харків м.,7\n2,Сумська,Харків м.,9\nx,,,\n3,Пушкінська,,1\n')
+        self.assertEqual((plan.rows, plan.created, plan.updated), (4, 1, 1))
+        self.assertEqual([error['number'] for error in plan.errors], ['x', '3'])
+        self.assertEqual(plan.changes[0]['changes'], [('House', '5', '7')])
+        # Nothing is written by the dry run
+        self.assertEqual(list(Avtomat.objects.values_list('avtomat_number', 'house')), [(1, '5')])
+
+        with self.captureOnCommitCallbacks(using='vodomat_server', execute=True):
+            response = self.client.post(reverse('admin:server_panel_avtomat_import_apply', args=[plan.id]))
+        self.assertRedirects(response, reverse('admin:server_panel_avtomat_changelist'), fetch_redirect_response=False)
+        self.assertEqual(list(Avtomat.objects.order_by('avtomat_number').values_list('avtomat_number', 'house')),
+                         [(1, '7'), (2, '9')])
+        self.assertEqual(LogEntry.objects.filter(object_id__in=['1', '2']).count(), 2)
+        self.assertIsNone(importer.apply(plan.id, self.superuser.id))
+
+    def test_avtomats_deleted_after_the_dry_run_are_skipped(self):
+        self.create_avtomat(1)
+        self.create_avtomat(2)
+        plan = self.prepare('Number,House\n1,7\n2,8\n')
+        Avtomat.objects.filter(avtomat_number=1).delete()
+        self.assertEqual(importer.apply(plan.id, self.superuser.id), (0, 1, [1]))
+        self.assertEqual(list(Avtomat.objects.values_list('avtomat_number', 'house')), [(2, '8')])
+
+
+class KeysetPaginatorTests(ServerTestCase):
+
+    def paginator(self) -> paginators.KeysetPaginator:
+        return paginators.KeysetPaginator(Avtomat.objects.order_by('avtomat_number'), 2)
+
+    def test_pages_after_the_first_seek_by_number(self):
+        for number in range(1, 6):
+            self.create_avtomat(number)
+        paginator = self.paginator()
+        self.assertEqual([avtomat.avtomat_number for avtomat in paginator.page(3).object_list], [5])
+        self.assertEqual([avtomat.avtomat_number for avtomat in paginator.page(2).object_list], [3, 4])
+
+    def test_stale_count(self):
+        for number in range(1, 6):
+            self.create_avtomat(number)
+        self.assertEqual(self.paginator().count, 5)
+        # Deleted by the server while the count is cached
+        Avtomat.objects.filter(avtomat_number__gt=1).delete()
+        with self.assertRaises(EmptyPage):
+            self.paginator().page(3)
+        self.assertEqual(self.paginator().count, 1)
+
+        Avtomat.objects.bulk_create(Avtomat(avtomat_number=number, street=self.street, house='5', state=1)
+                                    for number in range(2, 206))
+        paginators.invalidate()
+        self.client.get(reverse('admin:server_panel_avtomat_changelist'))
+        Avtomat.objects.filter(avtomat_number__gt=100).delete()
+        response = self.client.get(reverse('admin:server_panel_avtomat_changelist'), {'p': 3})
+        self.assertRedirects(response, reverse('admin:server_panel_avtomat_changelist') + '?e=1',
+                             fetch_redirect_response=False)
+
+
+REPLICAS = {'vodomat_server_replica_1': 2, 'vodomat_server_replica_2': 1}
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS)
+class ReplicaRoutingTests(SimpleTestCase):
+    """Routing decisions of ``ServerRouter``, no query reaches the replica aliases."""
+
+    def setUp(self):
+        self.router = dbrouters.ServerRouter()
+
+    def reads(self, count: int = 6) -> list[str]:
+        return [self.router.db_for_read(Avtomat) for _ in range(count)]
+
+    def test_reads_outside_a_request_are_spread_by_weight(self):
+        self.assertEqual(self.reads(), ['vodomat_server_replica_1', 'vodomat_server_replica_2',
+                                        'vodomat_server_replica_1'] * 2)
+
+    def test_a_request_or_bound_work_reads_from_one_replica(self):
+        for start in (dbrouters.start_request, dbrouters.bind):
+            with self.subTest(start.__name__):
+                if start is dbrouters.bind:
+                    with dbrouters.bind():
+                        reads = self.reads()
+                else:
+                    token = start()
+                    reads = self.reads()
+                    dbrouters.end_request(token)
+                self.assertEqual(len(set(reads)), 1)
+                self.assertIn(reads[0], REPLICAS)
+
+    def test_reads_after_a_write_go_to_the_primary(self):
+        token = dbrouters.start_request()
+        try:
+            self.assertIn(self.router.db_for_read(Avtomat), REPLICAS)
+            self.assertEqual(self.router.db_for_write(Avtomat), dbrouters.PRIMARY)
+            self.assertEqual(self.reads(), [dbrouters.PRIMARY] * 6)
+        finally:
+            dbrouters.end_request(token)
+
+    def test_pinned_and_atomic_reads_go_to_the_primary(self):
+        with dbrouters.use_primary():
+            self.assertEqual(self.reads(), [dbrouters.PRIMARY] * 6)
+        with mock.patch.object(connections[dbrouters.PRIMARY], 'in_atomic_block', True):
+            self.assertEqual(self.reads(), [dbrouters.PRIMARY] * 6)
+
+    def test_other_apps_are_not_routed(self):
+        self.assertIsNone(self.router.db_for_read(LogEntry))
+        self.assertFalse(self.router.allow_migrate('vodomat_server_replica_1', 'admin'))
+
+    def test_panel_and_admin_migrations_run_only_on_the_default_database(self):
+        for app_label in ('server_panel', 'admin'):
+            with self.subTest(app_label):
+                self.assertTrue(self.router.allow_migrate('default', app_label))
+                self.assertFalse(self.router.allow_migrate(dbrouters.PRIMARY, app_label))
+                self.assertFalse(self.router.allow_migrate('vodomat_server_replica_1', app_label))
+        self.assertIsNone(self.router.allow_migrate(dbrouters.PRIMARY, 'auth'))
+
+    def test_stickiness_cookie(self):
+        factory = RequestFactory()
+
+        def view(write):
+            def get_response(request):
+                if write:
+                    self.router.db_for_write(Avtomat)
+                return HttpResponse(self.router.db_for_read(Avtomat))
+            return PrimaryStickinessMiddleware(get_response)
+
+        cookie = PrimaryStickinessMiddleware.cookie_name
+        response = view(write=True)(factory.post('/'))
+        self.assertEqual(response.content.decode(), dbrouters.PRIMARY)
+        self.assertIn(cookie, response.cookies)
+        # Only a request that changed something sets the cookie
+        self.assertNotIn(cookie, view(write=False)(factory.post('/')).cookies)
+        self.assertNotIn(cookie, view(write=True)(factory.get('/')).cookies)
+
+        # The next requests of the browser read from the primary until the cookie expires
+        request = factory.get('/')
+        request.COOKIES[cookie] = '1'
+        self.assertEqual(view(write=False)(request).content.decode(), dbrouters.PRIMARY)
+        self.assertIn(view(write=False)(factory.get('/')).content.decode(), REPLICAS)
@@ -1,3 +1,38 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.admin.views.autocomplete import AutocompleteJsonView
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+
+from . import metrics, street_labels
+from .models import Street
+
+
+class StreetAutocompleteJsonView(AutocompleteJsonView):
+    """Autocomplete that labels streets from the cached street label map."""
+
+    labels = {}
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        if self.model_admin.model is Street:
+            self.labels = street_labels.get_labels(obj.pk for obj in context['object_list'])
+        return context
+
+    def serialize_result(self, obj, to_field_name):
+        label = self.labels.get(obj.pk)
+        if label is None:
+            return super().serialize_result(obj, to_field_name)
+        return {'id': str(getattr(obj, to_field_name)), 'text': label}
+
+
+def metrics_view(request):
+    """Prometheus metrics, for the bearer token of METRICS_TOKEN or a staff user."""
+    if settings.METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization, f'Bearer {settings.METRICS_TOKEN}'):
+            raise PermissionDenied
+    elif not (request.user.is_active and request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')